@@ -23,6 +23,8 @@ extern struct lf_state {
   const char *filter_name;
   FILE *in;
   FILE *out;
+  bool shm;  // server can hand out attribute values in shared memory
+  bool forkable;  // filter has called lf_enable_fork()
 } lf_state;
 
 lf_obj_handle_t lf_obj_handle_new(void);
@@ -23,6 +23,8 @@
 #include <string.h>
 #include <errno.h>
 #include <signal.h>
+#include <sys/socket.h>
+#include <sys/un.h>
 
 #include "lib_filter.h"
 #include "lf_protocol.h"
@@ -107,6 +109,14 @@ static gpointer logger(gpointer data) {
   return NULL;
 }
 
+static void start_logger(int stdout_log) {
+  if (g_thread_create(logger, GINT_TO_POINTER(stdout_log), false,
+                      NULL) == NULL) {
+    g_warning("Can't create logger thread");
+    exit(EXIT_FAILURE);
+  }
+}
+
 static void lf_init(void) {
   int stdin_orig;
   int stdout_orig;
@@ -132,14 +142,112 @@ static void lf_init(void) {
   // unbuffer fake stdout
   setbuf(stdout, NULL);
 
+  // check whether the server offers shared memory attribute handoff
+  const char *shm = getenv("DIAMOND_FILTER_SHM");
+  lf_state.shm = shm != NULL && strcmp(shm, "1") == 0;
+
   // start logging thread
-  if (g_thread_create(logger, GINT_TO_POINTER(stdout_log), false,
-                      NULL) == NULL) {
-    g_warning("Can't create logger thread");
+  start_logger(stdout_log);
+}
+
+void lf_enable_fork(void) {
+  lf_state.forkable = true;
+}
+
+static int connect_template_socket(const char *path) {
+  struct sockaddr_un addr;
+  int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+  assert_result(fd);
+  memset(&addr, 0, sizeof(addr));
+  addr.sun_family = AF_UNIX;
+  g_strlcpy(addr.sun_path, path, sizeof(addr.sun_path));
+  assert_result(connect(fd, (struct sockaddr *) &addr, sizeof(addr)));
+  return fd;
+}
+
+static void open_connection(int fd, FILE **in, FILE **out) {
+  *in = fdopen(fd, "r");
+  *out = fdopen(dup(fd), "w");
+  if (!*in || !*out) {
+    perror("Can't open template socket");
     exit(EXIT_FAILURE);
   }
 }
 
+// Serve as a template process for the filter, which has already been
+// initialized by our parent: fork a copy of ourselves whenever the
+// server asks.  Returns in each copy, connected to the server.
+static void serve_template(const char *path) {
+  FILE *in;
+  FILE *out;
+
+  // leave the parent's pipes to the parent, so the server still sees
+  // them close if the parent dies
+  fclose(lf_state.in);
+  fclose(lf_state.out);
+  int devnull = open("/dev/null", O_WRONLY);
+  assert_result(devnull);
+  assert_result(dup2(devnull, 1));
+  assert_result(close(devnull));
+
+  // don't leave zombies behind
+  signal(SIGCHLD, SIG_IGN);
+
+  open_connection(connect_template_socket(path), &in, &out);
+  while (true) {
+    g_free(lf_get_string(in));
+    pid_t pid = fork();
+    if (pid == 0) {
+      break;
+    }
+    lf_send_tag(out, "forked");
+    if (pid == -1) {
+      lf_send_blank(out);
+    } else {
+      lf_send_int(out, pid);
+    }
+  }
+
+  // in the copy
+  signal(SIGCHLD, SIG_DFL);
+  fclose(in);
+  fclose(out);
+  open_connection(connect_template_socket(path), &lf_state.in,
+                  &lf_state.out);
+  // the output lock may have been copied while held by our parent's
+  // logger thread
+  g_static_mutex_init(&out_mutex);
+  int stdout_pipe[2];
+  assert_result(pipe(stdout_pipe));
+  assert_result(dup2(stdout_pipe[1], 1));
+  assert_result(close(stdout_pipe[1]));
+  start_logger(stdout_pipe[0]);
+}
+
+// Offer to fork copies of the filter after initialization.  Returns true
+// in the copies.
+static bool offer_fork(void) {
+  const char *protocol = getenv("DIAMOND_FILTER_PROTOCOL");
+  if (!lf_state.forkable || protocol == NULL || atoi(protocol) < 2) {
+    return false;
+  }
+  lf_start_output();
+  lf_send_tag(lf_state.out, "declare-fork");
+  lf_end_output();
+  char *path = lf_get_string(lf_state.in);
+  if (path == NULL) {
+    return false;
+  }
+  pid_t pid = fork();
+  if (pid == 0) {
+    serve_template(path);
+    g_free(path);
+    return true;
+  }
+  g_free(path);
+  return false;
+}
+
 static void lf_run_filter(char *filter_name, filter_init_proto init,
                           filter_eval_proto eval_int,
                           filter_eval_double_proto eval_double,
@@ -156,10 +264,12 @@ static void lf_run_filter(char *filter_name, filter_init_proto init,
     exit(EXIT_FAILURE);
   }
 
-  // report init success
-  lf_start_output();
-  lf_send_tag(lf_state.out, "init-success");
-  lf_end_output();
+  // report init success, unless we are a forked copy
+  if (!offer_fork()) {
+    lf_start_output();
+    lf_send_tag(lf_state.out, "init-success");
+    lf_end_output();
+  }
 
   // eval loop
   while (true) {
@@ -18,6 +18,9 @@
 #include <errno.h>
 #include <stdlib.h>
 #include <string.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
 
 #include "lib_filter.h"
 #include "lf_protocol.h"
@@ -33,12 +36,17 @@ struct ohandle {
 struct attribute {
   size_t len;
   void *data;
+  bool mapped;  // data is a read-only mapping of shared memory
 };
 
 static void attribute_destroy(gpointer user_data) {
   struct attribute *attr = user_data;
 
-  g_free(attr->data);
+  if (attr->mapped) {
+    munmap(attr->data, attr->len);
+  } else {
+    g_free(attr->data);
+  }
   g_slice_free(struct attribute, attr);
 }
 
@@ -58,12 +66,87 @@ void lf_obj_handle_free(lf_obj_handle_t obj) {
   g_slice_free(struct ohandle, ohandle);
 }
 
+static struct attribute *map_attribute(const char *name) {
+  lf_start_output();
+  lf_send_tag(lf_state.out, "map-attribute");
+  lf_send_string(lf_state.out, name);
+  lf_end_output();
+
+  // reply is an array: empty if the attribute is missing, the value
+  // itself, or the path, offset, and length of a shared copy
+  void *items[3];
+  int lens[3];
+  int count = 0;
+  while (true) {
+    int len;
+    void *data = lf_get_binary(lf_state.in, &len);
+    if (len == -1) {
+      break;
+    }
+    if (count == 3) {
+      g_warning("Bad map-attribute reply");
+      exit(EXIT_FAILURE);
+    }
+    items[count] = data;
+    lens[count++] = len;
+  }
+
+  struct attribute *attr = NULL;
+  if (count == 1) {
+    attr = g_slice_new(struct attribute);
+    attr->data = items[0];
+    attr->len = lens[0];
+    attr->mapped = false;
+  } else if (count == 3) {
+    // items were read as binaries; terminate them to parse as strings
+    char *path = g_strndup(items[0], lens[0]);
+    char *offset = g_strndup(items[1], lens[1]);
+    char *length = g_strndup(items[2], lens[2]);
+
+    int fd = open(path, O_RDONLY);
+    if (fd == -1) {
+      perror("Can't open shared attribute");
+      exit(EXIT_FAILURE);
+    }
+    attr = g_slice_new(struct attribute);
+    attr->len = g_ascii_strtoull(length, NULL, 10);
+    attr->data = mmap(NULL, attr->len, PROT_READ, MAP_SHARED, fd,
+                      g_ascii_strtoull(offset, NULL, 10));
+    if (attr->data == MAP_FAILED) {
+      perror("Can't map shared attribute");
+      exit(EXIT_FAILURE);
+    }
+    attr->mapped = true;
+    close(fd);
+
+    g_free(path);
+    g_free(offset);
+    g_free(length);
+    for (int i = 0; i < count; i++) {
+      g_free(items[i]);
+    }
+  } else if (count != 0) {
+    g_warning("Bad map-attribute reply");
+    exit(EXIT_FAILURE);
+  }
+  return attr;
+}
+
 static struct attribute *get_attribute(struct ohandle *ohandle,
                                        const char *name) {
   // look up in hash table
   struct attribute *attr = g_hash_table_lookup(ohandle->attributes,
 					       name);
 
+  // map from shared memory?
+  if (attr == NULL && lf_state.shm) {
+    attr = map_attribute(name);
+    if (attr != NULL) {
+      g_hash_table_insert(ohandle->attributes, g_strdup(name), attr);
+    }
+    return attr;
+  }
+
   // retrieve?
   if (attr == NULL) {
     lf_start_output();
@@ -82,6 +165,7 @@ static struct attribute *get_attribute(struct ohandle *ohandle,
     attr = g_slice_new(struct attribute);
     attr->data = data;
     attr->len = len;
+    attr->mapped = false;
 
     g_hash_table_insert(ohandle->attributes, g_strdup(name), attr);
   }
@@ -210,6 +210,17 @@ void lf_main_double(filter_init_proto init, filter_eval_double_proto eval);
     }
 
 
+/*!
+ * Allow the server to start further instances of this filter by forking
+ * a copy of it after initialization, rather than starting and
+ * initializing each instance separately.  Call this from the filter init
+ * function.  Only safe if the initialized filter holds no threads or
+ * connections that copies cannot share.
+ */
+diamond_public
+void lf_enable_fork(void);
+
+
 /*!
  * Read an attribute from the object into the buffer space provided
  * by the caller.  This does invoke a copy and for large structures
@@ -249,7 +260,9 @@ int lf_read_attr(lf_obj_handle_t ohandle, const char *name, size_t *len,
 /*!
  * Get pointer to attribute data in an object.  The returned pointer should
  * be treated read-only, and is only valid in the current instance of the
- * filter.  
+ * filter.  If the server hands out large attribute values in shared memory,
+ * the pointer refers to a read-only mapping of the server's copy and no
+ * data is copied; writing through it will crash the filter.
  * \param ohandle
  * 		the object handle.
  *
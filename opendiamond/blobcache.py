@@ -155,16 +155,16 @@ class BlobCache(object):
 class ExecutableBlobCache(BlobCache):
     '''A BlobCache that can create executable files from cache entries.
 
-    Creates a temporary directory in TMPDIR and does not clean it up,
-    under the expectation that the entire TMPDIR will be blown away after
-    the search is complete.
+    Creates a temporary directory in TMPDIR, or in tempdir if specified,
+    and does not clean it up, under the expectation that the entire TMPDIR
+    will be blown away after the search is complete.
     '''
 
-    def __init__(self, basedir):
+    def __init__(self, basedir, tempdir=None):
         BlobCache.__init__(self, basedir)
         # Ensure _executable_dir is inside the search-specific tempdir
-        self._executable_dir = mkdtemp(dir=os.environ.get('TMPDIR'),
-                                       prefix='executable-')
+        self._executable_dir = mkdtemp(
+            dir=tempdir or os.environ.get('TMPDIR'), prefix='executable-')
 
     def executable_path(self, sig):
         '''Return a path to the file containing the specified data
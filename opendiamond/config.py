@@ -99,14 +99,63 @@ class DiamondConfig(object):
         # Define configuration parameters
         params = _ConfigParams(
             # -- diamondd
+            # Maximum number of objects a worker evaluates together
+            _Param('batch_size', 'BATCHSIZE', 1),
+            # Milliseconds to wait for a batch to fill before evaluating it
+            _Param('batch_timeout', 'BATCHTIMEOUT', 100),
             # Cache directory expiration
             _Param('blob_cache_days', 'BLOBDAYS', 30),
+            # Only cache attribute values that have been looked up before
+            _Param('cache_admission_sketch', 'CACHEADMITSKETCH', 0),
+            # Seconds until attribute cache entries expire; 0 for never
+            _Param('cache_attribute_ttl', 'CACHEATTRTTL', 0),
+            # 1 to compress large attribute cache values
+            _Param('cache_compress', 'CACHECOMPRESS', 0),
+            # 1 to key filter results on the object data rather than the
+            # object ID, so that objects with the same data share them
+            _Param('cache_content_keys', 'CACHECONTENTKEYS', 0),
             # Redis database
             _Param('cache_database', 'CACHEDB', 0),
+            # Directory for the embedded cache used without a Redis server
+            _Param('cache_disk_dir', 'CACHEDISKDIR',
+                   os.path.join(confdir, 'resultcache')),
+            # MB of disk for the embedded cache used without a Redis
+            # server; 0 to disable caching without one
+            _Param('cache_disk_mb', 'CACHEDISKMB', 0),
+            # Objects each worker takes from the scope ahead of time, so
+            # that their cache entries can be fetched together; 0 to
+            # disable
+            _Param('cache_lookahead', 'CACHELOOKAHEAD', 0),
+            # Result cache entries of an object: 0 under a key per filter,
+            # 1 in a single record per object, falling back to per-filter
+            # keys written before the switch, 2 in records only
+            _Param('cache_object_records', 'CACHERECORDS', 0),
             # Redis password
             _Param('cache_password', 'CACHEPASSWD', None),
-            # Redis host and port
+            # Result cache entries to write: 1 for JSON, 2 for the compact
+            # binary encoding, which older servers sharing the cache cannot
+            # read.  Both are read.
+            _Param('cache_result_format', 'CACHEFORMAT', 1),
+            # Seconds until result cache entries expire; 0 for never
+            _Param('cache_result_ttl', 'CACHERESULTTTL', 0),
+            # 1 to index cached scores by filter, so that repeating a search
+            # with different thresholds skips objects whose scores are out
+            # of range without fetching their results
+            _Param('cache_score_index', 'CACHESCOREINDEX', 0),
+            # MB of memory for the objects that each search finds out of
+            # range in the score indexes; objects beyond it have their
+            # results fetched as usual
+            _Param('cache_score_index_mb', 'CACHESCOREINDEXMB', 16),
+            # Redis host and port, or several separated by spaces or commas
+            # to shard the cache across them
             _Param('cache_server', 'CACHE', None),
+            # 1 to have Redis decide which objects' cached results prove
+            # they should be dropped, so that only the verdict is sent;
+            # requires CACHERECORDS
+            _Param('cache_server_resolution', 'CACHESERVERRESOLVE', 0),
+            # MB of cache updates to queue for writing in the background;
+            # 0 to write them synchronously
+            _Param('cache_write_mb', 'CACHEWRITEMB', 0),
             # Cache directory
             _Param('cachedir', 'CACHEDIR', os.path.join(confdir, 'cache')),
             # PEM data for scope cookie signing certificates
@@ -122,16 +171,56 @@ class DiamondConfig(object):
             _Param('debug_command', None, 'valgrind'),
             # Names or signatures of filters to run under a debugger
             _Param('debug_filters', None, []),
+            # "threads" to run the whole filter stack in each worker thread,
+            # or "pipeline" to run each filter as a separate stage
+            _Param('execution_mode', 'EXECMODE', 'threads'),
+            # Memory limit in MB for idle filter processes kept by the
+            # supervisor for later searches, or 0 to disable
+            _Param('filter_cache_mb', 'FILTERCACHEMB', 0),
+            # Seconds to keep an idle filter process for later searches
+            _Param('filter_cache_ttl', 'FILTERCACHETTL', 300),
+            # 1 to let filters that offer to fork initialized copies of
+            # themselves do so
+            _Param('filter_fork', 'FILTERFORK', 0),
+            # Maximum processes per filter, as "<filter name> <count>";
+            # otherwise sized from the time spent in each filter.  Also
+            # the thread count of the filter's stage in pipeline mode.
+            _Param('filter_processes', 'FILTERPROCS', []),
+            # Highest filter protocol version to offer to filters; 2 for
+            # the binary framed protocol
+            _Param('filter_protocol', 'FILTERPROTOCOL', 1),
             # Number of days of logfiles to keep
             _Param('logdays', 'LOGDAYS', 14),
             # Directory for logfiles
             _Param('logdir', 'LOGDIR', os.path.join(confdir, 'log')),
+            # MB of memory for caching attribute values in each search,
+            # in front of Redis; 0 to disable
+            _Param('memory_cache_attribute_mb', 'MEMCACHEATTRMB', 0),
+            # MB of memory for caching result entries in each search, in
+            # front of Redis; 0 to disable
+            _Param('memory_cache_result_mb', 'MEMCACHERESULTMB', 0),
             # Don't fork when a connection arrives
             _Param('oneshot', None, False),
+            # Maximum filters to run concurrently on each object, when
+            # their declared dependencies allow
+            _Param('parallel_filters', 'PARALLELFILTERS', 1),
+            # Objects queued before each pipeline stage; 0 for no limit
+            _Param('pipeline_queue', 'PIPELINEQUEUE', 16),
+            # 1 to start filter processes before the search starts
+            _Param('prewarm', 'PREWARM', 0),
             # HTTP proxy
             _Param('http_proxy', 'HTTP_PROXY', None),
+            # Objects between adaptive reorderings of filters; 0 to keep
+            # the declared order
+            _Param('reorder_interval', 'REORDERINTERVAL', 0),
             # Canonical server names
             _Param('serverids', 'SERVERID', []),
+            # Directory for shared memory copies of attribute values;
+            # ideally on tmpfs.  Defaults to the search's temporary directory
+            _Param('shm_dir', 'SHMDIR', None),
+            # Minimum attribute size (bytes) for handing values to filters
+            # via shared memory rather than their pipes; 0 to disable
+            _Param('shm_threshold', 'SHMTHRESHOLD', 0),
             # Worker threads per child process
             _Param('threads', 'THREADS', default_threads),
             # HTTP user agent
@@ -228,16 +317,36 @@ class DiamondConfig(object):
             except IOError:
                 pass
 
-        # Parse the Redis server address if specified
+        # Parse the Redis server addresses if specified
         if self.cache_server is not None:
-            if ':' not in self.cache_server:
-                self.cache_server += ':6379'
-            host, port = self.cache_server.split(':', 1)
+            servers = []
+            for server in self.cache_server.replace(',', ' ').split():
+                if ':' not in server:
+                    server += ':6379'
+                host, port = server.split(':', 1)
+                try:
+                    port = int(port)
+                except ValueError:
+                    raise DiamondConfigError('Invalid port number: ' + port)
+                servers.append((host, port))
+            if not servers:
+                raise DiamondConfigError('No cache servers specified')
+            self.cache_server = servers
+
+        if self.execution_mode not in ('threads', 'pipeline'):
+            raise DiamondConfigError('Invalid execution mode: ' +
+                                     self.execution_mode)
+
+        # Parse per-filter process limits
+        limits = dict()
+        for entry in self.filter_processes:
             try:
-                port = int(port)
+                name, count = entry.rsplit(None, 1)
+                limits[name] = int(count)
             except ValueError:
-                raise DiamondConfigError('Invalid port number: ' + port)
-            self.cache_server = (host, port)
+                raise DiamondConfigError('Invalid filter process limit: ' +
+                                         entry)
+        self.filter_processes = limits
 
         # Canonicalize debug options
         self.debug_filters = set(self.debug_filters)
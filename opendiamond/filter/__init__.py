@@ -12,7 +12,10 @@
 
 from __future__ import with_statement
 from cStringIO import StringIO
+import mmap
 import os
+import signal
+import socket
 import sys
 from tempfile import mkstemp
 import threading
@@ -23,6 +26,8 @@ import PIL.Image
 from opendiamond.attributes import (
     StringAttributeCodec, IntegerAttributeCodec, DoubleAttributeCodec,
     RGBImageAttributeCodec, PatchesAttributeCodec, HeatMapAttributeCodec)
+from opendiamond.framing import (
+    FrameCodec, PROTOCOL_VERSION, SHARED_MEMORY_ENV, advertised_version)
 
 EXAMPLE_DIR = 'examples'
 
@@ -86,6 +91,20 @@ class Filter(object):
     # Set to True to decode example images from the blob argument and set
     # self.examples to a list of PIL.Image.
     load_examples = False
+    # Set to True to map large attribute values from shared memory, if the
+    # server offers it, rather than receiving a copy over the pipe.
+    # get_binary() may then return a read-only buffer object.
+    shared_attributes = False
+    # Names of attributes this filter reads from every object.  If the
+    # server supports it, their values are sent along with each new object
+    # instead of being requested one at a time.  May be overridden per
+    # instance in __init__().
+    input_attributes = ()
+    # Set to True if the server may start further instances of the filter
+    # by forking a copy of it after initialization, rather than starting
+    # and initializing each one separately.  Only safe if the initialized
+    # filter holds no threads or connections that copies cannot share.
+    forkable = False
 
     def __init__(self, args, blob, session=Session('filter')):
         '''Called to initialize the filter.  After a subclass calls the
@@ -117,6 +136,13 @@ class Filter(object):
         search score.'''
         raise NotImplementedError()
 
+    def evaluate_batch(self, objects):
+        '''Called with a list of objects to be evaluated together.  Returns
+        a list of Diamond search scores, one per object.  Override this to
+        amortize per-call overhead across objects; if overridden, the
+        server may hand the filter several objects at a time.'''
+        return [self(obj) for obj in objects]
+
     def load_egg(self, module=None, globals=None, data=None):
         '''Treat data as the contents of an egg and add it to the Python
         path.  If data is not specified, self.blob will be used.  As a
@@ -177,6 +203,9 @@ class Filter(object):
             name = conn.get_item()
             args = conn.get_array()
             blob = conn.get_item()
+            # Upgrade to binary framing if the server offers it
+            if advertised_version(os.environ) >= PROTOCOL_VERSION:
+                conn.negotiate()
             session = Session(name, conn)
             if classes is not None:
                 # Use the class named by the first filter argument
@@ -191,22 +220,109 @@ class Filter(object):
             else:
                 filter_class = cls
             filter = filter_class(args, blob, session)
-            conn.send_message('init-success')
+            shared = (filter_class.shared_attributes and
+                      os.environ.get(SHARED_MEMORY_ENV) == '1')
+            pushed = list(filter.input_attributes)
+            if pushed and advertised_version(os.environ) >= 2:
+                conn.send_message('declare-attributes',
+                                  'map' if shared else 'get', pushed)
+            else:
+                pushed = []
+            batching = (filter_class.evaluate_batch.im_func is not
+                        Filter.evaluate_batch.im_func and
+                        advertised_version(os.environ) >= 2)
+            if batching:
+                conn.send_message('declare-batch')
+            path = None
+            if filter_class.forkable and advertised_version(os.environ) >= 2:
+                conn.send_message('declare-fork')
+                path = conn.get_item()
+            if path is not None and os.fork() == 0:
+                # We are the template; this returns only in forked copies,
+                # which are already initialized
+                conn = _serve_template(path, conn)
+                session._conn = conn
+            else:
+                conn.send_message('init-success')
 
             # Main loop
             while True:
-                obj = _DiamondObject(conn)
-                result = filter(obj)
-                if result is True:
-                    result = 1
-                elif result is False or result is None:
-                    result = 0
-                conn.send_message('result', result)
-                obj.invalidate()
+                if batching:
+                    count = int(conn.get_item())
+                    conn.start_batch()
+                    objs = [_DiamondObject(conn, shared, i)
+                            for i in range(count)]
+                    for obj in objs:
+                        obj.receive_pushed(pushed)
+                    results = filter.evaluate_batch(objs)
+                    if len(results) != count:
+                        raise ValueError('evaluate_batch() returned %d '
+                                         'results for %d objects' %
+                                         (len(results), count))
+                    conn.send_message('batch-result',
+                                      [_score(r) for r in results])
+                    for obj in objs:
+                        obj.invalidate()
+                else:
+                    obj = _DiamondObject(conn, shared)
+                    obj.receive_pushed(pushed)
+                    conn.send_message('result', _score(filter(obj)))
+                    obj.invalidate()
         except IOError:
             pass
 
 
+def _connect_template_socket(path, framed):
+    '''Connect to the server socket for forked copies of the filter.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    conn = _DiamondConnection(sock.makefile('rb', 1),
+                              sock.makefile('wb', 32768), framed)
+    sock.close()
+    return conn
+
+
+def _serve_template(path, conn):
+    '''Serve as a template process for the filter, which has already been
+    initialized by our parent: fork a copy of ourselves whenever the server
+    asks.  Returns a new connection in each copy.'''
+    # Leave the parent's pipes to the parent, so the server still sees
+    # them close if the parent dies
+    conn.close()
+    fh = open('/dev/null', 'w')
+    os.dup2(fh.fileno(), 1)
+    fh.close()
+    # Don't leave zombies behind
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    template = _connect_template_socket(path, conn.framed)
+    while True:
+        template.get_item()
+        try:
+            pid = os.fork()
+        except OSError:
+            template.send_message('forked', None)
+            continue
+        if pid == 0:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            template.close()
+            conn = _connect_template_socket(path, template.framed)
+            read_fd, write_fd = os.pipe()
+            os.dup2(write_fd, 1)
+            os.close(write_fd)
+            _StdoutThread(os.fdopen(read_fd, 'r', 0), conn).start()
+            return conn
+        template.send_message('forked', pid)
+
+
+def _score(result):
+    '''Convert a filter return value to a Diamond search score.'''
+    if result is True:
+        return 1
+    elif result is False or result is None:
+        return 0
+    return result
+
+
 class LingeringObjectError(Exception):
     '''Raised when an Object is accessed after it is no longer in play.'''
     pass
@@ -361,34 +477,123 @@ class Object(object):
 class _DiamondObject(Object):
     '''A Diamond object to be evaluated.'''
 
-    def __init__(self, conn):
+    def __init__(self, conn, shared=False, index=None):
         Object.__init__(self)
         self._conn = conn
+        self._shared = shared
+        # Position within the current batch, if the filter takes batches
+        self._index = index
+
+    def receive_pushed(self, keys):
+        '''Read the values of the declared input attributes, which the
+        server sends at the start of each object.'''
+        for key in keys:
+            if self._shared:
+                self._attrs[key] = self._get_mapped()
+            else:
+                self._attrs[key] = self._conn.get_item()
+
+    def _select(self):
+        '''Direct the following object commands at this object.'''
+        if self._index is not None:
+            self._conn.select_object(self._index)
 
     def _get_attribute(self, key):
+        self._select()
+        if self._shared:
+            self._conn.send_message('map-attribute', key)
+            return self._get_mapped()
         self._conn.send_message('get-attribute', key)
         return self._conn.get_item()
 
+    def _get_mapped(self):
+        '''Read a map-attribute reply and return the value, if any.'''
+        handle = self._conn.get_array()
+        if not handle:
+            return None
+        elif len(handle) == 1:
+            return handle[0]
+        path, offset, length = handle
+        return _map_shared(path, int(offset), int(length))
+
     def _set_attribute(self, key, value):
+        self._select()
         self._conn.send_message('set-attribute', key, value)
 
     def _omit_attribute(self, key):
+        self._select()
         self._conn.send_message('omit-attribute', key)
         if not self._conn.get_boolean():
             raise KeyError()
 
 
+def _map_shared(path, offset, length):
+    '''Return a read-only buffer over a region of a shared memory file.
+    The mapping lives as long as the buffer does.'''
+    with open(path, 'rb') as fh:
+        region = mmap.mmap(fh.fileno(), length, access=mmap.ACCESS_READ,
+                           offset=offset)
+    return buffer(region)
+
+
 class _DiamondConnection(object):
     '''Proxy object for the stdin/stdout protocol connection with the
     Diamond server.'''
     # XXX Work here to change the filter protocol (client side)
-    def __init__(self, fin, fout):
+
+    # With binary framing, messages after which the server may be left
+    # waiting with no further output from us
+    _flushing_tags = frozenset(('init-success', 'result', 'stdout'))
+
+    def __init__(self, fin, fout, framed=False):
         self._fin = fin
         self._fout = fout
         self._output_lock = threading.Lock()
+        # FrameCodec once we have upgraded to protocol version 2
+        self._framing = FrameCodec(fin, fout) if framed else None
+        # Batch index last selected with select-object
+        self._selected = 0
+
+    def negotiate(self, version=PROTOCOL_VERSION):
+        '''Ask the server to switch to the specified protocol version.
+        Returns True if the server agreed.  The output lock is held until
+        the switch so that no other thread can interleave a message in the
+        wrong framing.'''
+        with self._output_lock:
+            self._send_message('set-protocol', version)
+            accepted = self.get_boolean()
+            if accepted:
+                self._framing = FrameCodec(self._fin, self._fout)
+            return accepted
+
+    @property
+    def framed(self):
+        return self._framing is not None
+
+    def close(self):
+        '''Close the connection.'''
+        self._fin.close()
+        self._fout.close()
+
+    def start_batch(self):
+        '''Note that the server has started a new batch, in which the
+        first object is implicitly selected.'''
+        self._selected = 0
+
+    def select_object(self, index):
+        '''Direct subsequent object commands at the specified object of
+        the current batch.'''
+        if index != self._selected:
+            self.send_message('select-object', index)
+            self._selected = index
 
     def get_item(self):
         '''Read and return a string or blob.'''
+        if self._framing is not None:
+            with self._output_lock:
+                # Flush any batched output the server is waiting for
+                self._framing.flush()
+            return self._framing.get_item()
         sizebuf = self._fin.readline()
         if not sizebuf:
             # End of file
@@ -425,20 +630,39 @@ class _DiamondConnection(object):
     def send_message(self, tag, *values):
         '''Atomically sends a message, consisting of a tag followed by one
         or more values.  An argument can be a list or tuple, in which case
-        it is serialized as an array of values terminated by a blank line.'''
-        def send_value(value):
-            value = str(value)
-            self._fout.write('%d\n%s\n' % (len(value), value))
+        it is serialized as an array of values terminated by a blank line.
+        With binary framing, messages that do not end an exchange are
+        batched until the next read or flushing message.'''
         with self._output_lock:
-            self._fout.write('%s\n' % tag)
+            self._send_message(tag, *values)
+
+    def _send_message(self, tag, *values):
+        if self._framing is not None:
+            framing = self._framing
+            framing.put_tag(tag)
             for value in values:
                 if isinstance(value, (list, tuple)):
                     for el in value:
-                        send_value(el)
-                    self._fout.write('\n')
+                        framing.put_item(el)
+                    framing.put_none()
                 else:
-                    send_value(value)
-            self._fout.flush()
+                    framing.put_item(value)
+            if tag in self._flushing_tags:
+                framing.flush()
+            return
+
+        def send_value(value):
+            value = str(value)
+            self._fout.write('%d\n%s\n' % (len(value), value))
+        self._fout.write('%s\n' % tag)
+        for value in values:
+            if isinstance(value, (list, tuple)):
+                for el in value:
+                    send_value(el)
+                self._fout.write('\n')
+            else:
+                send_value(value)
+        self._fout.flush()
 
 
 class _StdoutThread(threading.Thread):
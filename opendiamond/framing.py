@@ -0,0 +1,163 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+'''Binary message framing for version 2 of the filter protocol.
+
+Version 1 of the filter protocol is line-oriented: a tag is a line of text,
+and a value is a line containing its decimal length followed by the value
+and a trailing newline.  Version 2 replaces this with fixed-size frame
+headers:
+
+    frame code (unsigned 16-bit, network order)
+    payload length (unsigned 32-bit, network order)
+    payload
+
+A frame code of FRAME_ITEM carries a string or blob.  FRAME_NONE is the
+equivalent of a blank line in version 1: a missing value or the end of an
+array.  Codes starting at FRAME_TAG_BASE are tags, indexed into TAGS, with
+an empty payload.  TAGS is append-only; never renumber existing entries.
+
+Version 2 is negotiated after the version 1 handshake.  The server
+advertises the highest protocol version it supports in the
+DIAMOND_FILTER_PROTOCOL environment variable of the filter process.  If
+the filter supports a newer version, it sends a version 1 "set-protocol"
+message carrying the version number and waits for a boolean reply.  If
+the reply is true, both sides switch framing immediately afterward.
+
+Writers do not flush after every message; the peer must flush pending
+output before blocking on a read.
+
+A server advertising version 2 also accepts "declare-attributes" and
+"declare-batch" during filter initialization, regardless of the framing in
+use.  After "declare-batch", the server begins each evaluation by sending
+the number of objects in the batch.  The first object is selected
+initially; the filter sends "select-object" with an index to address
+attribute commands to another object, and answers the whole batch with
+a single "batch-result" carrying an array of scores.
+
+A filter that can fork initialized copies of itself sends "declare-fork"
+after initializing, and the server replies with the path of a Unix socket,
+or a blank if it declines.  The filter then forks a template process,
+which connects to the socket using the framing already in use.  Whenever
+the server sends an item over the template connection, the template forks
+a copy of itself, replies with "forked" and the copy's PID (or a blank if
+the fork failed), and the copy connects to the socket again.  The server
+treats the new connection as an initialized filter.
+
+Independently of framing, the server sets DIAMOND_FILTER_SHM to 1 if it
+can answer "map-attribute" requests with handles to shared memory.
+'''
+
+import struct
+
+PROTOCOL_ENV = 'DIAMOND_FILTER_PROTOCOL'
+PROTOCOL_VERSION = 2
+SHARED_MEMORY_ENV = 'DIAMOND_FILTER_SHM'
+
+FRAME_HEADER = struct.Struct('!HI')
+FRAME_ITEM = 0
+FRAME_NONE = 1
+FRAME_TAG_BASE = 16
+
+TAGS = (
+    'init-success',
+    'get-attribute',
+    'set-attribute',
+    'omit-attribute',
+    'get-session-variables',
+    'update-session-variables',
+    'log',
+    'stdout',
+    'result',
+    'ensure-resource',
+    'set-protocol',
+    'map-attribute',
+    'declare-attributes',
+    'declare-batch',
+    'select-object',
+    'batch-result',
+    'declare-fork',
+    'forked',
+)
+_TAG_CODES = dict((tag, i + FRAME_TAG_BASE) for i, tag in enumerate(TAGS))
+
+
+def advertised_version(environ):
+    '''Return the protocol version advertised by the server in the
+    specified environment, or 1 if none.'''
+    try:
+        return int(environ.get(PROTOCOL_ENV, 1))
+    except ValueError:
+        return 1
+
+
+class FrameCodec(object):
+    '''Reads and writes version 2 frames on a pair of file-likes.
+    Not thread-safe; callers provide their own locking.'''
+
+    def __init__(self, fin, fout):
+        self._fin = fin
+        self._fout = fout
+        self._pending = False
+
+    def _read_header(self):
+        self.flush()
+        buf = self._fin.read(FRAME_HEADER.size)
+        if not buf:
+            raise IOError('End of input stream')
+        if len(buf) != FRAME_HEADER.size:
+            raise IOError('Short read from stream')
+        return FRAME_HEADER.unpack(buf)
+
+    def get_tag(self):
+        '''Read and return a tag.'''
+        code, _length = self._read_header()
+        if not FRAME_TAG_BASE <= code < FRAME_TAG_BASE + len(TAGS):
+            raise IOError('Unknown tag code %d' % code)
+        return TAGS[code - FRAME_TAG_BASE]
+
+    def get_item(self):
+        '''Read and return a string or blob, or None for a blank.'''
+        code, length = self._read_header()
+        if code == FRAME_NONE:
+            return None
+        elif code != FRAME_ITEM:
+            raise IOError('Expected item, got frame code %d' % code)
+        item = self._fin.read(length)
+        if len(item) != length:
+            raise IOError('Short read from stream')
+        return item
+
+    def put_tag(self, tag):
+        '''Queue a tag for writing.'''
+        self._fout.write(FRAME_HEADER.pack(_TAG_CODES[tag], 0))
+        self._pending = True
+
+    def put_item(self, value):
+        '''Queue a string or blob for writing.  The header and payload are
+        handed to the output buffer separately so large values are not
+        copied into a temporary string.'''
+        value = str(value)
+        self._fout.write(FRAME_HEADER.pack(FRAME_ITEM, len(value)))
+        self._fout.write(value)
+        self._pending = True
+
+    def put_none(self):
+        '''Queue a blank for writing.'''
+        self._fout.write(FRAME_HEADER.pack(FRAME_NONE, 0))
+        self._pending = True
+
+    def flush(self):
+        '''Flush queued output, if any.'''
+        if self._pending:
+            self._pending = False
+            self._fout.flush()
@@ -29,6 +29,15 @@ connection pair.
 temporary directories and killing all of their children (filters and helper
 processes).
 
+4.  If FILTERCACHEMB is set, keeping a cache of initialized filter
+processes for reuse by later searches running identical filters.  Cached
+processes are started by the supervisor, which initializes them in
+background threads; this is the only time the supervisor is not
+single-threaded.  Search processes inherit their pipes and lease them
+instead of starting filters of their own.  Idle processes are killed
+after FILTERCACHETTL seconds, or sooner if the cache exceeds its memory
+limit.
+
 The child is responsible for handling the search.  Initially it has only one
 thread, which is responsible for handling the control connection back to the
 client.  All client RPCs, including search reexecution, are handled in this
@@ -43,34 +52,68 @@ The blast channel is also shared.  There are also shared objects for logging
 and for tracking of statistics and session variables.  All of these objects
 have locking to ensure consistency.
 
-Each worker thread maintains a private TCP connection to the Redis server,
-which is used for result and attribute caching.  Each worker thread also
-maintains one child process for each filter in the filter stack.  These
+Each worker thread maintains a private TCP connection to each Redis server,
+which is used for result and attribute caching.  With several servers, keys
+are spread across them by consistent hashing.  Without a Redis server,
+the caches can instead live in an SQLite database on local disk, shared by
+all searches and bounded in size by evicting the least recently used
+entries.  The worker threads share
+a pool of child processes for each filter in the filter stack.  These
 children are the actual filter code, and communicate with the worker thread
-via a pair of pipes.  Because each worker thread has its own set of filter
-processes, worker threads can process objects independently.
+leasing them via a pair of pipes.  A pool starts processes on demand, up to
+a configured limit or the filter's share of the worker threads in
+proportion to the time spent in it, so expensive filters get more
+processes than cheap ones.
 
 Each worker thread executes a loop:
 
 1.  Obtain a new object from the ScopeListLoader.
 
-2.  Retrieve result cache entries from Redis.
+2.  Retrieve result cache entries.
 
 3.  Walk the result cache entries to determine if a drop decision can be
 made.  If so, drop the object.
 
 4.  For each filter in the filter chain, determine whether we received a
 valid result cache entry for the filter.  If so, attempt to obtain attribute
-cache entries from Redis.  If successful, merge the cached attributes into
-the object.  Otherwise, execute the filter.  If the filter produces a drop
-decision, break.
+cache entries.  If successful, merge the cached attributes into the object.
+Otherwise, execute the filter.  If the filter produces a drop decision,
+break.
 
-5.  Transmit new result cache entries, as well as attribute cache entries
-for filters producing less than 2 MB/s of attribute values, to Redis.
+5.  Queue new result cache entries, as well as attribute cache entries
+for filters expected to take longer to recompute their output than the
+cache takes to return it, for a background thread to write.  The thread
+coalesces entries from all workers into pipelined batches, and writes any
+still queued when the search ends.
 
 6.  If accepting the object, transmit it to the client via the blast
 channel.
 
+Once setup() or send_blobs() has made all filter code and blob arguments
+available, the search begins starting filter processes in background
+threads, so that the worker threads find them already initialized when the
+search starts.
+
+A filter may offer to fork initialized copies of itself.  Its first
+process then forks a template process, which connects back to the search
+and forks a copy of itself for each further process the pool needs, so
+that expensive initialization runs once and its memory is shared
+copy-on-write.
+
+With PARALLELFILTERS greater than 1, a worker thread runs filters that do
+not depend on one another concurrently on each object, up to that many at
+once, and stops as soon as one of them drops the object.  A filter reading
+another's output must then declare a dependency on it.  An attribute
+written by several filters takes its value from the last of them in
+declared order.  This shortens the time to evaluate each object, which
+matters most when reexecuting filters interactively.
+
+With EXECMODE set to "pipeline", the worker threads are instead divided
+into stages: one set of threads fetches objects and consults the result
+cache, and each filter has its own threads, fed by a bounded queue from the
+stage before it.  An object leaves the pipeline at the stage that drops it,
+and the stage that finishes with an object updates the cache.
+
 If a filter crashes while processing an object, the object is dropped and
 the filter is restarted.  If a worker thread or the control thread crashes,
 the exception is logged and the entire search is terminated.
@@ -89,12 +132,15 @@ from opendiamond.blobcache import ExecutableBlobCache
 from opendiamond.helpers import daemonize, signalname
 from opendiamond.rpc import RPCConnection, ConnectionFailure
 from opendiamond.server.child import ChildManager
+from opendiamond.server.filtercache import FilterProcessCache
 from opendiamond.server.listen import ConnListener
 from opendiamond.server.search import Search
 
 SEARCH_LOG_DATE_FORMAT = '%Y-%m-%d-%H:%M:%S'
 SEARCH_LOG_FORMAT = 'search-%s-%d.log'          # Args: date, pid
 SEARCH_LOG_REGEX = r'search-(.+)-[0-9]+\.log$'  # Match group: timestamp
+# Seconds between checks of the filter process cache while idle
+FILTER_CACHE_INTERVAL = 10
 
 _log = logging.getLogger(__name__)
 
@@ -133,7 +179,16 @@ class DiamondServer(object):
             daemonize()
 
         self.config = config
-        self._children = ChildManager(config.cgroupdir, not config.oneshot)
+        # Idle filter processes kept for later searches.  Pointless in
+        # oneshot mode, since there will be no later searches.
+        if config.filter_cache_mb and not config.oneshot:
+            self._filter_cache = FilterProcessCache(config)
+            keep = self._filter_cache.reusable_pids
+        else:
+            self._filter_cache = None
+            keep = None
+        self._children = ChildManager(config.cgroupdir, not config.oneshot,
+                                      keep)
         self._listener = ConnListener()
         self._last_log_prune = datetime.fromtimestamp(0)
         self._last_cache_prune = datetime.fromtimestamp(0)
@@ -167,14 +222,27 @@ class DiamondServer(object):
                       opendiamond.__version__, os.getpid())
             _log.info('Server IDs: %s', ', '.join(self.config.serverids))
             if self.config.cache_server:
-                _log.info('Cache: %s:%d', *self.config.cache_server)
+                _log.info('Cache: %s', ', '.join(
+                    '%s:%d' % server for server in self.config.cache_server))
+            elif self.config.cache_disk_mb:
+                _log.info('Cache: %s, %d MB', self.config.cache_disk_dir,
+                          self.config.cache_disk_mb)
             while True:
                 # Check for search logs that need to be pruned
                 self._prune_child_logs()
                 # Check for blob cache objects that need to be pruned
                 self._prune_blob_cache()
                 # Accept a new connection pair
-                control, data = self._listener.accept()
+                if self._filter_cache is not None:
+                    pair = self._listener.accept(FILTER_CACHE_INTERVAL)
+                    # Start processes requested by earlier searches
+                    # before forking
+                    self._filter_cache.service()
+                    if pair is None:
+                        continue
+                else:
+                    pair = self._listener.accept()
+                control, data = pair
                 # Fork a child for this connection pair.  In the child, this
                 # does not return.
                 self._children.start(self._child, control, data)
@@ -187,6 +255,8 @@ class DiamondServer(object):
             self._listener.shutdown()
             # Kill our children and clean up after them
             self._children.kill_all()
+            if self._filter_cache is not None:
+                self._filter_cache.shutdown()
             # Shut down logging
             logging.shutdown()
             # Ensure our exit status reflects that we died on the signal
@@ -227,7 +297,8 @@ class DiamondServer(object):
                 _log.info('Worker threads: %d', self.config.threads)
                 # Set up connection wrappers and search object
                 control = RPCConnection(control)
-                search = Search(self.config, RPCConnection(data))
+                search = Search(self.config, RPCConnection(data),
+                                self._filter_cache)
                 # Dispatch RPCs on the control connection until we die
                 while True:
                     control.dispatch(search)
@@ -0,0 +1,1302 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+'''Access to the storage holding the result and attribute caches: a Redis
+server, or an embedded database on local disk.
+
+See opendiamond.server.filter for the layout of the caches.
+'''
+
+from __future__ import with_statement
+import bisect
+from collections import OrderedDict
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import zlib
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from opendiamond.helpers import murmur
+
+# Seconds to wait at the end of a search for queued cache updates to be
+# written
+WRITE_FLUSH_TIMEOUT = 30
+# Maximum bytes of keys and values in a single MSET, so that a large
+# batch doesn't monopolize the server
+WRITE_CHUNK_SIZE = 4 << 20
+# Leading bytes of a compressed attribute cache value, followed by a zlib
+# stream.  Values without it are stored as-is.
+ATTRIBUTE_COMPRESSED = '\0DZ\1'
+# Attribute values smaller than this are stored as-is
+ATTRIBUTE_COMPRESS_MIN = 1024
+# Attribute values at least this large are compressed at a faster level
+ATTRIBUTE_COMPRESS_LARGE = 1 << 20
+# Attribute name suffixes of values that are already compressed
+ATTRIBUTE_PRECOMPRESSED = ('.jpeg', '.jpg', '.png', '.gif', '.gz', '.bz2',
+                           '.xz', '.zip')
+# Compressed values must be at most this fraction of the original size
+ATTRIBUTE_COMPRESS_RATIO = 0.9
+# Attribute cache fetch bandwidth (bytes/sec) assumed until it has been
+# measured
+ADMISSION_DEFAULT_BANDWIDTH = 2 << 20
+# Weight of the newest sample in running cost estimates
+ADMISSION_DECAY = 0.05
+# Attribute cache fetches to measure before trusting the estimates
+ADMISSION_MIN_SAMPLES = 10
+# Counters per row of the reuse sketch, and number of rows
+SKETCH_WIDTH = 1 << 16
+SKETCH_DEPTH = 4
+# Prefix of the keys holding admission policy state between searches: a
+# filter digest's execution estimate, or the fetch model or reuse sketch
+ADMISSION_PREFIX = 'admission:'
+# Separates an object record's key from the field within it, in keys
+# that address a field of a record
+RECORD_SEPARATOR = '#'
+# Prefix of records that are score indexes: sorted sets of members by score
+SCORE_INDEX_PREFIX = 'scores:'
+# Separates a score index member, in Redis, from the time it expires
+SCORE_EXPIRY_SEPARATOR = ':'
+# Score index members to fetch per request when scanning an index
+SCORE_SCAN_PAGE = 10000
+# Approximate bytes of memory for each score index member a search holds
+SCORE_MEMBER_SIZE = 200
+# Prefix of the first element of an attribute name table, followed by the
+# table's generation.  Attribute names never contain NUL.
+NAMES_GENERATION = '\0'
+# Points on the consistent hash ring for each Redis server
+SHARD_POINTS = 160
+# Name of the embedded cache database within cache_disk_dir
+DISK_DATABASE = 'cache.sqlite'
+# Seconds to wait for another process to release the embedded database
+DISK_LOCK_TIMEOUT = 30
+# Approximate bytes of bookkeeping per embedded cache entry
+DISK_ENTRY_OVERHEAD = 64
+# Eviction from the embedded cache frees space down to this fraction of
+# its limit, so that it needn't evict on every write
+DISK_EVICT_TARGET = 0.9
+# Seconds between recorded accesses of an embedded cache entry, to avoid
+# a write for every read
+DISK_ATIME_INTERVAL = 60
+# Maximum parameters in one SQLite statement
+DISK_BATCH = 500
+# Approximate bytes of bookkeeping per MemoryCache entry, beyond its key
+# and value
+MEMORY_ENTRY_OVERHEAD = 100
+# Lua script deciding, on the Redis server, whether the result cache
+# entries in each of a batch of object records prove that the object
+# should be dropped.  It follows FilterStackRunner's resolution of cached
+# results: a result outside its score bounds drops the object if each of
+# its input attributes matches an output of another resolvable result.
+#   KEYS: the records, then the attribute name table of each filter
+#   ARGV: filter count, then per filter: record field, minimum score and
+#         maximum score, with '' for no bound
+# Returns per record an empty list if no drop can be proven, or the
+# participating filters as a flat list of (index, score) pairs.
+RESOLVE_SCRIPT = '''
+local n = tonumber(ARGV[1])
+local nrecords = #KEYS - n
+local fields, lo, hi = {}, {}, {}
+for i = 1, n do
+    fields[i] = ARGV[3 * i - 1]
+    lo[i] = tonumber(ARGV[3 * i])
+    hi[i] = tonumber(ARGV[3 * i + 1])
+end
+
+local tables = {}
+local function names(i)
+    local t = tables[i]
+    if t == nil then
+        t = redis.call('LRANGE', KEYS[nrecords + i], 0, -1)
+        tables[i] = t
+    end
+    return t
+end
+
+local function hex(raw)
+    return (string.gsub(raw, '.', function(c)
+        return string.format('%02x', string.byte(c))
+    end))
+end
+
+local function varint(data, pos)
+    local value, scale = 0, 1
+    while true do
+        local byte = string.byte(data, pos)
+        pos = pos + 1
+        value = value + (byte % 128) * scale
+        if byte < 128 then
+            return value, pos
+        end
+        scale = scale * 128
+    end
+end
+
+-- Return the score, input name -> hash or false, and output name -> hash
+-- of a result cache entry, or nil
+local function decode(i, data)
+    if string.byte(data, 1) ~= 2 then
+        local dct = cjson.decode(data)
+        local inputs = {}
+        for name, sig in pairs(dct.input_attrs) do
+            inputs[name] = sig ~= cjson.null and sig
+        end
+        return tonumber(dct.score), inputs, dct.output_attrs
+    end
+    local t = names(i)
+    local flags, pos = varint(data, 2)
+    local generation
+    generation, pos = varint(data, pos)
+    if t[1] ~= '\\0' .. generation then
+        -- Interned in a name table that has since been lost
+        return nil
+    end
+    local score
+    if flags % 2 == 1 then
+        score, pos = varint(data, pos)
+        if score % 2 == 0 then
+            score = score / 2
+        else
+            score = -(score + 1) / 2
+        end
+    else
+        score, pos = struct.unpack('>d', data, pos)
+    end
+    local inputs, outputs = {}, {}
+    local count, id
+    count, pos = varint(data, pos)
+    for _ = 1, count do
+        id, pos = varint(data, pos)
+        local name = t[math.floor(id / 2) + 1]
+        if name == nil then
+            return nil
+        end
+        if id % 2 == 1 then
+            inputs[name] = hex(string.sub(data, pos, pos + 15))
+            pos = pos + 16
+        else
+            inputs[name] = false
+        end
+    end
+    count, pos = varint(data, pos)
+    for _ = 1, count do
+        id, pos = varint(data, pos)
+        local name = t[id + 1]
+        if name == nil then
+            return nil
+        end
+        outputs[name] = hex(string.sub(data, pos, pos + 15))
+        pos = pos + 16
+    end
+    return score, inputs, outputs
+end
+
+local reply = {}
+for r = 1, nrecords do
+    local values = redis.call('HMGET', KEYS[r], unpack(fields))
+    local results = {}
+    for i = 1, n do
+        if values[i] then
+            local ok, score, inputs, outputs = pcall(decode, i, values[i])
+            if ok and score then
+                results[i] = {score, inputs, outputs}
+            end
+        end
+    end
+
+    -- Attribute name -> filters whose results output it, in declared
+    -- order, as _ResolutionPlan.observe() records them.  Producers it has
+    -- seen only in other objects' results have no result here to use.
+    local producers = {}
+    for i = 1, n do
+        if results[i] then
+            for name in pairs(results[i][3]) do
+                producers[name] = producers[name] or {}
+                table.insert(producers[name], i)
+            end
+        end
+    end
+
+    local resolved, inprocess = {}, {}
+    local function resolve(i)
+        if resolved[i] then
+            return resolved[i]
+        end
+        local result = results[i]
+        if result == nil or inprocess[i] then
+            return nil
+        end
+        inprocess[i] = true
+        local deps = {[i] = true}
+        for name, sig in pairs(result[2]) do
+            local found = false
+            if sig then
+                for _, j in ipairs(producers[name] or {}) do
+                    -- A producer with another value is a cache collision
+                    if results[j][3][name] == sig then
+                        local other_deps = resolve(j)
+                        if other_deps then
+                            for k in pairs(other_deps) do
+                                deps[k] = true
+                            end
+                            found = true
+                            break
+                        end
+                    end
+                end
+            end
+            if not found then
+                inprocess[i] = nil
+                return nil
+            end
+        end
+        inprocess[i] = nil
+        resolved[i] = deps
+        return deps
+    end
+
+    local verdict = {}
+    for i = 1, n do
+        local result = results[i]
+        if result and ((lo[i] and result[1] < lo[i]) or
+                       (hi[i] and result[1] > hi[i])) then
+            local deps = resolve(i)
+            if deps then
+                for j in pairs(deps) do
+                    verdict[#verdict + 1] = j - 1
+                    verdict[#verdict + 1] = string.format('%.17g',
+                                                          results[j][1])
+                end
+                break
+            end
+        end
+    end
+    reply[r] = verdict
+end
+return reply
+'''
+
+_log = logging.getLogger(__name__)
+
+
+class CacheError(Exception):
+    '''The cache backend failed.'''
+
+
+def caching_enabled(config):
+    '''Return True if a cache backend is configured.'''
+    return config.cache_server is not None or bool(config.cache_disk_mb)
+
+
+def connect(config):
+    '''Return a CacheBackend for the configured Redis servers, or
+    otherwise for the embedded cache.  Backends must not be shared between
+    threads.'''
+    if config.cache_server is not None:
+        if len(config.cache_server) > 1:
+            return ShardedBackend(config)
+        return RedisBackend(config, config.cache_server[0])
+    return DiskBackend(config)
+
+
+def record_key(record, field):
+    '''Return a key addressing the field of the record.  Backends store
+    the fields of a record together where they can, e.g. as a Redis hash,
+    so that a batch of keys for the same record costs one lookup.'''
+    return record + RECORD_SEPARATOR + field
+
+
+def score_key(index, member):
+    '''Return a key under which to store the score of the member of the
+    score index.  Backends store a score index as a sorted set where they
+    can, and its score keys are not read with get_many().'''
+    return record_key(index, member)
+
+
+def _split_keys(keys):
+    '''Divide keys into a list of plain keys and a record -> [(field,
+    key)] mapping of keys addressing record fields.'''
+    plain = []
+    records = OrderedDict()
+    for key in keys:
+        if RECORD_SEPARATOR in key:
+            record, field = key.split(RECORD_SEPARATOR, 1)
+            records.setdefault(record, []).append((field, key))
+        else:
+            plain.append(key)
+    return plain, records
+
+
+def _hash_point(data):
+    '''Return the position of the string on the consistent hash ring.'''
+    return int(murmur(data)[:16], 16)
+
+
+def _ttl(config, key):
+    '''Return the seconds until the cache entry should expire, or 0 to
+    keep it indefinitely.'''
+    if key.startswith(('result:', 'object:', SCORE_INDEX_PREFIX)):
+        return config.cache_result_ttl
+    elif key.startswith('attribute:'):
+        return config.cache_attribute_ttl
+    # Attribute name tables must outlive the entries that use them
+    return 0
+
+
+class CacheBackend(object):
+    '''A connection to the storage holding the caches, used by a single
+    thread.  Methods raise CacheError on failure.'''
+
+    def get_many(self, keys):
+        '''Return a list of the values of the keys, with None for those
+        not present.'''
+        raise NotImplementedError()
+
+    def put_many(self, entries):
+        '''Store the key -> value mapping, with the configured expiry
+        times.'''
+        raise NotImplementedError()
+
+    def shard(self, key):
+        '''Return an identifier for the storage node holding the key.'''
+        return 0
+
+    def append(self, key, value, shard=0, create=True):
+        '''Append the value to the list stored under the key on the
+        specified node and return its index.  If create is False and
+        there is no such list, return None instead.'''
+        raise NotImplementedError()
+
+    def get_list(self, key, shard=0):
+        '''Return the list stored under the key on the specified node.'''
+        raise NotImplementedError()
+
+    def scan_scores(self, index, minimum, maximum, limit):
+        '''Return up to limit [(member, score)] of the score index whose
+        scores are above minimum and below maximum, with None for no
+        bound.  Members whose result cache entries would have expired are
+        left out.'''
+        raise NotImplementedError()
+
+    def resolve_drops(self, records, fields, bounds):
+        '''Decide on the storage nodes which of the object records prove
+        that their objects should be dropped.  fields lists the record
+        field of each filter and bounds its (minimum, maximum) accepted
+        score, with None for no bound.  Return a list with, per record,
+        None or the [(filter index, score)] of the filters participating
+        in the drop; or None if the backend cannot decide.'''
+        return None
+
+
+class RedisBackend(CacheBackend):
+    '''A connection to a Redis server, specified as (host, port).'''
+
+    def __init__(self, config, server, redis=None):
+        CacheBackend.__init__(self)
+        self._config = config
+        try:
+            if redis is None:
+                host, port = server
+                redis = Redis(host=host, port=port,
+                              db=config.cache_database,
+                              password=config.cache_password)
+                # Check that the server is available
+                redis.ping()
+        except RedisError, e:
+            raise CacheError(str(e))
+        self._redis = redis
+        self._resolve_script = None
+
+    def get_many(self, keys):
+        '''Fetch plain keys with an MGET and the fields of each record with
+        an HMGET, in one pipeline.'''
+        plain, records = _split_keys(keys)
+        try:
+            if not records:
+                return self._redis.mget(keys)
+            pipe = self._redis.pipeline(transaction=False)
+            if plain:
+                pipe.mget(plain)
+            for record, fields in records.iteritems():
+                pipe.hmget(record, [field for field, _ in fields])
+            replies = iter(pipe.execute())
+        except RedisError, e:
+            raise CacheError(str(e))
+        found = dict()
+        if plain:
+            found.update(zip(plain, replies.next()))
+        for fields, values in zip(records.itervalues(), replies):
+            found.update(zip((key for _, key in fields), values))
+        return [found[key] for key in keys]
+
+    def put_many(self, entries):
+        '''Write the entries as one pipeline: an HMSET for each record,
+        MSETs of other entries that don't expire, and a SET with expiry for
+        each entry that does.'''
+        pipe = self._redis.pipeline(transaction=False)
+        plain, records = _split_keys(entries)
+        for record, fields in records.iteritems():
+            ttl = _ttl(self._config, record)
+            if record.startswith(SCORE_INDEX_PREFIX):
+                # Members can't expire on their own, so those that should
+                # carry the time they expire
+                suffix = ''
+                if ttl:
+                    suffix = '%s%d' % (SCORE_EXPIRY_SEPARATOR,
+                                       int(time.time()) + ttl)
+                args = []
+                for member, key in fields:
+                    args.extend((entries[key], member + suffix))
+                pipe.execute_command('ZADD', record, *args)
+            else:
+                pipe.hmset(record, dict((field, entries[key])
+                                        for field, key in fields))
+            if ttl:
+                pipe.expire(record, ttl)
+        chunk = {}
+        chunk_size = 0
+        for key in plain:
+            value = entries[key]
+            ttl = _ttl(self._config, key)
+            if ttl:
+                pipe.set(key, value, ex=ttl)
+                continue
+            chunk[key] = value
+            chunk_size += len(key) + len(value)
+            if chunk_size >= WRITE_CHUNK_SIZE:
+                pipe.mset(chunk)
+                chunk = {}
+                chunk_size = 0
+        if chunk:
+            pipe.mset(chunk)
+        try:
+            pipe.execute()
+        except RedisError, e:
+            # Possibly due to maxmemory quota
+            raise CacheError(str(e))
+
+    def append(self, key, value, shard=0, create=True):
+        try:
+            if create:
+                length = self._redis.rpush(key, value)
+            else:
+                length = self._redis.rpushx(key, value)
+        except RedisError, e:
+            raise CacheError(str(e))
+        return length - 1 if length else None
+
+    def get_list(self, key, shard=0):
+        try:
+            return self._redis.lrange(key, 0, -1)
+        except RedisError, e:
+            raise CacheError(str(e))
+
+    def scan_scores(self, index, minimum, maximum, limit):
+        '''Page through the range with ZRANGEBYSCORE.  Expired members are
+        removed once the scan is done, so that they don't shift the
+        pages.'''
+        low = '-inf' if minimum is None else '(%r' % float(minimum)
+        high = '+inf' if maximum is None else '(%r' % float(maximum)
+        now = time.time()
+        found = []
+        expired = []
+        offset = 0
+        try:
+            while len(found) < limit:
+                count = min(SCORE_SCAN_PAGE, limit - len(found))
+                page = self._redis.zrangebyscore(index, low, high,
+                                                 start=offset, num=count,
+                                                 withscores=True)
+                for member, score in page:
+                    name, _, expires = member.partition(
+                        SCORE_EXPIRY_SEPARATOR)
+                    if expires and int(expires) <= now:
+                        expired.append(member)
+                    else:
+                        found.append((name, score))
+                if len(page) < count:
+                    break
+                offset += len(page)
+            if expired:
+                self._redis.zrem(index, *expired)
+        except RedisError, e:
+            raise CacheError(str(e))
+        return found
+
+    def resolve_drops(self, records, fields, bounds):
+        '''Run RESOLVE_SCRIPT over the records.'''
+        args = [len(fields)]
+        for field, limits in zip(fields, bounds):
+            args.append(field)
+            for limit in limits:
+                if limit is None or abs(float(limit)) == float('inf'):
+                    args.append('')
+                else:
+                    args.append(repr(float(limit)))
+        try:
+            if self._resolve_script is None:
+                self._resolve_script = self._redis.register_script(
+                    RESOLVE_SCRIPT)
+            replies = self._resolve_script(
+                keys=list(records) + ['names:' + f for f in fields],
+                args=args)
+        except RedisError, e:
+            raise CacheError(str(e))
+        return [zip(reply[::2], [float(s) for s in reply[1::2]]) or None
+                for reply in replies]
+
+
+class ShardedBackend(CacheBackend):
+    '''Connections to several Redis servers, each holding the keys that
+    fall in its share of a consistent hash ring.  Adding or removing a
+    server only moves the keys in its share.  Servers that are unreachable
+    at connection time are left out of the ring, so their keys fall to
+    the others for the life of the connection.
+
+    Shards are identified by the servers' positions in the configuration.
+    Attribute name tables are kept per server, alongside the result cache
+    entries that use them, so that entries and tables move together.'''
+
+    def __init__(self, config, backends=None):
+        CacheBackend.__init__(self)
+        if backends is None:
+            backends = dict()
+            for i, server in enumerate(config.cache_server):
+                try:
+                    backends[i] = RedisBackend(config, server)
+                except CacheError, e:
+                    _log.warning('Cache server %s:%d unavailable: %s',
+                                 server[0], server[1], e)
+            if not backends:
+                raise CacheError('No cache servers available')
+        # shard -> RedisBackend
+        self._backends = backends
+        ring = sorted((_hash_point('%s:%d-%d' % (server + (point,))), i)
+                      for i, server in enumerate(config.cache_server)
+                      if i in backends
+                      for point in xrange(SHARD_POINTS))
+        self._points = [point for point, _ in ring]
+        self._shards = [i for _, i in ring]
+
+    def shard(self, key):
+        # All fields of a record live together
+        record = key.split(RECORD_SEPARATOR, 1)[0]
+        index = bisect.bisect(self._points, _hash_point(record))
+        return self._shards[index % len(self._shards)]
+
+    def _group(self, keys):
+        '''Return a shard -> [key] mapping.'''
+        groups = dict()
+        for key in keys:
+            groups.setdefault(self.shard(key), []).append(key)
+        return groups
+
+    def get_many(self, keys):
+        found = dict()
+        for shard, group in self._group(keys).iteritems():
+            found.update(zip(group, self._backends[shard].get_many(group)))
+        return [found[key] for key in keys]
+
+    def put_many(self, entries):
+        '''Write each server's entries as a pipeline.  Try every server
+        before reporting a failure.'''
+        error = None
+        for shard, group in self._group(entries).iteritems():
+            try:
+                self._backends[shard].put_many(
+                    dict((key, entries[key]) for key in group))
+            except CacheError, e:
+                error = e
+        if error is not None:
+            raise error
+
+    def _backend(self, shard):
+        try:
+            return self._backends[shard]
+        except KeyError:
+            raise CacheError('Cache server %d unavailable' % shard)
+
+    def append(self, key, value, shard=0, create=True):
+        return self._backend(shard).append(key, value, create=create)
+
+    def get_list(self, key, shard=0):
+        return self._backend(shard).get_list(key)
+
+    def scan_scores(self, index, minimum, maximum, limit):
+        return self._backend(self.shard(index)).scan_scores(
+            index, minimum, maximum, limit)
+
+    def resolve_drops(self, records, fields, bounds):
+        '''Run the script on each server over its records.'''
+        found = dict()
+        for shard, group in self._group(records).iteritems():
+            found.update(zip(group, self._backends[shard].resolve_drops(
+                group, fields, bounds)))
+        return [found[record] for record in records]
+
+
+class DiskBackend(CacheBackend):
+    '''A connection to the embedded cache: an SQLite database in
+    cache_disk_dir, shared by all searches on this server and bounded to
+    cache_disk_mb by evicting the least recently used entries.'''
+
+    _schema = (
+        '''CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, value BLOB NOT NULL,
+            size INTEGER NOT NULL, atime INTEGER NOT NULL,
+            expires INTEGER)''',
+        '''CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)''',
+        '''CREATE TABLE IF NOT EXISTS lists (
+            key TEXT NOT NULL, idx INTEGER NOT NULL, value BLOB NOT NULL,
+            PRIMARY KEY (key, idx))''',
+        # Total size of entries, maintained by triggers so that every
+        # process sees it
+        '''CREATE TABLE IF NOT EXISTS usage (
+            id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)''',
+        '''INSERT OR IGNORE INTO usage VALUES (0, 0)''',
+        '''CREATE TRIGGER IF NOT EXISTS entries_insert
+            AFTER INSERT ON entries BEGIN
+                UPDATE usage SET size = size + new.size;
+            END''',
+        '''CREATE TRIGGER IF NOT EXISTS entries_delete
+            AFTER DELETE ON entries BEGIN
+                UPDATE usage SET size = size - old.size;
+            END''',
+    )
+
+    def __init__(self, config):
+        CacheBackend.__init__(self)
+        self._config = config
+        self._limit = config.cache_disk_mb << 20
+        try:
+            if not os.path.isdir(config.cache_disk_dir):
+                os.makedirs(config.cache_disk_dir)
+        except OSError:
+            # Perhaps created concurrently; connect() will tell
+            pass
+        try:
+            # Transactions are managed explicitly
+            self._db = sqlite3.connect(
+                os.path.join(config.cache_disk_dir, DISK_DATABASE),
+                timeout=DISK_LOCK_TIMEOUT, isolation_level=None)
+            self._db.text_factory = str
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA synchronous = NORMAL')
+            # Fire the delete trigger for rows replaced by INSERT OR REPLACE
+            self._db.execute('PRAGMA recursive_triggers = ON')
+            with self._transaction():
+                for statement in self._schema:
+                    self._db.execute(statement)
+        except sqlite3.Error, e:
+            raise CacheError(str(e))
+
+    def _transaction(self):
+        '''Return a context manager for a write transaction.'''
+        return _DiskTransaction(self._db)
+
+    def get_many(self, keys):
+        now = int(time.time())
+        found = dict()
+        try:
+            for start in xrange(0, len(keys), DISK_BATCH):
+                chunk = keys[start:start + DISK_BATCH]
+                rows = self._db.execute(
+                    'SELECT key, value, atime, expires FROM entries '
+                    'WHERE key IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk).fetchall()
+                stale = []
+                for key, value, atime, expires in rows:
+                    if expires is not None and expires <= now:
+                        continue
+                    found[key] = str(value)
+                    if atime < now - DISK_ATIME_INTERVAL:
+                        stale.append(key)
+                if stale:
+                    with self._transaction():
+                        self._db.execute(
+                            'UPDATE entries SET atime = ? '
+                            'WHERE key IN (%s)' %
+                            ','.join('?' * len(stale)), [now] + stale)
+        except sqlite3.Error, e:
+            raise CacheError(str(e))
+        return [found.get(key) for key in keys]
+
+    def put_many(self, entries):
+        now = int(time.time())
+        rows = []
+        for key, value in entries.iteritems():
+            ttl = _ttl(self._config, key)
+            rows.append((key, sqlite3.Binary(value),
+                         len(key) + len(value) + DISK_ENTRY_OVERHEAD, now,
+                         now + ttl if ttl else None))
+        try:
+            with self._transaction():
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                    rows)
+                self._evict(now)
+        except sqlite3.Error, e:
+            raise CacheError(str(e))
+
+    def _evict(self, now):
+        '''If the cache is over its limit, drop expired entries and then
+        the least recently used ones.  Call within a transaction.'''
+        size, = self._db.execute('SELECT size FROM usage').fetchone()
+        if size <= self._limit:
+            return
+        self._db.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+        target = int(self._limit * DISK_EVICT_TARGET)
+        while True:
+            size, = self._db.execute('SELECT size FROM usage').fetchone()
+            if size <= target:
+                break
+            victims = []
+            for key, entry_size in self._db.execute(
+                    'SELECT key, size FROM entries ORDER BY atime LIMIT ?',
+                    (DISK_BATCH,)).fetchall():
+                victims.append(key)
+                size -= entry_size
+                if size <= target:
+                    break
+            if not victims:
+                break
+            self._db.execute('DELETE FROM entries WHERE key IN (%s)' %
+                             ','.join('?' * len(victims)), victims)
+
+    def append(self, key, value, shard=0, create=True):
+        try:
+            with self._transaction():
+                index, = self._db.execute(
+                    'SELECT COALESCE(MAX(idx) + 1, 0) FROM lists '
+                    'WHERE key = ?', (key,)).fetchone()
+                if not index and not create:
+                    return None
+                self._db.execute('INSERT INTO lists VALUES (?, ?, ?)',
+                                 (key, index, sqlite3.Binary(value)))
+        except sqlite3.Error, e:
+            raise CacheError(str(e))
+        return index
+
+    def get_list(self, key, shard=0):
+        try:
+            return [str(value) for value, in self._db.execute(
+                'SELECT value FROM lists WHERE key = ? ORDER BY idx',
+                (key,))]
+        except sqlite3.Error, e:
+            raise CacheError(str(e))
+
+    def scan_scores(self, index, minimum, maximum, limit):
+        '''Select from the score keys of the index, which are ordinary
+        entries sharing a prefix and expiring individually.'''
+        prefix = score_key(index, '')
+        # Keys between the prefix and the prefix with its last character
+        # incremented
+        query = ('SELECT key, value FROM entries WHERE key > ? AND key < ? '
+                 'AND (expires IS NULL OR expires > ?)')
+        args = [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1),
+                int(time.time())]
+        if minimum is not None:
+            query += ' AND CAST(value AS REAL) > ?'
+            args.append(float(minimum))
+        if maximum is not None:
+            query += ' AND CAST(value AS REAL) < ?'
+            args.append(float(maximum))
+        try:
+            rows = self._db.execute(query + ' LIMIT ?', args + [limit])
+            return [(key[len(prefix):], float(str(value)))
+                    for key, value in rows]
+        except sqlite3.Error, e:
+            raise CacheError(str(e))
+
+
+class _DiskTransaction(object):
+    '''Context manager for a write transaction on an SQLite connection in
+    autocommit mode.  The database is locked for writing at the start, so
+    that concurrent searches serialize rather than deadlock.'''
+
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        self._db.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._db.execute('COMMIT')
+        else:
+            self._db.execute('ROLLBACK')
+
+
+def encode_attribute(name, value):
+    '''Return the attribute cache value for the value of the named
+    attribute, compressing it if worthwhile.'''
+    if (len(value) < ATTRIBUTE_COMPRESS_MIN or
+            name.lower().endswith(ATTRIBUTE_PRECOMPRESSED)):
+        return value
+    level = 1 if len(value) >= ATTRIBUTE_COMPRESS_LARGE else 6
+    data = ATTRIBUTE_COMPRESSED + zlib.compress(value, level)
+    if len(data) > len(value) * ATTRIBUTE_COMPRESS_RATIO:
+        return value
+    return data
+
+
+def decode_attribute(key, data):
+    '''Return the attribute value stored by encode_attribute() under the
+    attribute cache key.'''
+    if data is None or not data.startswith(ATTRIBUTE_COMPRESSED):
+        return data
+    try:
+        value = zlib.decompress(buffer(data, len(ATTRIBUTE_COMPRESSED)))
+    except zlib.error:
+        return data
+    # An uncompressed value could begin with the header, so make sure
+    if key != 'attribute:' + murmur(value):
+        return data
+    return value
+
+
+def _entry_size(key, value):
+    return len(key) + len(value) + MEMORY_ENTRY_OVERHEAD
+
+
+class MemoryCache(object):
+    '''An in-memory tier in front of the cache backend, shared by the
+    threads of a search: a least-recently-used cache of string values,
+    bounded by the total size of its keys and values.'''
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._lock = threading.Lock()
+        # key -> value, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get_many(self, keys):
+        '''Return a list of the values of the keys, with None for those
+        not present.'''
+        values = []
+        with self._lock:
+            for key in keys:
+                try:
+                    value = self._entries.pop(key)
+                except KeyError:
+                    values.append(None)
+                else:
+                    # Most recently used
+                    self._entries[key] = value
+                    values.append(value)
+        return values
+
+    def update(self, mapping):
+        '''Store the key -> value mapping, evicting the least recently used
+        entries as necessary.'''
+        with self._lock:
+            for key, value in mapping.iteritems():
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self._size -= _entry_size(key, old)
+                size = _entry_size(key, value)
+                if size <= self._limit:
+                    self._entries[key] = value
+                    self._size += size
+            while self._size > self._limit:
+                key, value = self._entries.popitem(last=False)
+                self._size -= _entry_size(key, value)
+
+
+class AttributeNames(object):
+    '''Interned ids for the attribute names in compact result cache
+    entries, shared by the threads of a search.  Each filter digest has its
+    own table on each storage node, kept as a list; an id is an index into
+    the list.  Lists only grow, so an id stays valid for every server.  If
+    a list is lost, as when Redis evicts it, a new one is started with a
+    new generation, a random number recorded in its first element and in
+    each entry interned with it, so that entries interned with the lost
+    list are not read against its successor.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (shard, digest) -> generation, or None if there is no usable list
+        self._generations = dict()
+        # (shard, digest) -> set of generations found to have been lost
+        self._lost = dict()
+        # (shard, digest) -> name -> id
+        self._ids = dict()
+        # (shard, digest) -> id -> name
+        self._names = dict()
+
+    def _refresh(self, backend, table, create=False):
+        '''Reload the table, a (shard, digest) pair, first starting it if
+        create is True and the list does not exist.  Call with the lock
+        held.'''
+        shard, digest = table
+        key = 'names:' + digest
+        values = backend.get_list(key, shard)
+        if not values and create:
+            backend.append(key, NAMES_GENERATION +
+                           str(random.getrandbits(31)), shard)
+            # Another writer may have started the list first
+            values = backend.get_list(key, shard)
+        ids = self._ids[table] = dict()
+        names = self._names[table] = dict()
+        generation = None
+        if values and values[0].startswith(NAMES_GENERATION):
+            generation = int(values[0][len(NAMES_GENERATION):])
+            for i, name in enumerate(values):
+                if not name.startswith(NAMES_GENERATION):
+                    names[i] = name
+                    # A name appended concurrently by two writers has two
+                    # ids
+                    ids.setdefault(name, i)
+        previous = self._generations.get(table)
+        if previous is not None and previous != generation:
+            self._lost.setdefault(table, set()).add(previous)
+        self._generations[table] = generation
+
+    def get_ids(self, backend, shard, digest, names):
+        '''Return the generation of the digest's table on the shard and a
+        list of the ids of the names in it, adding new names to the
+        table.'''
+        table = (shard, digest)
+        key = 'names:' + digest
+        with self._lock:
+            # Check, extend, and if the list was lost meanwhile, extend a
+            # new one
+            for _i in xrange(3):
+                ids = self._ids.get(table, dict())
+                if (self._generations.get(table) is not None and
+                        all(name in ids for name in names)):
+                    return (self._generations[table],
+                            [ids[name] for name in names])
+                self._refresh(backend, table, True)
+                if self._generations[table] is None:
+                    break
+                ids = self._ids[table]
+                for name in names:
+                    if name not in ids:
+                        i = backend.append(key, name, shard, False)
+                        if i is None:
+                            break
+                        ids[name] = i
+                        self._names[table][i] = name
+        raise CacheError('Cannot extend attribute name table ' + key)
+
+    def get_names(self, backend, shard, digest, generation, ids):
+        '''Return a list of the names with the ids in the given generation
+        of the digest's table on the shard, with None for unknown ids and
+        for every id if that generation was lost.'''
+        table = (shard, digest)
+        with self._lock:
+            if generation in self._lost.get(table, ()):
+                return [None] * len(ids)
+            names = self._names.get(table, dict())
+            if (self._generations.get(table) != generation or
+                    any(i not in names for i in ids)):
+                self._refresh(backend, table)
+                if self._generations[table] != generation:
+                    self._lost.setdefault(table, set()).add(generation)
+                    return [None] * len(ids)
+                names = self._names[table]
+            return [names.get(i) for i in ids]
+
+
+class _ReuseSketch(object):
+    '''A count-min sketch of how often attribute values have been looked
+    up, with saturating counters that are halved periodically so that old
+    lookups fade.  Call with the owner's lock held.'''
+
+    def __init__(self):
+        self._counts = bytearray(SKETCH_WIDTH * SKETCH_DEPTH)
+        self._additions = 0
+
+    def _slots(self, sig):
+        # sig is a hex murmur() hash, so its digits are already uniform
+        return [row * SKETCH_WIDTH +
+                int(sig[row * 8:row * 8 + 8], 16) % SKETCH_WIDTH
+                for row in xrange(SKETCH_DEPTH)]
+
+    def add(self, sig):
+        for slot in self._slots(sig):
+            if self._counts[slot] < 255:
+                self._counts[slot] += 1
+        self._additions += 1
+        if self._additions >= SKETCH_WIDTH * 10:
+            self._additions = 0
+            for slot in xrange(len(self._counts)):
+                self._counts[slot] >>= 1
+
+    def estimate(self, sig):
+        return min(self._counts[slot] for slot in self._slots(sig))
+
+    def encode(self):
+        return zlib.compress(str(self._counts))
+
+    def decode(self, data):
+        try:
+            counts = bytearray(zlib.decompress(data))
+        except zlib.error:
+            return
+        if len(counts) == len(self._counts):
+            self._counts = counts
+
+
+class AdmissionPolicy(object):
+    '''Decides which filter outputs to store in the attribute cache; shared
+    by the threads of a search.  Outputs are admitted if recomputing them
+    is expected to take longer than fetching them from the cache.
+
+    Recompute cost is a running estimate of execution seconds per object
+    for each filter digest.  Fetch cost is modeled as latency + bytes /
+    bandwidth, fitted to measured attribute cache loads by decayed least
+    squares.  With a reuse sketch, an output is also only admitted if its
+    value has been looked up before.
+
+    The estimates and sketch are kept in the cache between searches: the
+    execution estimate of each filter digest under its own key, so that
+    searches with different filters don't overwrite each other's.
+    Concurrent searches with the same filter keep the last one saved.'''
+
+    def __init__(self, sketch=False):
+        self._lock = threading.Lock()
+        # digest -> running seconds per execution
+        self._execution = dict()
+        # Decayed sums over fetches of 1, bytes, seconds, bytes^2, and
+        # bytes * seconds
+        self._sums = [0.0] * 5
+        self._fetches = 0
+        self._latency = 0.0
+        self._per_byte = 1.0 / ADMISSION_DEFAULT_BANDWIDTH
+        self._sketch = _ReuseSketch() if sketch else None
+
+    def load(self, backend, digests):
+        '''Restore the state saved by earlier searches, including the
+        execution estimates of the filter digests.  Raise CacheError on
+        failure.'''
+        keys = ([ADMISSION_PREFIX + 'fetch', ADMISSION_PREFIX + 'sketch'] +
+                [ADMISSION_PREFIX + digest for digest in digests])
+        values = backend.get_many(keys)
+        with self._lock:
+            if values[0] is not None:
+                try:
+                    fields = [float(v) for v in values[0].split()]
+                    self._sums = fields[:5]
+                    self._fetches = int(fields[5])
+                    self._latency, self._per_byte = fields[6:8]
+                except (ValueError, IndexError):
+                    _log.warning('Ignoring unreadable admission state')
+            if values[1] is not None and self._sketch is not None:
+                self._sketch.decode(values[1])
+            for digest, value in zip(digests, values[2:]):
+                if value is not None and digest not in self._execution:
+                    try:
+                        self._execution[digest] = float(value)
+                    except ValueError:
+                        pass
+
+    def save(self, backend):
+        '''Store the state for later searches.  Raise CacheError on
+        failure.'''
+        with self._lock:
+            entries = dict((ADMISSION_PREFIX + digest, repr(estimate))
+                           for digest, estimate in
+                           self._execution.iteritems())
+            if self._fetches:
+                entries[ADMISSION_PREFIX + 'fetch'] = ' '.join(
+                    repr(v) for v in self._sums + [self._fetches,
+                                                   self._latency,
+                                                   self._per_byte])
+            if self._sketch is not None:
+                entries[ADMISSION_PREFIX + 'sketch'] = self._sketch.encode()
+        if entries:
+            backend.put_many(entries)
+
+    @property
+    def fetch_estimate(self):
+        '''Return the estimated latency of a fetch in seconds and the
+        estimated seconds per byte.'''
+        with self._lock:
+            return self._latency, self._per_byte
+
+    def record_fetch(self, nbytes, seconds):
+        '''Record an attribute cache load of nbytes in total.'''
+        with self._lock:
+            sample = (1.0, nbytes, seconds, float(nbytes) * nbytes,
+                      float(nbytes) * seconds)
+            self._sums = [(1 - ADMISSION_DECAY) * cur + ADMISSION_DECAY * new
+                          for cur, new in zip(self._sums, sample)]
+            self._fetches += 1
+            if self._fetches < ADMISSION_MIN_SAMPLES:
+                return
+            n, x, y, xx, xy = self._sums
+            variance = n * xx - x * x
+            if variance <= 0:
+                # All fetches were the same size; keep the bandwidth
+                self._latency = max(0.0, (y - self._per_byte * x) / n)
+                return
+            per_byte = (n * xy - x * y) / variance
+            if per_byte > 0:
+                self._per_byte = per_byte
+            self._latency = max(0.0, (y - self._per_byte * x) / n)
+
+    def record_lookups(self, sigs):
+        '''Record attempts to load attribute values with the signatures.'''
+        if self._sketch is None:
+            return
+        with self._lock:
+            for sig in sigs:
+                self._sketch.add(sig)
+
+    def admit(self, digest, seconds, nbytes, sigs):
+        '''Record an execution of the filter with the digest, taking the
+        specified seconds and producing output values of nbytes in total
+        with the signatures, and return True if the values should be
+        cached.'''
+        with self._lock:
+            estimate = self._execution.get(digest, seconds)
+            estimate += ADMISSION_DECAY * (seconds - estimate)
+            self._execution[digest] = estimate
+            if estimate <= self._latency + self._per_byte * nbytes:
+                return False
+            if self._sketch is not None:
+                return all(self._sketch.estimate(sig) for sig in sigs)
+            return True
+
+
+class ScoreIndex(object):
+    '''The objects of a search that the score indexes of its filters show
+    to be out of range, loaded on first use and shared by the worker
+    threads.  At most limit objects are held, so that memory doesn't grow
+    with the indexes; the others have their results fetched as usual.'''
+
+    def __init__(self, limit):
+        self._lock = threading.Lock()
+        self._limit = limit
+        # murmur(object ID) -> (query index, score)
+        self._drops = None
+
+    def drops(self, backend, queries):
+        '''Return the murmur(object ID) -> (query index, score) mapping for
+        objects whose score in some index is out of bounds.  queries is a
+        list of (score index, minimum, maximum) with None for no bound; an
+        object found by several queries is attributed to the first.'''
+        with self._lock:
+            if self._drops is None:
+                drops = dict()
+                for i, (index, low, high) in enumerate(queries):
+                    ranges = []
+                    if low is not None:
+                        ranges.append((None, low))
+                    if high is not None:
+                        ranges.append((high, None))
+                    for minimum, maximum in ranges:
+                        limit = self._limit - len(drops)
+                        if limit <= 0:
+                            break
+                        for member, score in backend.scan_scores(
+                                index, minimum, maximum, limit):
+                            drops.setdefault(member, (i, score))
+                self._drops = drops
+            return self._drops
+
+
+class CacheWriter(object):
+    '''Writes cache entries to the backend from a background thread, so that
+    worker threads need not wait for them.  Entries queued by all workers
+    are coalesced by key and written in pipelined batches.  Entries that
+    would take the queue beyond its memory budget are dropped.'''
+
+    def __init__(self, config, stats):
+        self._config = config
+        self._stats = stats
+        self._limit = config.cache_write_mb << 20
+        self._cond = threading.Condition()
+        # key -> value awaiting write
+        self._pending = dict()
+        # Bytes of keys and values queued or being written
+        self._size = 0
+        self._closed = False
+        self._thread = None
+
+    def put(self, entries):
+        '''Queue the key -> value mapping for writing.'''
+        queued = coalesced = dropped = 0
+        with self._cond:
+            if self._closed:
+                dropped = len(entries)
+                entries = {}
+            for key, value in entries.iteritems():
+                size = len(key) + len(value)
+                old = self._pending.get(key)
+                if old is not None:
+                    size -= len(key) + len(old)
+                if self._size + size > self._limit:
+                    dropped += 1
+                    continue
+                self._pending[key] = value
+                self._size += size
+                if old is not None:
+                    coalesced += 1
+                else:
+                    queued += 1
+            size = self._size
+            if self._thread is None and self._pending:
+                self._thread = threading.Thread(target=self._run,
+                                                name='CacheWriter')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._cond.notify()
+        self._stats.update(cache_writes_queued=queued,
+                           cache_writes_coalesced=coalesced,
+                           cache_writes_dropped=dropped,
+                           cache_write_queue_max=size)
+
+    def _run(self):
+        '''Thread function.'''
+        backend = None
+        warned = False
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, dict()
+                size = sum(len(k) + len(v) for k, v in batch.iteritems())
+            try:
+                if backend is None:
+                    backend = connect(self._config)
+                backend.put_many(batch)
+            except CacheError, e:
+                if not warned:
+                    warned = True
+                    _log.warning('Failed to update cache: %s', e)
+                self._stats.update(cache_writes_failed=len(batch))
+            else:
+                self._stats.update('cache_write_batches')
+            with self._cond:
+                self._size -= size
+
+    def close(self):
+        '''Write the queued entries, waiting up to WRITE_FLUSH_TIMEOUT
+        seconds, and stop the thread.  Later entries are dropped.'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(WRITE_FLUSH_TIMEOUT)
+            if thread.isAlive():
+                _log.warning('Gave up waiting for cache updates')
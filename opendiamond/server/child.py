@@ -22,6 +22,9 @@ import time
 
 from opendiamond.helpers import signalname
 
+# Set in search processes to the tasks file of their cgroup, if any
+CGROUP_TASKS_ENV = 'DIAMOND_CGROUP_TASKS'
+
 _log = logging.getLogger(__name__)
 
 
@@ -61,20 +64,23 @@ class _SearchChild(object):
             # Move ourselves into a dedicated cgroup if available
             if self._taskfile is not None:
                 open(self._taskfile, 'w').write('%d\n' % os.getpid())
+                os.environ[CGROUP_TASKS_ENV] = self._taskfile
         else:
             _log.info('Launching PID %d', self.pid)
 
         return self.pid
 
-    def cleanup(self):
+    def cleanup(self, keep=()):
         '''Clean up the process' temporary directory.  If cgroups are
         enabled, also kill the process (if still running) and all of its
-        descendents.'''
+        descendents, except for the PIDs in keep.  Those belong to the
+        supervisor and are moved back to the parent cgroup.'''
         if not self._terminated:
             self._terminated = True
 
             # Kill child plus grandchildren, great-grandchildren, etc.
             if self._taskfile is not None:
+                self._release_tasks(keep)
                 killed = set()
                 # Loop until all grandchildren are killed
                 while True:
@@ -114,14 +120,31 @@ class _SearchChild(object):
             # Delete temporary directory
             shutil.rmtree(self.tempdir, True)
 
+    def _release_tasks(self, pids):
+        '''Move the specified PIDs, if they are in our cgroup, to the
+        parent cgroup.'''
+        with open(self._taskfile) as fh:
+            pids = set(pids) & set(int(pid) for pid in fh)
+        parent = os.path.join(os.path.dirname(self._cgroupdir), 'tasks')
+        for pid in pids:
+            try:
+                with open(parent, 'w') as fh:
+                    fh.write('%d\n' % pid)
+            except IOError:
+                # Perhaps it has already died
+                pass
+
 
 class ChildManager(object):
     '''The set of forked search processes.'''
 
-    def __init__(self, cgroupdir=None, fork=True):
+    def __init__(self, cgroupdir=None, fork=True, keep=None):
         self._children = dict()
         self._cgroupdir = cgroupdir
         self._fork = fork
+        # Callable returning PIDs in search cgroups that must survive the
+        # search
+        self._keep = keep
         signal.signal(signal.SIGCHLD, self._child_exited)
 
     def start(self, child_function, *args, **kwargs):
@@ -146,21 +169,24 @@ class ChildManager(object):
         '''Clean up the specified search process.'''
         try:
             child = self._children.pop(pid)
-            child.cleanup()
+            child.cleanup(self._keep() if self._keep is not None else ())
         except KeyError:
             pass
 
     def _child_exited(self, _sig, _frame):
-        '''Signal handler for SIGCHLD.'''
-        while True:
+        '''Signal handler for SIGCHLD.  Only reaps search processes; the
+        supervisor's other children, such as cached filter processes, are
+        reaped by whoever started them.'''
+        for child in self._children.keys():
             try:
-                pid, status = os.waitpid(-1, os.WNOHANG)
+                pid, status = os.waitpid(child, os.WNOHANG)
             except OSError:
-                # No child processes
-                break
+                # Already reaped
+                self._cleanup_child(child)
+                continue
             if pid == 0:
-                # No exited processes
-                break
+                # Still running
+                continue
             if os.WIFSIGNALED(status):
                 _log.info('PID %d exited on %s',
                           pid, signalname(os.WTERMSIG(status)))
@@ -13,7 +13,8 @@
 '''Filter configuration and execution; result and attribute caching.
 
 There are two caches, both accessible via key lookups in the same
-Redis database.
+Redis database, or in the embedded database of opendiamond.server.cache
+when no Redis server is configured.
 
 Result cache:
     'result:' + murmur(
@@ -33,10 +34,40 @@ Result cache:
         'output_attrs': {attribute name => murmur(attribute value)},
         'omit_attrs': [attribute name],     # optional
         'score': filter score
-    })
+    }) or the same in the compact encoding below
+With CACHECONTENTKEYS set, filters other than the object fetcher use
+murmur(object data) in place of the object ID, as recorded by the fetcher's
+cached result or computed when the object is loaded.
+
+Object record, replacing the result cache keys when CACHERECORDS is set:
+    'object:' + murmur(object ID) => {filter digest => result cache entry}
+
+Score index, maintained when CACHESCOREINDEX is set:
+    'scores:' + murmur(
+        murmur(' '.join(sorted(filter digests of the stack))),
+        ' ',
+        filter digest
+    ) => sorted set of murmur(object ID) by filter score; with a result
+         TTL, each member is followed by ':' and the time it expires
 
 Attribute cache:
-    'attribute:' + murmur(attribute value) => attribute value
+    'attribute:' + murmur(attribute value) => attribute value, or
+        '\\0DZ\\1' + zlib(attribute value) if that is much smaller
+
+Attribute name table, for the compact encoding:
+    'names:' + filter digest => ['\\0' + generation, attribute name...]
+
+The compact encoding of a result cache entry is the byte 0x02, then
+varints (unsigned LEB128) and raw 16-byte murmur() hashes:
+    flags (0x1: integer score)
+    generation of the attribute name table
+    score as zigzag varint, or 8-byte big-endian double
+    input count, then per input: (name id << 1 | hash present), [hash]
+    output count, then per output: name id, hash
+    omit count, then per omitted attribute: name id
+Name ids index the filter's attribute name table, which only grows.  The
+generation is a random number chosen when the table is started, so that
+entries are not read against a table started after it was lost.
 
 murmur() is the output of MurmurHash3_x64_128 with a seed of 0xbb40e64d.
 murmur() and SHA256() both produce a lowercase hex string.
@@ -51,7 +82,16 @@ for that result is traversed to prove that its input attribute values were
 produced by filters present in, and identically configured in, the current
 search.  If so, the result cache drops the object.  Otherwise, we proceed to
 filter execution.  FilterResult objects produced by filter execution are
-always stored in the result cache.
+always stored in the result cache.  With object records, the traversal can
+instead run on the Redis server (cache.RESOLVE_SCRIPT), which then returns
+only the verdict.
+
+A repeat search of the same filter stack can skip the lookup entirely for
+objects whose indexed score for some filter is out of range.  The search
+reads the out-of-range members of each index once, by score range, up to
+CACHESCOREINDEXMB of them.  Scores are only indexed for results whose
+inputs came from the filter's declared dependencies, which then produce
+the same inputs in every search of the stack.
 
 The attribute cache is used to reduce the number of filters we need to run
 when executing a filter stack on an object.  When preparing to run a filter,
@@ -61,36 +101,62 @@ met.  If so, we look up the hashes of the cached output values in the
 attribute cache.  If they are present, we store those values in the object
 and skip execution of the filter.  Otherwise, we execute the filter.  To
 avoid storing cheaply recomputable values in the attribute cache, we only
-cache values resulting from filter executions that produce attribute data at
-less than 2 MB/s.
+cache values whose filter is estimated to take longer to recompute them than
+the attribute cache would take to return them (see cache.AdmissionPolicy).
 '''
 
+import binascii
+import collections
+from functools import partial
 import logging
+import math
 import os
+import Queue
 import signal
+import re
 import socket
+import struct
 import subprocess
+import sys
+from tempfile import mktemp
 import threading
 import time
 
-from redis import Redis
-from redis.exceptions import ResponseError
 import simplejson as json
 import yaml
 
+from opendiamond.framing import (
+    FrameCodec, PROTOCOL_ENV, PROTOCOL_VERSION, SHARED_MEMORY_ENV)
 from opendiamond.helpers import murmur, signalname, split_scheme
 from opendiamond.rpc import ConnectionFailure
-from opendiamond.server.object_ import ObjectLoader, ObjectLoadError
+from opendiamond.server import cache
+from opendiamond.server.object_ import (ATTR_DATA, ObjectLoader,
+                                        ObjectLoadError)
 from opendiamond.server.statistics import FilterStatistics, Timer
 
 ATTR_FILTER_SCORE = '_filter.%s_score'  # arg: filter name
-# If a filter produces attribute values at less than this rate
-# (total attribute value size / execution time), we will cache the attribute
-# values as well as the filter results.
-ATTRIBUTE_CACHE_THRESHOLD = 2 << 20  # bytes/sec
+# Leading byte of a result cache entry in the compact binary encoding.
+# JSON entries start with '{'.
+RESULT_FORMAT_COMPACT = '\x02'
+# Compact entry flag: the score is stored as a varint rather than a double
+RESULT_FLAG_INT_SCORE = 0x1
+# Bytes in a murmur() hash
+RESULT_HASH_SIZE = 16
+# Filters that have considered fewer objects than this are moved early in
+# the execution order so that we learn their cost and selectivity.
+REORDER_MIN_SAMPLES = 10
+# Seconds to wait for a forkable filter's template process, or a copy of
+# it, to connect
+FORK_TIMEOUT = 10
+# Name of the file in the blob cache directory recording that the filter
+# code with the specified signature has offered to fork copies of itself
+FORK_HINT = 'forkable-%s'
+# Minimum seconds between samples of a filter process's resource usage
+USAGE_INTERVAL = 1
 DEBUG = False
 
 _log = logging.getLogger(__name__)
+_HASH_RE = re.compile(r'\A[0-9a-f]{%d}\Z' % (RESULT_HASH_SIZE * 2))
 if DEBUG:
     _debug = _log.debug
 else:
@@ -119,6 +185,28 @@ class _DropObject(Exception):
     without caching the drop result.'''
 
 
+def _read_usage(pid):
+    '''Return (user CPU us, system CPU us, peak RSS KB) for the process
+    with the specified PID, or None if it cannot be read.  The peak RSS
+    is 0 once the process has exited.'''
+    try:
+        with open('/proc/%d/stat' % pid) as fh:
+            # The command name may contain spaces
+            fields = fh.read().rsplit(')', 1)[1].split()
+        peak = 0
+        with open('/proc/%d/status' % pid) as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    peak = int(line.split()[1])
+                    break
+    except (IOError, ValueError, IndexError):
+        return None
+    # utime and stime, fields 14 and 15 of stat(5), in clock ticks
+    scale = 1e6 / os.sysconf('SC_CLK_TCK')
+    return (int(int(fields[11]) * scale), int(int(fields[12]) * scale),
+            peak)
+
+
 class _FilterConnection(object):
     """A connection to a filter specified by fin and fout.
 
@@ -126,30 +214,63 @@ class _FilterConnection(object):
     fout -- A file-like that WE can write to.
     """
 
-    def __init__(self, fin, fout, name, args, blob):
+    # PID of the filter process, if local
+    pid = None
+    # Whether the conversation was broken off by abort()
+    aborted = False
+    # CPU time (user us, system us) the process had used when last
+    # sampled, and when it was sampled
+    _usage = (0, 0)
+    _usage_sampled = 0
+
+    def __init__(self, fin, fout, name, args, blob, handshake=True):
         try:
             self._name = name
             self._fin = fin
             self._fout = fout
+            # FrameCodec once the filter upgrades to protocol version 2
+            self._framing = None
+            # Input attributes to push with each object, and whether to
+            # push them as map-attribute replies
+            self.push_attrs = []
+            self.push_mapped = False
+            # Whether the filter accepts batches of objects
+            self.batch = False
+            # Whether the filter has reported init-success
+            self.initialized = False
 
             # Send:
             # - Protocol version (1)
             # - Filter name
             # - Array of filter arguments
             # - Blob argument
-            self.send(1, name, args, blob)
+            if handshake:
+                self.send(1, name, args, blob)
         except (OSError, IOError):
             raise FilterExecutionError('Unable to initialize filter %s' % self)
 
     def __str__(self):
         return self._name
 
+    @property
+    def protocol_version(self):
+        return 1 if self._framing is None else PROTOCOL_VERSION
+
+    def upgrade(self):
+        '''Switch to binary framing.  Called after acknowledging the
+        filter's set-protocol request.'''
+        self._framing = FrameCodec(self._fin, self._fout)
+
     def get_tag(self):
         '''Read and return a tag.'''
+        if self._framing is not None:
+            return self._framing.get_tag()
         return self._fin.readline().strip()
 
     def get_item(self):
         '''Read and return a string or blob.'''
+        if self._framing is not None:
+            return self._framing.get_item()
         sizebuf = self._fin.readline()
         if not sizebuf:
             # End of file
@@ -180,25 +301,40 @@ class _FilterConnection(object):
            None => serialized as a blank line
            scalar => serialized as str(value)
            tuple or list => serialized as an array terminated by a blank line
+        With binary framing, output is flushed by the next read rather
+        than immediately.
         '''
+        if self._framing is not None:
+            send_value = self._framing.put_item
+            send_blank = self._framing.put_none
+        else:
+            def send_value(value):
+                value = str(value)
+                self._fout.write('%d\n%s\n' % (len(value), value))
 
-        def send_value(value):
-            value = str(value)
-            self._fout.write('%d\n%s\n' % (len(value), value))
+            def send_blank():
+                self._fout.write('\n')
 
         for value in values:
             if isinstance(value, (list, tuple)):
                 for element in value:
                     send_value(element)
-                self._fout.write('\n')
+                send_blank()
             elif value is True:
                 send_value('true')
             elif value is False:
                 send_value('false')
             elif value is None:
-                self._fout.write('\n')
+                send_blank()
             else:
                 send_value(value)
+        if self._framing is None:
+            self._fout.flush()
+
+    def flush(self):
+        '''Flush output queued by send().'''
+        if self._framing is not None:
+            self._framing.flush()
         self._fout.flush()
 
     def send_dict(self, dct):
@@ -209,30 +345,70 @@ class _FilterConnection(object):
         self.send(keys)
         self.send(values)
 
+    def account_usage(self, stats, force=False):
+        """Charge the CPU time used by the filter process since the last
+        sample to the FilterStatistics, and record its peak RSS.  Unless
+        force is True, do nothing if the last sample is recent."""
+        if self.pid is None:
+            return
+        now = time.time()
+        if not force and now - self._usage_sampled < USAGE_INTERVAL:
+            return
+        self._usage_sampled = now
+        usage = _read_usage(self.pid)
+        if usage is None:
+            return
+        user, system, peak = usage
+        stats.update(cpu_user_us=max(0, user - self._usage[0]),
+                     cpu_system_us=max(0, system - self._usage[1]),
+                     peak_rss_kb=peak)
+        self._usage = (user, system)
+
+    def abort(self):
+        """Break off the conversation from another thread, so that the
+        thread talking to the filter fails promptly.  The connection can
+        no longer be used."""
+        self.aborted = True
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
 
 class _FilterProcess(_FilterConnection):
     """Connection to filter in form of executables."""
 
-    def __init__(self, code_argv, name, args, blob):
+    def __init__(self, code_argv, name, args, blob, protocol=1,
+                 shared_memory=False):
+        # Advertise the highest filter protocol version we will accept,
+        # and whether we can hand out attribute values in shared memory
+        env = dict(os.environ)
+        env[PROTOCOL_ENV] = str(protocol)
+        if shared_memory:
+            env[SHARED_MEMORY_ENV] = '1'
         try:
+            # Buffer the pipes; the protocol code flushes explicitly
             self._proc = subprocess.Popen(
                 code_argv + ['--filter'],
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                close_fds=True, cwd=os.getenv('TMPDIR'))
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=-1,
+                close_fds=True, cwd=os.getenv('TMPDIR'), env=env)
         except (OSError, IOError):
             raise FilterExecutionError(
                 'Unable to execute filter code %s: %s' % (name, code_argv))
 
+        self.pid = self._proc.pid
         super(_FilterProcess, self).__init__(
             fin=self._proc.stdout, fout=self._proc.stdin,
             name=name, args=args, blob=blob)
 
     def __del__(self):
-        # try a 'gentle' shutdown first
+        # try a 'gentle' shutdown first, unless the filter was aborted
         try:
             self._fout.close()
-            os.kill(self._proc.pid, signal.SIGTERM)
-            time.sleep(1)
+            if not self.aborted:
+                os.kill(self._proc.pid, signal.SIGTERM)
+                time.sleep(1)
         except (OSError, IOError):
             pass
 
@@ -246,6 +422,100 @@ class _FilterProcess(_FilterConnection):
             _log.info('Filter %s exited with status %d', self, ret)
 
 
+class _LeasedFilterProcess(_FilterConnection):
+    """Connection to an initialized filter process leased from the
+    supervisor's FilterProcessCache."""
+
+    def __init__(self, lease, name):
+        self._lease = lease
+        self.pid = lease.pid
+        # Only charge this search for CPU time used from now on
+        usage = _read_usage(lease.pid)
+        if usage is not None:
+            self._usage = usage[:2]
+        # Our own copies of the inherited pipes, so that closing them
+        # leaves the process usable by later searches
+        super(_LeasedFilterProcess, self).__init__(
+            fin=os.fdopen(os.dup(lease.fin), 'rb'),
+            fout=os.fdopen(os.dup(lease.fout), 'wb'),
+            name=name, args=None, blob=None, handshake=False)
+        if lease.state['protocol'] == PROTOCOL_VERSION:
+            self.upgrade()
+        self.push_attrs = lease.state['push_attrs']
+        self.push_mapped = lease.state['push_mapped']
+        self.batch = lease.state['batch']
+        self.initialized = True
+
+    def end_lease(self, reusable):
+        """Give the process back to the supervisor.  It is reusable only
+        if the filter is idle between objects."""
+        state = None
+        if reusable:
+            try:
+                self.flush()
+                state = {
+                    'protocol': self.protocol_version,
+                    'push_attrs': self.push_attrs,
+                    'push_mapped': self.push_mapped,
+                    'batch': self.batch,
+                }
+            except IOError:
+                pass
+        self._lease.end(state)
+        self._close()
+
+    def _close(self):
+        for fh in self._fin, self._fout:
+            try:
+                fh.close()
+            except IOError:
+                pass
+
+    def __del__(self):
+        # The process belongs to the supervisor; just drop our pipes
+        self._close()
+
+
+class _ForkedFilterProcess(_FilterConnection):
+    """Connection over a Unix socket to a copy of an initialized filter,
+    forked from its template process, or to the template itself."""
+
+    def __init__(self, sock, pid, name, model):
+        self._sock = sock
+        # Forked copies start with no CPU time of their own
+        self.pid = pid
+        super(_ForkedFilterProcess, self).__init__(
+            fin=sock.makefile('rb'), fout=sock.makefile('wb'),
+            name=name, args=None, blob=None, handshake=False)
+        # The copy starts out in the same state as the filter it was
+        # forked from
+        if model.protocol_version == PROTOCOL_VERSION:
+            self.upgrade()
+        self.push_attrs = model.push_attrs
+        self.push_mapped = model.push_mapped
+        self.batch = model.batch
+        self.initialized = True
+
+    def abort(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        super(_ForkedFilterProcess, self).abort()
+
+    def __del__(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+            self._sock.close()
+        except socket.error:
+            pass
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
 class _FilterTCP(_FilterConnection):
     """Connection to a filter in form of a TCP port"""
 
@@ -280,6 +550,13 @@ class _FilterTCP(_FilterConnection):
             blob=blob
         )
 
+    def abort(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        super(_FilterTCP, self).abort()
+
     def __del__(self):
         try:
             self._sock.shutdown(socket.SHUT_RDWR)
@@ -305,7 +582,13 @@ class _FilterResult(object):
         # Whether to cache output attributes in the attribute cache
         self.cache_output = False
 
-    def encode(self):
+    def encode(self, intern=None):
+        '''Return the result cache entry for this result.  If intern is
+        specified, it maps a list of attribute names to the generation of
+        the table interning them and a list of interned ids, and the entry
+        uses the compact binary encoding; otherwise it is JSON.'''
+        if intern is not None and self._compactable():
+            return self._encode_compact(intern)
         props = {
             'input_attrs': self.input_attrs,
             'output_attrs': self.output_attrs,
@@ -315,12 +598,62 @@ class _FilterResult(object):
             props['omit_attrs'] = list(self.omit_attrs)
         return json.dumps(props)
 
+    def _compactable(self):
+        '''Return True if every attribute signature is a murmur() hash,
+        which the compact encoding stores as raw bytes.'''
+        sigs = self.output_attrs.values() + [
+            sig for sig in self.input_attrs.itervalues() if sig is not None]
+        return all(_HASH_RE.match(sig) for sig in sigs)
+
+    def _encode_compact(self, intern):
+        input_names = sorted(self.input_attrs)
+        output_names = sorted(self.output_attrs)
+        omit_names = sorted(self.omit_attrs)
+        generation, ids = intern(input_names + output_names + omit_names)
+        ids = iter(ids)
+        score = self.score
+        flags = 0
+        if abs(score) < 1 << 62 and score == int(score):
+            flags |= RESULT_FLAG_INT_SCORE
+        out = [RESULT_FORMAT_COMPACT, _varint(flags), _varint(generation)]
+        if flags & RESULT_FLAG_INT_SCORE:
+            score = int(score)
+            out.append(_varint(score << 1 if score >= 0 else
+                               (-score << 1) - 1))
+        else:
+            out.append(struct.pack('!d', score))
+        out.append(_varint(len(input_names)))
+        for name in input_names:
+            sig = self.input_attrs[name]
+            out.append(_varint(ids.next() << 1 | int(sig is not None)))
+            if sig is not None:
+                out.append(binascii.unhexlify(sig))
+        out.append(_varint(len(output_names)))
+        for name in output_names:
+            out.append(_varint(ids.next()))
+            out.append(binascii.unhexlify(self.output_attrs[name]))
+        out.append(_varint(len(omit_names)))
+        out.extend(_varint(ids.next()) for name in omit_names)
+        return ''.join(out)
+
     # pylint thinks json.loads() returns bool?
     # pylint: disable=maybe-no-member
     @classmethod
-    def decode(cls, data):
+    def decode(cls, data, lookup=None):
+        '''Return the _FilterResult stored in a result cache entry, or None
+        if there is none or it cannot be read.  lookup maps the generation
+        of a name table and a list of interned ids to a list of attribute
+        names, with None for unknown ids; it is needed to read compact
+        entries.'''
         if data is None:
             return None
+        if data.startswith(RESULT_FORMAT_COMPACT):
+            if lookup is None:
+                return None
+            try:
+                return cls._decode_compact(data, lookup)
+            except (IndexError, KeyError, struct.error):
+                return None
         dct = json.loads(data)
         try:
             return cls(dct['input_attrs'], dct['output_attrs'],
@@ -329,6 +662,85 @@ class _FilterResult(object):
             return None
             # pylint: enable=maybe-no-member
 
+    @classmethod
+    def _decode_compact(cls, data, lookup):
+        flags, pos = _read_varint(data, len(RESULT_FORMAT_COMPACT))
+        generation, pos = _read_varint(data, pos)
+        if flags & RESULT_FLAG_INT_SCORE:
+            score, pos = _read_varint(data, pos)
+            score = float(score >> 1 if not score & 1 else
+                          -((score + 1) >> 1))
+        else:
+            score, = struct.unpack_from('!d', data, pos)
+            pos += 8
+        # Name ids and hashes of inputs, then outputs, then omits
+        ids = []
+        sigs = []
+        count, pos = _read_varint(data, pos)
+        for _ in xrange(count):
+            value, pos = _read_varint(data, pos)
+            ids.append(value >> 1)
+            if value & 1:
+                sigs.append(data[pos:pos + RESULT_HASH_SIZE])
+                pos += RESULT_HASH_SIZE
+            else:
+                sigs.append(None)
+        inputs = count
+        count, pos = _read_varint(data, pos)
+        for _ in xrange(count):
+            value, pos = _read_varint(data, pos)
+            ids.append(value)
+            sigs.append(data[pos:pos + RESULT_HASH_SIZE])
+            pos += RESULT_HASH_SIZE
+        outputs = inputs + count
+        count, pos = _read_varint(data, pos)
+        for _ in xrange(count):
+            value, pos = _read_varint(data, pos)
+            ids.append(value)
+        if pos != len(data):
+            raise IndexError('Malformed result cache entry')
+        names = lookup(generation, ids)
+        if None in names:
+            # Interned by a writer whose update we haven't seen, or in a
+            # name table that has since been lost
+            return None
+        sigs = [sig and binascii.hexlify(sig) for sig in sigs]
+        return cls(dict(zip(names[:inputs], sigs[:inputs])),
+                   dict(zip(names[inputs:outputs], sigs[inputs:outputs])),
+                   names[outputs:], score)
+
+
+def _varint(value):
+    '''Return the unsigned LEB128 encoding of a non-negative integer.'''
+    out = []
+    while value > 0x7f:
+        out.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+
+def _read_varint(data, pos):
+    '''Return the integer encoded by _varint() at data[pos:] and the
+    position following it.'''
+    byte = ord(data[pos])
+    if byte < 0x80:
+        return byte, pos + 1
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _fork_hint(state, filter):
+    '''Return the path of the file recording that the filter's code has
+    offered to fork copies of itself.'''
+    return os.path.join(state.config.cachedir, FORK_HINT % filter.signature)
+
 
 class _ObjectProcessor(object):
     '''A context for processing objects.'''
@@ -336,6 +748,8 @@ class _ObjectProcessor(object):
     # Whether to report the filter score back to the client (True for
     # filters requested by the client, False for other filters)
     send_score = False
+    # Names of the filters whose outputs this one declares it reads
+    dependencies = ()
 
     def __str__(self):
         '''Return a human-readable name for the underlying filter.'''
@@ -346,6 +760,11 @@ class _ObjectProcessor(object):
         on this object.'''
         return 'result:' + murmur(self._get_cache_digest() + ' ' + str(obj))
 
+    @property
+    def cache_digest(self):
+        '''The object-independent part of the result cache key.'''
+        return self._get_cache_digest()
+
     def _get_cache_digest(self):
         '''Return a short string representing object-independent information
         about the filter (e.g. its arguments).'''
@@ -360,11 +779,34 @@ class _ObjectProcessor(object):
         '''Execute the filter on this object, returning a _FilterResult.'''
         raise NotImplementedError()
 
+    def evaluate_batch(self, objs, cancellation=None):
+        '''Execute the filter on a list of objects, returning a list with
+        a _FilterResult for each object, or None for each object that
+        should be dropped without caching the result.  Once the
+        _Cancellation, if any, is cancelled, the remaining objects are
+        not evaluated.'''
+        results = []
+        for obj in objs:
+            if cancellation is not None and cancellation.cancelled:
+                results.append(None)
+                continue
+            try:
+                results.append(self.evaluate(obj))
+            except _DropObject:
+                results.append(None)
+        return results
+
     def threshold(self, result):
         '''Apply the drop threshold to the _FilterResult and return True
         to accept the object or False to drop it.'''
         raise NotImplementedError()
 
+    @property
+    def score_bounds(self):
+        '''The (minimum, maximum) score accepted by threshold(), with None
+        for no bound, or None if threshold() is not a score range.'''
+        return None
+
 
 class _ObjectFetcher(_ObjectProcessor):
     '''A context for loading object data from the dataretriever.'''
@@ -395,18 +837,213 @@ class _ObjectFetcher(_ObjectProcessor):
     def threshold(self, result):
         return True
 
+    @property
+    def score_bounds(self):
+        return (None, None)
+
+
+class _FilterPool(object):
+    '''A pool of connections to a filter, shared by the worker threads.
+    Connections are started on demand, up to a limit that may change over
+    the course of the search.'''
+
+    def __init__(self, filter, limit, cache=None):
+        self._filter = filter
+        # Callable returning the current maximum number of connections
+        self._limit = limit
+        # FilterProcessCache to lease filter processes from, if any
+        self._cache = cache
+        # Socket and connection for the filter's template process, if the
+        # filter can fork initialized copies of itself
+        self._template_sock = None
+        self._template = None
+        self._fork_lock = threading.Lock()
+        # Whether a template process is expected shortly, so new
+        # connections should wait to be forked from it
+        self._template_expected = False
+        self._cond = threading.Condition()
+        self._idle = []
+        # Number of live connections, idle or leased
+        self._count = 0
+        # Whether the filter accepts batches of objects
+        self.batch = False
+
+    def acquire(self):
+        '''Return an idle connection, starting one if the pool is below
+        its limit, or otherwise waiting for one to be released.'''
+        with self._cond:
+            while not self._idle and (self._template_expected or
+                                      self._count >= self._limit()):
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._count += 1
+            count = self._count
+        return self._connect(count)
+
+    def start(self):
+        '''Start a connection outside of any lease, for prewarming.
+        Return None if the pool is already at its limit.'''
+        with self._cond:
+            if self._count >= self._limit():
+                return None
+            self._count += 1
+            count = self._count
+        return self._connect(count, cold=False)
+
+    def _connect(self, count, cold=True):
+        '''Start a connection, which will bring the pool to count
+        connections.'''
+        try:
+            timer = Timer()
+            # debug = self._state.config.debug_filters
+            # if self._filter.name in debug or self._filter.signature in debug:
+            #     argv = (self._state.config.debug_command +
+            #             [self._filter.code_path])
+            # else:
+            #     argv = [self._filter.code_path]
+            # proc = _FilterProcess(argv, self._filter.name,
+            #                       self._filter.arguments,
+            #                       self._filter.blob)
+            cache = self._cache if self._filter.mode == 'default' else None
+            lease = cache.lease(self._filter.cache_digest) if cache else None
+            if lease is not None:
+                proc = _LeasedFilterProcess(lease, self._filter.name)
+                self._filter.stats.update('procs_reused', procs_max=count)
+                return proc
+            proc = self._fork()
+            if proc is not None:
+                self._filter.stats.update('procs_forked', procs_max=count)
+                return proc
+            proc = self._filter.connect()
+            self._filter.stats.update('procs_started', procs_max=count)
+            if cache is not None:
+                # Have one ready for the next search
+                cache.request(self._filter, count)
+            if cold:
+                self._filter.stats.update(startup_us_avg=timer.elapsed,
+                                          startup_us_min=timer.elapsed,
+                                          startup_us_max=timer.elapsed)
+            return proc
+        except Exception:
+            self.discard(None)
+            raise
+
+    def expect_template(self, expected=True):
+        '''Note whether the filter is expected to offer a template process
+        shortly.'''
+        with self._cond:
+            self._template_expected = expected
+            self._cond.notify_all()
+
+    def listen(self):
+        '''Return the path of a socket for the filter's template process
+        to connect to, or None if the pool already has one.'''
+        with self._cond:
+            if self._template_sock is not None:
+                return None
+            path = mktemp(prefix='fork-', dir=os.environ.get('TMPDIR'))
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            sock.listen(5)
+            sock.settimeout(FORK_TIMEOUT)
+            self._template_sock = sock
+            return path
+
+    def _accept(self):
+        '''Accept a connection from the template process or a copy.'''
+        sock, _addr = self._template_sock.accept()
+        sock.setblocking(1)
+        return sock
+
+    def accept_template(self, proc):
+        '''Accept the connection from the template process forked by
+        proc, after the pool has started listening for it.  Return True
+        on success.'''
+        try:
+            sock = self._accept()
+        except socket.error, e:
+            _log.warning('%s: template process did not connect: %s',
+                         self._filter.name, e)
+            return False
+        with self._fork_lock:
+            # The template exits when its connection closes
+            self._template = _ForkedFilterProcess(sock, None,
+                                                  self._filter.name, proc)
+        return True
+
+    def _fork(self):
+        '''Return a connection to a new copy of the filter, forked from
+        its template process, or None if there is none.'''
+        with self._fork_lock:
+            template = self._template
+            if template is None:
+                return None
+            try:
+                template.send('fork')
+                if template.get_tag() != 'forked':
+                    raise IOError('unexpected reply from template process')
+                pid = template.get_item()
+                if pid is None:
+                    raise IOError('template process could not fork')
+                sock = self._accept()
+            except (IOError, socket.error), e:
+                _log.warning('%s: not forking further copies: %s',
+                             self._filter.name, e)
+                self._template = None
+                return None
+            return _ForkedFilterProcess(sock, int(pid), self._filter.name,
+                                        template)
+
+    def release(self, proc):
+        '''Return a leased connection to the pool.  If the pool has shrunk
+        below its size, the connection is closed instead.'''
+        proc.account_usage(self._filter.stats)
+        with self._cond:
+            if self._count > self._limit():
+                self._count -= 1
+                proc.account_usage(self._filter.stats, True)
+                if isinstance(proc, _LeasedFilterProcess):
+                    proc.end_lease(True)
+            else:
+                self._idle.append(proc)
+            self._cond.notify()
+
+    def discard(self, proc):
+        '''Forget a leased connection that can no longer be used.'''
+        if proc is not None:
+            proc.account_usage(self._filter.stats, True)
+        with self._cond:
+            self._count -= 1
+            if isinstance(proc, _LeasedFilterProcess):
+                proc.end_lease(False)
+            self._cond.notify()
+
+    def close(self):
+        '''Close idle connections, returning processes leased from the
+        FilterProcessCache.  Called when the search ends.'''
+        with self._cond:
+            for proc in self._idle:
+                proc.account_usage(self._filter.stats, True)
+                if isinstance(proc, _LeasedFilterProcess):
+                    proc.end_lease(True)
+            self._count -= len(self._idle)
+            self._idle = []
+
 
 class _FilterRunner(_ObjectProcessor):
     '''A context for processing objects with a Filter.'''
 
     send_score = True
 
-    def __init__(self, state, filter):
+    def __init__(self, state, filter, pool=None):
         _ObjectProcessor.__init__(self)
         self._filter = filter
         self._state = state
-        self._proc = None
-        self._proc_initialized = False
+        if pool is None:
+            # A private pool, as for a single worker thread
+            pool = _FilterPool(filter, lambda: 1)
+        self._pool = pool
 
     def __str__(self):
         return self._filter.name
@@ -421,28 +1058,197 @@ class _FilterRunner(_ObjectProcessor):
                                   objs_cache_dropped=int(not accept),
                                   objs_cache_passed=int(accept))
 
+    def _input_value(self, obj, key, mapped, result):
+        '''Return the value to send to the filter for the specified input
+        attribute, and record the attribute's signature in the result.  If
+        mapped is True, return a map-attribute reply: an empty array if the
+        attribute is missing, [value] to send it inline, or
+        [path, offset, length] of a shared copy.'''
+        if key in obj:
+            result.input_attrs[key] = obj.get_signature(key)
+            if mapped:
+                return obj.get_shared(key) or [obj[key]]
+            return obj[key]
+        else:
+            # Record the failure in the result cache.  Otherwise,
+            # subsequent searches may reuse the cached result
+            # (probably a drop) even if the attribute becomes
+            # available.
+            result.input_attrs[key] = None
+            return [] if mapped else None
+
+    def _begin(self, proc, objs, results):
+        '''Start evaluation of objs on an initialized filter: for filters
+        accepting batches, send the number of objects, then push declared
+        input attributes for each object, all in one write.'''
+        values = [len(objs)] if proc.batch else []
+        if proc.push_attrs:
+            for obj, result in zip(objs, results):
+                values.extend(self._input_value(obj, key, proc.push_mapped,
+                                                result)
+                              for key in proc.push_attrs)
+        if values:
+            proc.send(*values)
+
+    def prewarm(self):
+        '''Start a filter process, wait for it to finish initializing, and
+        leave it idle in the pool.  Called in a background thread before
+        the search starts.'''
+        timer = Timer()
+        try:
+            proc = self._pool.start()
+        except FilterExecutionError, e:
+            _log.warning('Could not prewarm %s: %s', self, e)
+            return
+        if proc is None:
+            return
+        try:
+            while not proc.initialized:
+                cmd = proc.get_tag()
+                if cmd == 'init-success':
+                    proc.initialized = True
+                elif cmd == '':
+                    # Encountered EOF on pipe
+                    raise IOError()
+                elif not self._control(proc, cmd):
+                    raise FilterExecutionError('%s: unknown command' % self)
+        # We want to catch all exceptions
+        # pylint: disable=broad-except
+        except Exception, e:
+            # Leave it to the search to start the filter and report the
+            # failure
+            _log.warning('Could not prewarm %s: %s', self, e)
+            self._pool.discard(proc)
+            # pylint: enable=broad-except
+        else:
+            self._filter.stats.update('procs_prewarmed',
+                                      prewarm_us_avg=timer.elapsed,
+                                      prewarm_us_min=timer.elapsed,
+                                      prewarm_us_max=timer.elapsed)
+            self._pool.release(proc)
+
     def evaluate(self, obj):
-        if self._proc is None:
-            timer = Timer()
-            # debug = self._state.config.debug_filters
-            # if self._filter.name in debug or self._filter.signature in debug:
-            #     argv = (self._state.config.debug_command +
-            #             [self._filter.code_path])
-            # else:
-            #     argv = [self._filter.code_path]
-            # self._proc = _FilterProcess(argv, self._filter.name,
-            #                             self._filter.arguments,
-            #                             self._filter.blob)
-            self._proc = self._filter.connect()
-            self._proc_initialized = False
-            self._filter.stats.update(startup_us_avg=timer.elapsed,
-                                      startup_us_min=timer.elapsed,
-                                      startup_us_max=timer.elapsed)
+        return self._execute([obj])[0]
+
+    def evaluate_batch(self, objs, cancellation=None):
+        if self._pool.batch and len(objs) > 1:
+            try:
+                return self._execute(objs, cancellation)
+            except _DropObject:
+                return [None] * len(objs)
+        results = []
+        for obj in objs:
+            try:
+                results.append(self._execute([obj], cancellation)[0])
+            except _DropObject:
+                results.append(None)
+        return results
+
+    def _control(self, proc, cmd):
+        '''Handle a command from the filter that does not refer to the
+        current object.  Return False if the command is not one of
+        these.'''
+        if cmd == 'set-protocol':
+            # The filter wants to upgrade the wire protocol.  The
+            # reply is sent in the old framing.
+            version = int(proc.get_item())
+            if (version == PROTOCOL_VERSION and version <=
+                    self._state.config.filter_protocol):
+                proc.send(True)
+                proc.upgrade()
+            else:
+                proc.send(False)
+        elif cmd == 'declare-attributes':
+            # The filter wants these input attributes pushed to it
+            # at the start of every object, either inline ('get')
+            # or as map-attribute replies ('map').
+            mode = proc.get_item()
+            proc.push_attrs = proc.get_array()
+            proc.push_mapped = mode == 'map'
+        elif cmd == 'declare-batch':
+            # The filter accepts several objects at a time.  Each
+            # evaluation will begin with the number of objects.
+            proc.batch = self._pool.batch = True
+        elif cmd == 'declare-fork':
+            # The filter can fork initialized copies of itself.  Give its
+            # template process a socket to connect to, unless we already
+            # have a template.
+            path = None
+            if self._state.config.filter_fork:
+                path = self._pool.listen()
+            proc.send(path)
+            proc.flush()
+            if path is not None and self._pool.accept_template(proc):
+                try:
+                    open(_fork_hint(self._state, self._filter), 'w').close()
+                except IOError:
+                    pass
+        elif cmd == 'get-session-variables':
+            keys = proc.get_array()
+            valuemap = self._state.session_vars.filter_get(keys)
+            values = [valuemap[key] for key in keys]
+            proc.send(values)
+        elif cmd == 'update-session-variables':
+            keys = proc.get_array()
+            values = proc.get_array()
+            try:
+                values = [float(f) for f in values]
+            except ValueError:
+                raise FilterExecutionError(
+                    '%s: bad session variable value' % self)
+            if len(keys) != len(values):
+                raise FilterExecutionError(
+                    '%s: bad array lengths' % self)
+            valuemap = dict(zip(keys, values))
+            self._state.session_vars.filter_update(valuemap)
+        elif cmd == 'log':
+            level = int(proc.get_item())
+            message = proc.get_item()
+            if level & 0x01:
+                # LOGL_CRIT
+                level = logging.CRITICAL
+            elif level & 0x02:
+                # LOGL_ERR
+                level = logging.ERROR
+            elif level & 0x04:
+                # LOGL_INFO
+                level = logging.INFO
+            elif level & 0x08:
+                # LOGL_TRACE.  Very verbose; ignore.
+                return True
+            elif level & 0x10:
+                # LOGL_DEBUG
+                level = logging.DEBUG
+            else:
+                level = logging.DEBUG
+            _log.log(level, message)
+        elif cmd == 'stdout':
+            print proc.get_item(),
+        else:
+            return False
+        return True
+
+    def _execute(self, objs, cancellation=None):
+        '''Run the filter on one object, or on several objects if the
+        filter accepts batches, and return a list of _FilterResult.  Raise
+        _DropObject if the filter dies, or if the _Cancellation, if any,
+        is cancelled.'''
+        proc = self._pool.acquire()
+        if cancellation is not None and not cancellation.attach(proc):
+            # Abandoned while we waited for the connection
+            self._pool.release(proc)
+            raise _DropObject()
         timer = Timer()
-        result = _FilterResult()
-        proc = self._proc
+        results = [_FilterResult() for _obj in objs]
+        # Index of the object the filter is currently addressing
+        current = 0
         try:
+            if proc.initialized:
+                # Otherwise we begin after init-success
+                self._begin(proc, objs, results)
             while True:
+                obj = objs[current]
+                result = results[current]
                 # XXX Work here to change the filter protocol (server side):
                 # https://github.com/cmusatyalab/opendiamond/wiki/FilterProtocol
                 cmd = proc.get_tag()
@@ -450,19 +1256,21 @@ class _FilterRunner(_ObjectProcessor):
                     # The filter initialized successfully.  This may not
                     # be the first command produced by the filter, since
                     # its init function may e.g. produce log messages.
-                    self._proc_initialized = True
+                    proc.initialized = True
+                    self._begin(proc, objs, results)
+                elif cmd == 'select-object':
+                    # Subsequent object commands refer to this index
+                    # within the batch.
+                    current = int(proc.get_item())
+                    if not 0 <= current < len(objs):
+                        raise FilterExecutionError(
+                            '%s: bad object index' % self)
                 elif cmd == 'get-attribute':
                     key = proc.get_item()
-                    if key in obj:
-                        proc.send(obj[key])
-                        result.input_attrs[key] = obj.get_signature(key)
-                    else:
-                        proc.send(None)
-                        # Record the failure in the result cache.  Otherwise,
-                        # subsequent searches may reuse the cached result
-                        # (probably a drop) even if the attribute becomes
-                        # available.
-                        result.input_attrs[key] = None
+                    proc.send(self._input_value(obj, key, False, result))
+                elif cmd == 'map-attribute':
+                    key = proc.get_item()
+                    proc.send(self._input_value(obj, key, True, result))
                 elif cmd == 'set-attribute':
                     key = proc.get_item()
                     value = proc.get_item()
@@ -476,50 +1284,17 @@ class _FilterRunner(_ObjectProcessor):
                         proc.send(True)
                     except KeyError:
                         proc.send(False)
-                elif cmd == 'get-session-variables':
-                    keys = proc.get_array()
-                    valuemap = self._state.session_vars.filter_get(keys)
-                    values = [valuemap[key] for key in keys]
-                    proc.send(values)
-                elif cmd == 'update-session-variables':
-                    keys = proc.get_array()
-                    values = proc.get_array()
-                    try:
-                        values = [float(f) for f in values]
-                    except ValueError:
-                        raise FilterExecutionError(
-                            '%s: bad session variable value' % self)
-                    if len(keys) != len(values):
-                        raise FilterExecutionError(
-                            '%s: bad array lengths' % self)
-                    valuemap = dict(zip(keys, values))
-                    self._state.session_vars.filter_update(valuemap)
-                elif cmd == 'log':
-                    level = int(proc.get_item())
-                    message = proc.get_item()
-                    if level & 0x01:
-                        # LOGL_CRIT
-                        level = logging.CRITICAL
-                    elif level & 0x02:
-                        # LOGL_ERR
-                        level = logging.ERROR
-                    elif level & 0x04:
-                        # LOGL_INFO
-                        level = logging.INFO
-                    elif level & 0x08:
-                        # LOGL_TRACE.  Very verbose; ignore.
-                        continue
-                    elif level & 0x10:
-                        # LOGL_DEBUG
-                        level = logging.DEBUG
-                    else:
-                        level = logging.DEBUG
-                    _log.log(level, message)
-                elif cmd == 'stdout':
-                    print proc.get_item(),
                 elif cmd == 'result':
                     result.score = float(proc.get_item())
                     break
+                elif cmd == 'batch-result':
+                    scores = proc.get_array()
+                    if len(scores) != len(objs):
+                        raise FilterExecutionError(
+                            '%s: bad array lengths' % self)
+                    for cur, score in zip(results, scores):
+                        cur.score = float(score)
+                    break
                 elif cmd == 'ensure-resource':
                     # Create scoped resource here
                     scope = proc.get_item()
@@ -536,35 +1311,74 @@ class _FilterRunner(_ObjectProcessor):
                 elif cmd == '':
                     # Encountered EOF on pipe
                     raise IOError()
-                else:
+                elif not self._control(proc, cmd):
                     raise FilterExecutionError('%s: unknown command' % self)
         except IOError:
-            if self._proc_initialized:
-                # Filter died on an object.  Drop the object without caching
-                # the result.
+            self._pool.discard(proc)
+            if proc.aborted:
+                # Nobody wants the results
+                raise _DropObject()
+            if proc.initialized:
+                # Filter died on an object.  Drop the object (and the rest
+                # of its batch) without caching the result.
                 _log.error('Filter %s (signature %s) died on object %s',
-                           self, self._filter.signature, obj)
+                           self, self._filter.signature, objs[current])
                 self._filter.stats.update('objs_terminate')
-                self._proc = None
                 raise _DropObject()
             else:
                 # Filter died during initialization.  Treat this as fatal.
                 raise FilterExecutionError("Filter %s failed to initialize"
                                            % self)
+        except Exception:
+            # The conversation is in an unknown state
+            self._pool.discard(proc)
+            if proc.aborted:
+                raise _DropObject()
+            raise
+        else:
+            if cancellation is not None:
+                cancellation.detach(proc)
+            if proc.aborted:
+                # Aborted just as the filter finished
+                self._pool.discard(proc)
+            else:
+                self._pool.release(proc)
         finally:
-            accept = self.threshold(result)
-            self._filter.stats.update('objs_processed', 'objs_computed',
-                                      objs_dropped=int(not accept),
-                                      execution_us=timer.elapsed)
-            lengths = [len(obj[k]) for k in result.output_attrs]
-            throughput = int(sum(lengths) / timer.elapsed_seconds)
-            if throughput < ATTRIBUTE_CACHE_THRESHOLD:
-                result.cache_output = True
-        return result
+            if cancellation is not None:
+                cancellation.detach(proc)
+            # Charge each object of a batch an equal share of the time,
+            # unless the evaluation was abandoned
+            elapsed_seconds = timer.elapsed_seconds / len(objs)
+            accounted = [] if proc.aborted else zip(objs, results)
+            for obj, result in accounted:
+                accept = self.threshold(result)
+                self._filter.stats.update(
+                    'objs_processed', 'objs_computed',
+                    objs_dropped=int(not accept),
+                    execution_us=int(elapsed_seconds * 1e6))
+                admission = self._state.admission
+                if admission is not None:
+                    nbytes = sum(len(obj[k]) for k in result.output_attrs)
+                    result.cache_output = admission.admit(
+                        self._filter.cache_digest, elapsed_seconds, nbytes,
+                        result.output_attrs.values())
+                    if result.output_attrs:
+                        self._filter.stats.update(
+                            attrs_cache_admitted=int(result.cache_output),
+                            attrs_cache_rejected=int(not result.cache_output))
+        return results
 
     def threshold(self, result):
         return self._filter.min_score <= result.score <= self._filter.max_score
 
+    @property
+    def score_bounds(self):
+        return (self._filter.min_score, self._filter.max_score)
+
+    @property
+    def dependencies(self):
+        return self._filter.dependencies
+
 
 class Filter(object):
     '''A filter with arguments.'''
@@ -584,6 +1398,7 @@ class Filter(object):
         self.code_path = None
         self.signature = None
         self.blob = None
+        self.blob_signature = None
         self.cache_digest = None
         self.mode = None
 
@@ -609,6 +1424,7 @@ class Filter(object):
         self.code_path = code_path
         self.signature = code_signature
         self.blob = blob
+        self.blob_signature = blob_signature
         self.cache_digest = cache_digest
 
         # Resolve mode and reload connect()
@@ -667,7 +1483,9 @@ class Filter(object):
                     code_argv=[self.code_path],
                     name=self.name,
                     args=self.arguments,
-                    blob=self.blob
+                    blob=self.blob,
+                    protocol=state.config.filter_protocol,
+                    shared_memory=bool(state.config.shm_threshold)
                 )
         elif self.mode == 'docker':
             # Docker service accessed via TCP
@@ -712,38 +1530,575 @@ class Filter(object):
         else:
             raise FilterUnsupportedSource()
 
-    def bind(self, state):
-        '''Return a _FilterRunner for this filter.'''
+    def bind(self, state, pool=None):
+        '''Return a _FilterRunner for this filter.  If pool is specified,
+        the runner takes filter connections from this _FilterPool.'''
         # resolve() must be called first
         assert self.code_path is not None
-        return _FilterRunner(state, self)
+        return _FilterRunner(state, self, pool)
+
+
+class _Cancellation(object):
+    '''Shared by the overlays and filter connections of a concurrent
+    evaluation of objs.  Serializes access to the objects' shared memory.
+    Once cancelled, connections still in use are aborted, and the shared
+    memory is held until the last evaluation still running finishes.'''
+
+    def __init__(self, objs=()):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self._objs = objs
+        # Connections in use by the evaluations
+        self._procs = set()
+        # Number of evaluations running
+        self._running = 0
+
+    def attach(self, proc):
+        '''Note that an evaluation is using the connection.  Return False
+        if the evaluation has been cancelled, so the connection should
+        not be used.'''
+        with self.lock:
+            if self.cancelled:
+                return False
+            self._procs.add(proc)
+            return True
+
+    def detach(self, proc):
+        '''Note that an evaluation is done with the connection.  If
+        proc.aborted is not set by now, it will not be.'''
+        with self.lock:
+            self._procs.discard(proc)
+
+    def started(self):
+        '''Note that an evaluation has started.'''
+        with self.lock:
+            self._running += 1
+
+    def finished(self):
+        '''Note that an evaluation has finished.'''
+        with self.lock:
+            self._running -= 1
+            release = self.cancelled and not self._running
+        if release:
+            for obj in self._objs:
+                obj.release()
+
+    def cancel(self):
+        '''Abandon the evaluations still running.'''
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            procs = list(self._procs)
+            self._procs.clear()
+            if self._running:
+                # Released by finished()
+                for obj in self._objs:
+                    obj.hold()
+            # Under the lock, so that detach() and abort() are ordered
+            for proc in procs:
+                proc.abort()
+
+
+class _EvaluationThreads(object):
+    '''Long-lived threads running a worker's concurrent filter
+    evaluations.  A thread is added whenever all of the existing ones are
+    busy, e.g. winding down abandoned evaluations.'''
+
+    def __init__(self, name):
+        self._name = name
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._count = 0
+        self._idle = 0
+
+    def run(self, func):
+        '''Call func() in one of the threads.'''
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+            else:
+                self._count += 1
+                thread = threading.Thread(target=self._run, name='%s-%d' %
+                                          (self._name, self._count))
+                thread.setDaemon(True)
+                thread.start()
+        self._queue.put(func)
+
+    def _run(self):
+        while True:
+            func = self._queue.get()
+            if func is None:
+                break
+            func()
+            with self._lock:
+                self._idle += 1
+
+    def close(self):
+        '''Stop the threads once they are done with their work.'''
+        with self._lock:
+            for _i in xrange(self._count):
+                self._queue.put(None)
+            self._count = self._idle = 0
+
+
+class _ObjectOverlay(object):
+    '''A view of an object for one of several filters running on it
+    concurrently.  Attributes written or omitted by the filter are kept
+    aside until merge(), so that concurrent filters never see each
+    other's output and the merged result does not depend on which filter
+    finished first.'''
+
+    def __init__(self, obj, cancellation):
+        self._obj = obj
+        self._cancellation = cancellation
+        self._attrs = dict()
+        self._signatures = dict()
+        self._omit_attrs = set()
+
+    def __str__(self):
+        return str(self._obj)
+
+    def __repr__(self):
+        return '<_ObjectOverlay %s>' % self._obj
+
+    def __contains__(self, key):
+        return key in self._attrs or key in self._obj
+
+    def __getitem__(self, key):
+        if key in self._attrs:
+            return self._attrs[key]
+        return self._obj[key]
+
+    def __setitem__(self, key, value):
+        self._attrs[key] = value
+        self._signatures[key] = murmur(value)
+
+    def get_signature(self, key):
+        if key in self._signatures:
+            return self._signatures[key]
+        return self._obj.get_signature(key)
+
+    def omit(self, key):
+        if key not in self:
+            raise KeyError()
+        self._omit_attrs.add(key)
+
+    def get_shared(self, key):
+        if key in self._attrs:
+            # Our own output is sent inline
+            return None
+        with self._cancellation.lock:
+            if self._cancellation.cancelled:
+                return None
+            return self._obj.get_shared(key)
+
+    def merge(self, position, writers):
+        '''Copy our attributes into the object, except those already
+        written by a filter at a later position in the declared order.
+        writers maps attribute names to the position of their writer and
+        is updated accordingly.'''
+        for key, value in self._attrs.iteritems():
+            if writers.get(key, -1) <= position:
+                self._obj[key] = value
+                writers[key] = position
+        for key in self._omit_attrs:
+            self._obj.omit(key)
+
+
+class _ResolutionPlan(object):
+    '''The per-search structures used to derive result cache keys for a
+    filter stack and to decide whether cached results prove that an object
+    can be dropped, so that the work per object is limited to what depends
+    on the object itself.'''
+
+    def __init__(self, runners, content_keys=False):
+        self._runners = tuple(runners)
+        # Whether results other than the object fetcher's are keyed on the
+        # object data rather than the object ID
+        self._content_keys = content_keys
+        # Position of each runner in the stack's declared order, which
+        # lists every filter after those it depends on
+        self._positions = dict((r, i) for i, r in enumerate(runners))
+        # [(runner, cache digest + ' ')] and [(runner, record field)] for
+        # results keyed on the object ID, and the same for those keyed on
+        # content, computed on first use since filter digests are only
+        # known once the filters are resolved
+        self._key_prefixes = None
+        self._record_fields = None
+        self._content_prefixes = []
+        self._content_fields = []
+        # Per runner: the name of its score index, and the runners its
+        # inputs may come from for a result to be indexed; None if its
+        # results are not indexed
+        self._score_indexes = None
+        self._chains = None
+        # Attribute name -> runners seen to output it, in declared order,
+        # and runner -> set of attribute names it was seen to output
+        self._producers = dict()
+        self._outputs = dict((r, set()) for r in runners)
+
+    def _compile_keys(self):
+        digests = [r.cache_digest for r in self._runners]
+        fetchers = set(r for r in self._runners
+                       if isinstance(r, _ObjectFetcher))
+        self._key_prefixes = []
+        self._record_fields = []
+        for r, d in zip(self._runners, digests):
+            # The fetcher's result names the content of the object
+            if self._content_keys and r not in fetchers:
+                prefixes, fields = (self._content_prefixes,
+                                    self._content_fields)
+            else:
+                prefixes, fields = self._key_prefixes, self._record_fields
+            prefixes.append((r, d + ' '))
+            fields.append((r, cache.RECORD_SEPARATOR + d))
+        # Scores are indexed per filter stack, so that the inputs of a
+        # filter come from the same filters whenever its index is used
+        stack = murmur(' '.join(sorted(digests)))
+        by_name = dict((str(r), r) for r in self._runners)
+        self._score_indexes = []
+        self._chains = []
+        for runner, digest in zip(self._runners, digests):
+            chain = set(fetchers)
+            pending = list(runner.dependencies)
+            while pending:
+                dep = by_name.get(pending.pop())
+                if dep is None:
+                    chain = None
+                    break
+                if dep not in chain:
+                    chain.add(dep)
+                    pending.extend(dep.dependencies)
+            if (chain is None or runner in fetchers or
+                    runner.score_bounds is None):
+                self._score_indexes.append(None)
+                self._chains.append(None)
+            else:
+                self._score_indexes.append(cache.SCORE_INDEX_PREFIX +
+                                           murmur(stack + ' ' + digest))
+                self._chains.append(chain)
+
+    def result_keys(self, obj, records=False, content=None):
+        '''Return the runner -> result cache key mapping for the object,
+        naming fields of its object record if records is true.  With
+        content keys, results other than the object fetcher's are keyed on
+        content, the signature of the object data, and left out if it is
+        None.  Otherwise equivalent to calling get_cache_key() on each
+        runner.'''
+        if self._key_prefixes is None:
+            self._compile_keys()
+        keys = self._keys(str(obj), records, self._key_prefixes,
+                          self._record_fields)
+        if content is not None and self._content_prefixes:
+            keys.update(self._keys(content, records, self._content_prefixes,
+                                   self._content_fields))
+        return keys
+
+    @staticmethod
+    def _keys(name, records, prefixes, fields):
+        if records:
+            record = 'object:' + murmur(name)
+            return dict((r, record + field) for r, field in fields)
+        return dict((r, 'result:' + murmur(prefix + name))
+                    for r, prefix in prefixes)
+
+    def content(self, obj, results=None):
+        '''Return the signature of the object data, from the object if it
+        has been loaded or else from the object fetcher's result in
+        results, a runner -> _FilterResult map; or None.'''
+        if ATTR_DATA in obj:
+            return obj.get_signature(ATTR_DATA)
+        for runner, result in (results or {}).iteritems():
+            if isinstance(runner, _ObjectFetcher):
+                return result.output_attrs.get(ATTR_DATA)
+        return None
+
+    def record(self, obj):
+        '''Return the name of the object's record.'''
+        return 'object:' + murmur(str(obj))
+
+    @property
+    def drop_query(self):
+        '''The record fields and score bounds of the runners, as taken by
+        CacheBackend.resolve_drops(), or None if a runner's threshold is
+        not a score range.'''
+        bounds = [r.score_bounds for r in self._runners]
+        if None in bounds:
+            return None
+        return [r.cache_digest for r in self._runners], bounds
+
+    def observe(self, runner, result):
+        '''Add the output attributes of the result to the attribute flow.'''
+        outputs = self._outputs[runner]
+        if outputs.issuperset(result.output_attrs):
+            return
+        for key in result.output_attrs:
+            if key not in outputs:
+                outputs.add(key)
+                producers = self._producers.get(key, ()) + (runner,)
+                self._producers[key] = tuple(sorted(
+                    producers, key=self._positions.__getitem__))
+
+    def score_entries(self, obj, results):
+        '''Return the score index key -> score mapping for the results, a
+        runner -> _FilterResult map, of the object.  A result is indexed
+        only if every input attribute was present and only the filters
+        it declares it depends on, or the object fetcher, are seen to
+        produce them, since an index entry is trusted without checking
+        the inputs of the result.'''
+        if self._key_prefixes is None:
+            self._compile_keys()
+        entries = dict()
+        member = None
+        for runner, result in results.iteritems():
+            self.observe(runner, result)
+        for runner, result in results.iteritems():
+            i = self._positions[runner]
+            index = self._score_indexes[i]
+            if index is None:
+                continue
+            chain = self._chains[i]
+            for key, valsig in result.input_attrs.iteritems():
+                producers = self._producers.get(key)
+                if (valsig is None or not producers or
+                        not chain.issuperset(producers)):
+                    break
+            else:
+                score = float(result.score)
+                if math.isinf(score) or math.isnan(score):
+                    # Not storable in a sorted set
+                    continue
+                if member is None:
+                    member = murmur(str(obj))
+                entries[cache.score_key(index, member)] = repr(score)
+        return entries
+
+    @property
+    def score_queries(self):
+        '''The [(runner, (score index, minimum, maximum))] to find objects
+        that indexed runners would drop, with None for no bound.'''
+        if self._key_prefixes is None:
+            self._compile_keys()
+        queries = []
+        for runner, index in zip(self._runners, self._score_indexes):
+            if index is None:
+                continue
+            bounds = [None if b is None or math.isinf(b) else b
+                      for b in runner.score_bounds]
+            if bounds != [None, None]:
+                queries.append((runner, (index,) + tuple(bounds)))
+        return queries
+
+    def resolve_drop(self, obj, cache_results):
+        '''Return the set of runners whose cached results prove that the
+        object should be dropped, or None if cache_results, a runner ->
+        _FilterResult map, do not.'''
+        outputs = self._outputs
+        drops = []
+        for runner, result in cache_results.iteritems():
+            if not outputs[runner].issuperset(result.output_attrs):
+                self.observe(runner, result)
+            if not runner.threshold(result):
+                drops.append(runner)
+        if not drops:
+            return None
+        # Try the dropping runners in declared order, as RESOLVE_SCRIPT
+        # does, so that both credit the same runners with the drop
+        drops.sort(key=self._positions.__getitem__)
+
+        # Now follow the dependency chains of each runner that produced a
+        # drop decision to determine whether any of them have cached results
+        # we can use.  A usable cached result is one where every input
+        # attribute that was used to calculate the result, directly or via a
+        # dependency chain, is an output attribute of another cached result.
+        # (In other words, an unusable cached result is one where we cannot
+        # prove that all of its inputs match the inputs on which it was
+        # originally run.)  We compute the set of filters that contributed
+        # to a drop decision so that the runners can be notified to update
+        # their statistics.
+        resolved = dict()  # runner -> set(runner + transitive depends)
+        for runner in drops:
+            deps = self._resolve(obj, runner, cache_results, resolved, set())
+            if deps is not None:
+                _debug('Drop via %s', runner)
+                return deps
+        return None
+
+    def _resolve(self, obj, runner, cache_results, resolved, inprocess):
+        '''If this runner has usable cached results, return a set
+        containing the runner and its transitive dependencies.  Otherwise
+        return None.'''
+        if runner in resolved:
+            return resolved[runner]
+        try:
+            result = cache_results[runner]
+        except KeyError:
+            # No cached result for this runner.
+            return None
+        if runner in inprocess:
+            # Circular dependency in cache; shouldn't happen.
+            # Bail out on this resolution.
+            _log.error('Circular dependency in cache for object %s', obj)
+            return None
+        inprocess.add(runner)
+        try:
+            dependencies = set([runner])
+            # For each input attribute...
+            for key, valsig in result.input_attrs.iteritems():
+                # ...try to find a resolvable filter that generated it.
+                if valsig is None:
+                    # The result claims the filter tried and failed to
+                    # load an input attribute.  We can only resolve this
+                    # result if all other filter results are cached *and*
+                    # none of them contain the attribute.  (The failure
+                    # already indicates a dependency bug in the searchlet,
+                    # so it's not sufficient to check the filter's
+                    # declared dependencies.)  This is an unusual case,
+                    # so simply declare this result unresolvable.
+                    _debug('%s key %s was missing; skipping resolution',
+                           runner, key)
+                    return None
+                for cur in self._producers.get(key, ()):
+                    try:
+                        cur_valsig = cache_results[cur].output_attrs[key]
+                    except KeyError:
+                        # No cached result for this producer, or it did
+                        # not output the attribute this time.
+                        continue
+                    if cur_valsig != valsig:
+                        # This filter generated the right attribute name
+                        # but the wrong attribute value.  This means that
+                        # the output of the filter can vary with the value
+                        # of an input (probably a filter argument) which
+                        # is not captured in the result cache key of the
+                        # runner, leading to a cache collision for the
+                        # runner.  To fix this, filter authors should add
+                        # the hash of the dependency's arguments as a
+                        # dummy argument to the runner's filter.
+                        _log.warning('Result cache collision for ' +
+                                     'filter %s', runner)
+                        continue
+                    cur_deps = self._resolve(obj, cur, cache_results,
+                                             resolved, inprocess)
+                    if cur_deps is not None:
+                        # Resolved this input attribute.
+                        dependencies.update(cur_deps)
+                        break
+                else:
+                    # No resolvable filter generated this attribute.
+                    return None
+            # Successfully resolved dependencies.
+            _debug('Resolved: %s', runner)
+            resolved[runner] = dependencies
+            return dependencies
+        finally:
+            inprocess.remove(runner)
+
+
+class _ScopeReader(object):
+    '''Reads the objects of the scope in a background thread, so that
+    worker threads can wait for the next object with a timeout.'''
+
+    def __init__(self, scope, size):
+        self._queue = Queue.Queue(size)
+        thread = threading.Thread(target=self._read, args=(scope,),
+                                  name='Scope')
+        thread.setDaemon(True)
+        thread.start()
+
+    # We want to catch all exceptions
+    # pylint: disable=broad-except
+    def _read(self, scope):
+        '''Thread function.'''
+        try:
+            for obj in scope:
+                self._queue.put(obj)
+        except Exception:
+            _log.exception('Scope reader exception')
+            os.kill(os.getpid(), signal.SIGUSR1)
+            # pylint: enable=broad-except
+        finally:
+            self._queue.put(None)
+
+    def get(self, timeout=None):
+        '''Return the next object, or None at the end of the scope or if
+        timeout seconds pass first.'''
+        try:
+            obj = self._queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+        if obj is None:
+            # Leave the end of the scope for the other threads to see
+            self._queue.put(None)
+        return obj
 
 
 class FilterStackRunner(threading.Thread):
     '''A context for processing objects with a FilterStack.  Handles querying
     and updating the result and attribute caches.'''
 
-    def __init__(self, state, filter_runners, name, cleanup):
+    def __init__(self, state, filter_runners, name, cleanup, stack=None,
+                 scope=None):
         threading.Thread.__init__(self, name=name)
         self.setDaemon(True)
         self._state = state
         self._runners = filter_runners
-        self._redis = None  # May be None if caching is not enabled
+        # The _ScopeReader the thread takes objects from, shared with the
+        # other worker threads of the search
+        self._scope = scope
+        # If the FilterStack is given, we follow its adaptive execution
+        # order.  filter_runners is then the object fetcher followed by one
+        # runner per filter in the stack's declared order.
+        self._stack = stack
+        if stack is not None:
+            self._filter_runners = dict(zip(stack, filter_runners[1:]))
+            # runner -> set of runners it depends on, and runner ->
+            # declared position, for concurrent evaluation
+            by_name = dict((f.name, r) for f, r in
+                           self._filter_runners.iteritems())
+            self._dependencies = dict(
+                (r, set(by_name[name] for name in f.dependencies))
+                for f, r in self._filter_runners.iteritems())
+            self._positions = dict((r, i) for i, r in
+                                   enumerate(filter_runners))
+        # Maximum filters to run concurrently on each object
+        self._parallel = 1
+        if stack is not None:
+            self._parallel = state.config.parallel_filters
+        # _EvaluationThreads for concurrent filters, once needed
+        self._threads = None
+        self._cache = None  # CacheBackend; None if caching is not enabled
         self._cleanup = cleanup  # cleanup.__del__ fires when all workers exit
         self._warned_cache_update = False
+        # Objects taken from the scope but not yet evaluated
+        self._lookahead = collections.deque()
+        # Object -> (runner -> _FilterResult, attribute cache key -> value
+        # or None if not cached) fetched from the cache ahead of evaluation
+        self._prefetched = dict()
+        # Attribute cache key -> value for the objects being evaluated
+        self._prefetched_values = dict()
+        # Cache keys and drop resolution, compiled for the filter stack
+        self._content_keys = bool(state.config.cache_content_keys)
+        self._plan = _ResolutionPlan(filter_runners, self._content_keys)
+        # Object -> [(runner, _FilterResult)] for objects the score index
+        # or the cache server found should be dropped, and whether to
+        # consult each
+        self._known_drops = dict()
+        self._score_index = bool(state.config.cache_score_index)
+        # The server sees an object's results together only in its record
+        self._server_resolution = bool(
+            state.config.cache_server_resolution and
+            state.config.cache_object_records and
+            not self._content_keys)
 
     def _ensure_cache(self):
-        '''Connect to Redis cache if not already connected.  Called from
-        worker thread context, rather than in __init__, to avoid any
-        redis-py thread-safety issues.'''
+        '''Connect to the cache backend if not already connected.  Called
+        from worker thread context, rather than in __init__, because
+        backends must not be shared between threads.'''
         config = self._state.config
-        if self._redis is None and config.cache_server is not None:
-            host, port = config.cache_server
-            self._redis = Redis(host=host, port=port,
-                                db=config.cache_database,
-                                password=config.cache_password)
-            # Ensure the Redis server is available
-            self._redis.ping()
+        if self._cache is None and cache.caching_enabled(config):
+            self._cache = cache.connect(config)
 
     def _get_attribute_key(self, value_sig):
         '''Return an attribute cache lookup key for the specified signature.'''
@@ -752,102 +2107,88 @@ class FilterStackRunner(threading.Thread):
     def _result_cache_can_drop(self, obj, cache_results):
         '''Return True if the object can be dropped.  cache_results is a
         runner -> _FilterResult map retrieved from the result cache.'''
+        hits = self._known_drops.pop(obj, None)
+        if hits is None:
+            deps = self._plan.resolve_drop(obj, cache_results)
+            if deps is None:
+                return False
+            hits = [(cur, cache_results[cur]) for cur in deps]
+        # Notify runners that participated in the cached result
+        for cur, result in hits:
+            cur.cache_hit(result)
+        return True
 
-        # Build output_key -> [runners] mapping.
-        output_attrs = dict()
-        for runner, result in cache_results.iteritems():
-            for k in result.output_attrs:
-                output_attrs.setdefault(k, []).append(runner)
-
-        # Now follow the dependency chains of each runner that produced a
-        # drop decision to determine whether any of them have cached results
-        # we can use.  A usable cached result is one where every input
-        # attribute that was used to calculate the result, directly or via a
-        # dependency chain, is an output attribute of another cached result.
-        # (In other words, an unusable cached result is one where we cannot
-        # prove that all of its inputs match the inputs on which it was
-        # originally run.)  We compute the set of filters that contributed
-        # to a drop decision so that the runners can be notified to update
-        # their statistics.
-        resolved = dict()  # runner -> set(runner + transitive depends)
-        inprocess = set()  # runner
-
-        def resolve(runner):
-            '''If this runner has usable cached results, return a set
-            containing the runner and its transitive dependencies.  Otherwise
-            return None.'''
-            if runner in resolved:
-                return resolved[runner]
+    def _resolve_known_drops(self, objs):
+        '''Find the objects that can be dropped without fetching their
+        cached results, and record them for _result_cache_can_drop().
+        Return the other objects.'''
+        return self._server_resolve(self._index_resolve(objs))
+
+    def _index_resolve(self, objs):
+        '''Find the objects that a score index shows to be out of range.
+        Return the other objects.'''
+        if not self._score_index or self._cache is None or not objs:
+            return objs
+        queries = self._plan.score_queries
+        if not queries:
+            return objs
+        try:
+            drops = self._state.score_index.drops(
+                self._cache, [query for _, query in queries])
+        except cache.CacheError, e:
+            _log.warning('Cannot read score index: %s', e)
+            self._score_index = False
+            return objs
+        remaining = []
+        for obj in objs:
             try:
-                result = cache_results[runner]
+                i, score = drops[murmur(str(obj))]
             except KeyError:
-                # No cached result for this runner.
-                return
-            if runner in inprocess:
-                # Circular dependency in cache; shouldn't happen.
-                # Bail out on this resolution.
-                _log.error('Circular dependency in cache for object %s', obj)
-                return
-            inprocess.add(runner)
+                remaining.append(obj)
+            else:
+                self._known_drops[obj] = [(queries[i][0],
+                                           _FilterResult(score=score))]
+        self._state.stats.update(
+            result_cache_index_drops=len(objs) - len(remaining))
+        return remaining
+
+    def _server_resolve(self, objs):
+        '''Have the cache server decide which of the objects its cached
+        results prove should be dropped, and record them for
+        _result_cache_can_drop().  Return the other objects, whose results
+        must be fetched as usual.'''
+        if not self._server_resolution or self._cache is None or not objs:
+            return objs
+        query = self._plan.drop_query
+        verdicts = None
+        if query is None:
+            _log.info('Resolving cached drops locally: a filter has no '
+                      'score bounds')
+        else:
             try:
-                dependencies = set([runner])
-                # For each input attribute...
-                for key, valsig in result.input_attrs.iteritems():
-                    # ...try to find a resolvable filter that generated it.
-                    if valsig is None:
-                        # The result claims the filter tried and failed to
-                        # load an input attribute.  We can only resolve this
-                        # result if all other filter results are cached *and*
-                        # none of them contain the attribute.  (The failure
-                        # already indicates a dependency bug in the searchlet,
-                        # so it's not sufficient to check the filter's
-                        # declared dependencies.)  This is an unusual case,
-                        # so simply declare this result unresolvable.
-                        _debug('%s key %s was missing; skipping resolution',
-                               runner, key)
-                        return
-                    for cur in output_attrs.get(key, ()):
-                        if cache_results[cur].output_attrs[key] != valsig:
-                            # This filter generated the right attribute name
-                            # but the wrong attribute value.  This means that
-                            # the output of the filter can vary with the value
-                            # of an input (probably a filter argument) which
-                            # is not captured in the result cache key of the
-                            # runner, leading to a cache collision for the
-                            # runner.  To fix this, filter authors should add
-                            # the hash of the dependency's arguments as a
-                            # dummy argument to the runner's filter.
-                            _log.warning('Result cache collision for ' +
-                                         'filter %s', runner)
-                            continue
-                        cur_deps = resolve(cur)
-                        if cur_deps is not None:
-                            # Resolved this input attribute.
-                            dependencies.update(cur_deps)
-                            break
-                    else:
-                        # No resolvable filter generated this attribute.
-                        return
-                # Successfully resolved dependencies.
-                _debug('Resolved: %s', runner)
-                resolved[runner] = dependencies
-                return dependencies
-            finally:
-                inprocess.remove(runner)
-
-        for runner, result in cache_results.iteritems():
-            if not runner.threshold(result):
-                # This would be a drop.  Try to resolve the cached result.
-                deps = resolve(runner)
-                if deps is not None:
-                    # Success!  Notify runners that participated in the
-                    # cached result and drop the object.
-                    _debug('Drop via %s', runner)
-                    for cur in deps:
-                        cur.cache_hit(cache_results[cur])
-                    return True
-
-        return False
+                verdicts = self._cache.resolve_drops(
+                    [self._plan.record(obj) for obj in objs], *query)
+            except cache.CacheError, e:
+                _log.warning('Cache server cannot resolve drops: %s', e)
+            else:
+                if verdicts is None:
+                    _log.info('Resolving cached drops locally: not '
+                              'supported by the cache backend')
+        if verdicts is None:
+            self._server_resolution = False
+            return objs
+        remaining = []
+        for obj, verdict in zip(objs, verdicts):
+            if verdict is None:
+                remaining.append(obj)
+            else:
+                self._known_drops[obj] = [
+                    (self._runners[i], _FilterResult(score=score))
+                    for i, score in verdict]
+        self._state.stats.update(
+            cache_round_trips=1,
+            result_cache_server_drops=len(objs) - len(remaining))
+        return remaining
 
     def _attribute_cache_try_load(self, runner, obj, result):
         '''Try to update object attributes from the cached result from
@@ -873,10 +2214,21 @@ class FilterStackRunner(threading.Thread):
         keys = result.output_attrs.keys()
         cache_keys = [self._get_attribute_key(result.output_attrs[k])
                       for k in keys]
-        if self._redis is not None and cache_keys:
-            values = self._redis.mget(cache_keys)
-        else:
-            values = [None for k in cache_keys]
+        # Values already looked up by _prefetch(), including those it
+        # found missing, need no further round trip
+        values = [self._prefetched_values.get(k) for k in cache_keys]
+        missing = [i for i, k in enumerate(cache_keys)
+                   if k not in self._prefetched_values]
+        stats = self._state.stats
+        if missing and self._cache is not None:
+            fetched, trips = self._cache_get([cache_keys[i] for i in missing],
+                                             attributes=True)
+            for i, value in zip(missing, fetched):
+                values[i] = value
+            stats.update(cache_round_trips=trips)
+        if cache_keys:
+            stats.update('attribute_cache_lookups',
+                         attribute_cache_hits=int(None not in values))
         if None in values:
             # One or more attribute values was not cached.  We need
             # to rerun the filter.
@@ -896,57 +2248,479 @@ class FilterStackRunner(threading.Thread):
         runner.cache_hit(result)
         return True
 
-    def _evaluate(self, obj):
-        _debug('Evaluating %s', obj)
-
-        # Calculate runner -> result cache key mapping.
-        cache_keys = dict([(r, r.get_cache_key(obj)) for r in self._runners])
-
-        # Look up all filter results in the cache and build runner -> result
-        # mapping for results that exist.
-        if self._redis is not None:
-            keys = [cache_keys[r] for r in self._runners]
-            results = [(runner, _FilterResult.decode(data))
-                       for runner, data in
-                       zip(self._runners, self._redis.mget(keys))]
-            # runner -> _FilterResult
-            cache_results = dict([(k, v) for k, v in results if v is not None])
+    def _result_keys(self, obj, results=None):
+        '''Return the runner -> result cache key mapping for the object.
+        With object records, the keys name fields of the object's record,
+        which the backend reads and writes together.  With content keys,
+        the keys of filter results are derived from the object data, as
+        loaded or as recorded by the object fetcher's result in results,
+        and are left out while that is unknown.'''
+        content = None
+        if self._content_keys:
+            content = self._plan.content(obj, results)
+        return self._plan.result_keys(
+            obj, self._state.config.cache_object_records, content)
+
+    def _cache_get(self, keys, attributes=False, sources=None):
+        '''Return a list of the cached values of the keys, with None for
+        those not cached, and the number of backend round trips taken.  The
+        search's in-memory cache of result entries, or of attribute values
+        if attributes is True, is consulted first and updated with values
+        found in the backend.  sources, a list of (runner, object) pairs
+        parallel to the result cache keys, allows results missing from
+        object records to be found under per-filter keys.'''
+        if attributes:
+            memory = self._state.attribute_memory
+            stats = ('attribute_memory_lookups', 'attribute_memory_hits')
         else:
-            cache_results = dict()
+            memory = self._state.result_memory
+            stats = ('result_memory_lookups', 'result_memory_hits')
+        if memory is not None:
+            values = memory.get_many(keys)
+            missing = [i for i, value in enumerate(values) if value is None]
+            self._state.stats.update(**{
+                stats[0]: len(keys),
+                stats[1]: len(keys) - len(missing),
+            })
+        else:
+            values = [None] * len(keys)
+            missing = range(len(keys))
+        admission = self._state.admission
+        if attributes and admission is not None:
+            admission.record_lookups(key[len('attribute:'):] for key in keys)
+        if not missing:
+            return values, 0
+        timer = Timer()
+        found = dict()
+        for i, value in zip(missing,
+                            self._cache.get_many([keys[i] for i in missing])):
+            if value is not None:
+                if attributes:
+                    value = cache.decode_attribute(keys[i], value)
+                values[i] = found[keys[i]] = value
+        trips = 1
+        if (sources is not None and
+                self._state.config.cache_object_records == 1):
+            trips += self._migrate_results(keys, values, sources, found)
+        if attributes and found and admission is not None:
+            admission.record_fetch(sum(len(v) for v in found.itervalues()),
+                                   timer.elapsed_seconds)
+            latency, per_byte = admission.fetch_estimate
+            self._state.stats.update(
+                cache_fetch_latency_us=int(latency * 1e6),
+                cache_fetch_us_per_mb=int(per_byte * 1e6 * (1 << 20)))
+        if memory is not None:
+            memory.update(found)
+        return values, trips
+
+    def _migrate_results(self, keys, values, sources, found):
+        '''Look up the results missing from object records under the
+        per-filter keys written without records, and copy those found into
+        the records.  Update values and found in place and return the
+        number of backend round trips taken.'''
+        missing = [i for i, value in enumerate(values) if value is None]
+        if not missing:
+            return 0
+        legacy = [sources[i][0].get_cache_key(sources[i][1]) for i in missing]
+        migrated = dict()
+        for i, legacy_key, data in zip(missing, legacy,
+                                       self._cache.get_many(legacy)):
+            runner = sources[i][0]
+            result = self._decode_result(runner, legacy_key, data)
+            if result is not None:
+                values[i] = found[keys[i]] = migrated[keys[i]] = \
+                    self._encode_result(runner, keys[i], result)
+        if migrated:
+            self._state.stats.update(cache_record_migrations=len(migrated))
+            self._cache_write(migrated)
+        return 1
+
+    def _encode_result(self, runner, key, result):
+        '''Return the result cache entry, stored under key, for the
+        runner's result, in the configured format.'''
+        if (self._cache is None or
+                self._state.config.cache_result_format < 2):
+            return result.encode()
+        names = self._state.attribute_names
+        try:
+            return result.encode(partial(names.get_ids, self._cache,
+                                         self._cache.shard(key),
+                                         runner.cache_digest))
+        except cache.CacheError:
+            # Couldn't extend the name table
+            return result.encode()
+
+    def _decode_result(self, runner, key, data):
+        '''Return the _FilterResult in the runner's result cache entry,
+        stored under key, or None.'''
+        if data is None:
+            return None
+        return _FilterResult.decode(data, partial(
+            self._state.attribute_names.get_names, self._cache,
+            self._cache.shard(key), runner.cache_digest))
+
+    def _cache_lookup(self, obj, cache_keys):
+        '''Look up all filter results for the object in the cache and
+        return a runner -> _FilterResult mapping for results that exist.'''
+        if self._cache is None or not self._resolve_known_drops([obj]):
+            return dict()
+        found, trips = self._lookup_results([obj], [cache_keys])
+        self._state.stats.update(cache_round_trips=trips)
+        return found[0]
+
+    def _lookup_results(self, objs, keymaps):
+        '''Look up the result cache entries named by keymaps, a runner ->
+        key mapping per object.  Return a runner -> _FilterResult mapping
+        per object for the results that exist, and the number of round
+        trips taken.  With content keys, the object fetcher's results
+        name the keys of the others, which are then looked up too and
+        added to keymaps.'''
+        found, trips = self._fetch_results(objs, keymaps)
+        if self._content_keys:
+            more = []
+            for obj, keymap, results in zip(objs, keymaps, found):
+                keys = self._result_keys(obj, results)
+                more.append(dict((r, k) for r, k in keys.iteritems()
+                                 if r not in keymap))
+                keymap.update(more[-1])
+            if any(more):
+                extra, extra_trips = self._fetch_results(objs, more)
+                for results, extra_results in zip(found, extra):
+                    results.update(extra_results)
+                trips += extra_trips
+        return found, trips
+
+    def _fetch_results(self, objs, keymaps):
+        '''Fetch and decode the result cache entries named by keymaps.
+        Return as for _lookup_results().'''
+        lookups = [(i, runner, key) for i, keymap in enumerate(keymaps)
+                   for runner, key in keymap.iteritems()]
+        found = [dict() for _obj in objs]
+        if not lookups:
+            return found, 0
+        data, trips = self._cache_get([key for _, _, key in lookups],
+                                      sources=[(runner, objs[i]) for
+                                               i, runner, _ in lookups])
+        hits = 0
+        for (i, runner, key), item in zip(lookups, data):
+            result = self._decode_result(runner, key, item)
+            if result is not None:
+                found[i][runner] = result
+                hits += 1
+        self._state.stats.update(result_cache_lookups=len(lookups),
+                                 result_cache_hits=hits)
+        return found, trips
+
+    def _content_lookup(self, objs, live, cache_keys, cache_results):
+        '''With content keys, look up the results of the objects whose
+        indexes are in live, if loading them has changed or revealed their
+        content keys.  Update cache_keys and cache_results, and return the
+        indexes of the objects the results do not prove should be
+        dropped.'''
+        changed = []
+        keymaps = []
+        for i in live:
+            keymap = dict((r, k) for r, k in
+                          self._result_keys(objs[i]).iteritems()
+                          if cache_keys[i].get(r) != k)
+            if keymap:
+                cache_keys[i].update(keymap)
+                for runner in keymap:
+                    cache_results[i].pop(runner, None)
+                changed.append(i)
+                keymaps.append(keymap)
+        if not changed or self._cache is None:
+            return live
+        found, trips = self._lookup_results([objs[i] for i in changed],
+                                            keymaps)
+        self._state.stats.update(cache_round_trips=trips)
+        dropped = set()
+        for i, results in zip(changed, found):
+            cache_results[i].update(results)
+            if self._result_cache_can_drop(objs[i], cache_results[i]):
+                dropped.add(i)
+        return [i for i in live if i not in dropped]
+
+    def _prefetch(self, objs):
+        '''Fetch the cached results of all filters for the objects, and
+        the attribute values recorded by results that would not drop the
+        object, in at most two round trips (three with content keys),
+        after asking the cache server to resolve drops if configured.
+        _evaluate() then finds them locally rather than looking them up
+        one object at a time.'''
+        if self._cache is None or not objs:
+            return
+        # Round trips saved over looking up each object on its own, as
+        # _evaluate() would otherwise do: first those of asking the server
+        # to resolve drops
+        saved = 0
+        indexed = self._index_resolve(objs)
+        server = self._server_resolution and bool(indexed)
+        live = self._server_resolve(indexed)
+        if server and self._server_resolution:
+            saved += len(indexed) - 1
+        for obj in objs:
+            if obj in self._known_drops:
+                # Nothing more to fetch
+                self._prefetched[obj] = (dict(), dict())
+        objs = live
+        if not objs:
+            self._state.stats.update(cache_round_trips_saved=saved)
+            return
+        keymaps = [self._result_keys(obj) for obj in objs]
+        sizes = [len(keymap) for keymap in keymaps]
+        found, trips = self._lookup_results(objs, keymaps)
+        baseline = 0
+        if trips:
+            migrating = self._state.config.cache_object_records == 1
+            for keymap, size, results in zip(keymaps, sizes, found):
+                # The object's own lookup, a second one for the keys that
+                # its content named, and one for results missing from its
+                # record
+                baseline += 1 + int(len(keymap) > size)
+                baseline += int(migrating and len(results) < len(keymap))
+        attribute_keys = set()
+        loads = 0
+        for results in found:
+            # Values produced by a dropping filter are only needed if the
+            # drop cannot be proven, so don't speculate on them
+            passing = [result for runner, result in results.iteritems()
+                       if runner.threshold(result)]
+            for result in passing:
+                attribute_keys.update(self._get_attribute_key(sig)
+                                      for sig in
+                                      result.output_attrs.itervalues())
+            if len(passing) == len(results):
+                # Each result loaded would have fetched its own values
+                loads += sum(1 for result in passing if result.output_attrs)
+        values = dict()
+        if attribute_keys:
+            attribute_keys = list(attribute_keys)
+            data, attribute_trips = self._cache_get(attribute_keys,
+                                                    attributes=True)
+            values = dict(zip(attribute_keys, data))
+            trips += attribute_trips
+            if attribute_trips:
+                baseline += loads
+        for obj, results in zip(objs, found):
+            self._prefetched[obj] = (results, dict(
+                (key, values[key]) for key in
+                (self._get_attribute_key(sig) for result in results.values()
+                 for sig in result.output_attrs.itervalues())
+                if key in values))
+        saved += max(0, baseline - trips)
+        self._state.stats.update(cache_round_trips=trips,
+                                 cache_round_trips_saved=saved)
+
+    def _evaluate(self, objs, runners):
+        '''Evaluate a list of objects, running each of the runners in turn
+        over all of the objects still in play.  Return a list of accept
+        decisions.'''
+        _debug('Evaluating %s', ', '.join(str(obj) for obj in objs))
+
+        # Per object: runner -> result cache key mapping, and runner ->
+        # _FilterResult mapping of cached and newly computed results.
+        cache_keys = [self._result_keys(obj) for obj in objs]
+        cache_results = []
+        for obj, keys in zip(objs, cache_keys):
+            try:
+                results, values = self._prefetched.pop(obj)
+            except KeyError:
+                results = self._cache_lookup(obj, keys)
+            else:
+                self._prefetched_values.update(values)
+                if self._content_keys:
+                    keys.update(self._result_keys(obj, results))
+            cache_results.append(results)
+        new_results = [dict() for _obj in objs]
 
-        # Evaluate the object in the result cache.
-        if self._result_cache_can_drop(obj, cache_results):
-            return False
+        # Evaluate the objects in the result cache.  Indexes of objects
+        # still in play:
+        live = [i for i, obj in enumerate(objs)
+                if not self._result_cache_can_drop(obj, cache_results[i])]
 
-        new_results = dict()  # runner -> result
         try:
-            # Run each filter or load its prior result into the object.
-            for runner in self._runners:
-                if (runner in cache_results and
-                        self._attribute_cache_try_load(runner, obj,
-                                                       cache_results[runner])):
-                    result = cache_results[runner]
-                else:
-                    result = runner.evaluate(obj)
-                    new_results[runner] = result
-                if not runner.threshold(result):
-                    # Drop decision.
-                    return False
-                elif runner.send_score:
-                    # Store the filter score in the object.  This attribute
-                    # is not cached because that would be redundant.
-                    attrname = ATTR_FILTER_SCORE % runner
-                    obj[attrname] = str(result.score) + '\0'
-            # Object passes all filters, accept
-            return True
-        except _DropObject:
-            return False
+            # The object fetcher comes first regardless
+            live = self._run_filter(runners[0], objs, live,
+                                    cache_results, new_results)
+            if self._content_keys:
+                live = self._content_lookup(objs, live, cache_keys,
+                                            cache_results)
+            if self._parallel > 1:
+                live = self._run_concurrently(objs, runners[1:], live,
+                                              cache_results, new_results)
+            else:
+                for runner in runners[1:]:
+                    live = self._run_filter(runner, objs, live,
+                                            cache_results, new_results)
+            # Objects passing all filters are accepted
+            live = set(live)
+            return [i in live for i in xrange(len(objs))]
+        finally:
+            self._prefetched_values.clear()
+            self._cache_update(objs, cache_keys, new_results)
+
+    def _run_filter(self, runner, objs, live, cache_results, new_results):
+        '''Run a filter, or load its prior result, on the objects whose
+        indexes are in live, and return the indexes of the survivors.'''
+        results = dict()  # index -> result
+        pending = []
+        for i in live:
+            cached = cache_results[i].get(runner)
+            if (cached is not None and
+                    self._attribute_cache_try_load(runner, objs[i], cached)):
+                results[i] = cached
+            else:
+                pending.append(i)
+        if pending:
+            evaluated = runner.evaluate_batch([objs[i] for i in pending])
+            for i, result in zip(pending, evaluated):
+                # None means the object is dropped uncached
+                if result is not None:
+                    results[i] = result
+                    new_results[i][runner] = result
+        survivors = []
+        for i in live:
+            result = results.get(i)
+            if result is None or not runner.threshold(result):
+                # Drop decision.
+                continue
+            self._store_score(runner, objs[i], result)
+            survivors.append(i)
+        return survivors
+
+    def _store_score(self, runner, obj, result):
+        if runner.send_score:
+            # Store the filter score in the object.  This attribute is
+            # not cached because that would be redundant.
+            attrname = ATTR_FILTER_SCORE % runner
+            obj[attrname] = str(result.score) + '\0'
+
+    def _run_concurrently(self, objs, runners, live, cache_results,
+                          new_results):
+        '''Like _run_filter() for each of the runners in turn, but run
+        filters whose dependencies have finished concurrently, up to the
+        configured limit, in order of preference.  Each filter sees its
+        own overlay of each object, merged into the object when the
+        filter finishes.  Where filters write the same attribute, the
+        value from the filter declared last wins, regardless of which
+        finished first.  Once every object has been dropped, filters not
+        yet started are skipped and those still running are abandoned.'''
+        cancellation = _Cancellation(objs)
+        finished_queue = Queue.Queue()
+        pending = list(runners)
+        running = 0
+        finished = set()
+        # Per object: attribute name -> position of the filter whose value
+        # the object holds
+        writers = [dict() for _obj in objs]
+        try:
+            while live and (pending or running):
+                # runners is in dependency order, so when nothing is
+                # running, at least the first pending runner is ready
+                for runner in list(pending):
+                    if running >= self._parallel:
+                        break
+                    if self._dependencies[runner] <= finished:
+                        pending.remove(runner)
+                        self._start_filter(runner, objs, live, cache_results,
+                                           cancellation, finished_queue)
+                        running += 1
+                runner, overlays, results, exc_info = finished_queue.get()
+                running -= 1
+                finished.add(runner)
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                # As in sequential execution, the filter's output lands in
+                # the object even if it is dropped, so that it can be
+                # cached along with the result
+                position = self._positions[runner]
+                for i, overlay in overlays.iteritems():
+                    overlay.merge(position, writers[i])
+                for i, (result, cached) in results.iteritems():
+                    # None means the object is dropped uncached
+                    if result is not None and not cached:
+                        new_results[i][runner] = result
+                survivors = []
+                for i in live:
+                    result = results.get(i, (None, False))[0]
+                    if result is None or not runner.threshold(result):
+                        # Drop decision.
+                        continue
+                    self._store_score(runner, objs[i], result)
+                    survivors.append(i)
+                live = survivors
+            return live
         finally:
-            # Update the cache with new values
-            resultmap = dict()
-            for runner, result in new_results.iteritems():
+            # Abort the filters still running rather than waiting for
+            # them.  The objects' shared memory is held until they finish.
+            cancellation.cancel()
+
+    def _start_filter(self, runner, objs, live, cache_results, cancellation,
+                      finished_queue):
+        '''Start running a filter on overlays of the objects whose indexes
+        are in live, in one of our evaluation threads unless all of its
+        results can be loaded from the cache.  Report (runner, index ->
+        overlay, index -> (result, cached), exc_info) to finished_queue.'''
+        overlays = dict()
+        results = dict()
+        pending = []
+        for i in live:
+            overlay = overlays[i] = _ObjectOverlay(objs[i], cancellation)
+            cached = cache_results[i].get(runner)
+            # Cache lookups stay in this thread, which owns the cache
+            # backend
+            if (cached is not None and
+                    self._attribute_cache_try_load(runner, overlay, cached)):
+                results[i] = (cached, True)
+            else:
+                pending.append(i)
+
+        # We want to hand all exceptions to the calling thread
+        # pylint: disable=broad-except
+        def run():
+            try:
+                evaluated = runner.evaluate_batch([overlays[i]
+                                                   for i in pending],
+                                                  cancellation)
+                for i, result in zip(pending, evaluated):
+                    results[i] = (result, False)
+                finished_queue.put((runner, overlays, results, None))
+            except Exception:
+                if cancellation.cancelled:
+                    _log.warning('%s failed on discarded objects: %s',
+                                 runner, sys.exc_info()[1])
+                finished_queue.put((runner, overlays, results,
+                                    sys.exc_info()))
+            finally:
+                cancellation.finished()
+        # pylint: enable=broad-except
+
+        if pending:
+            if self._threads is None:
+                self._threads = _EvaluationThreads(
+                    threading.current_thread().name)
+            cancellation.started()
+            self._threads.run(run)
+        else:
+            finished_queue.put((runner, overlays, results, None))
+
+    def _cache_update(self, objs, cache_keys, new_results):
+        '''Update the cache with new values.  cache_keys and new_results
+        are lists of runner -> result cache key and runner -> _FilterResult
+        mappings, one per object.'''
+        resultmap = dict()
+        attributemap = dict()
+        attribute_names = dict()
+        scoremap = dict()
+        for obj, keys, results in zip(objs, cache_keys, new_results):
+            if self._score_index:
+                scoremap.update(self._plan.score_entries(obj, results))
+            for runner, result in results.iteritems():
                 # Result cache entry
-                resultmap[cache_keys[runner]] = result.encode()
+                result_key = keys[runner]
+                resultmap[result_key] = self._encode_result(runner, result_key,
+                                                            result)
                 # Attribute cache entries, if the filter was expensive enough
                 if result.cache_output:
                     for key, valsig in result.output_attrs.iteritems():
@@ -955,31 +2729,114 @@ class FilterStackRunner(threading.Thread):
                         # newer value against this key.
                         if valsig == obj.get_signature(key):
                             attribute_key = self._get_attribute_key(valsig)
-                            resultmap[attribute_key] = obj[key]
-            # Do it
-            if self._redis is not None and resultmap:
-                try:
-                    self._redis.mset(resultmap)
-                except ResponseError, e:
-                    # mset failed, possibly due to maxmemory quota
-                    if not self._warned_cache_update:
-                        self._warned_cache_update = True
-                        _log.warning('Failed to update cache: %s', e)
+                            attributemap[attribute_key] = obj[key]
+                            attribute_names[attribute_key] = key
+        # Later lookups in this search needn't go to the backend
+        if self._state.result_memory is not None:
+            self._state.result_memory.update(resultmap)
+        if self._state.attribute_memory is not None:
+            self._state.attribute_memory.update(attributemap)
+        config = self._state.config
+        if attributemap and self._cache is not None:
+            stored = attributemap
+            if config.cache_compress:
+                stored = dict((k, cache.encode_attribute(attribute_names[k],
+                                                         v))
+                              for k, v in attributemap.iteritems())
+            self._state.stats.update(
+                attribute_bytes_cached=sum(len(v) for v in
+                                           attributemap.itervalues()),
+                attribute_bytes_stored=sum(len(v) for v in
+                                           stored.itervalues()))
+            resultmap.update(stored)
+        resultmap.update(scoremap)
+        # Do it
+        if resultmap:
+            self._cache_write(resultmap)
+
+    def _cache_write(self, entries):
+        '''Store the key -> value mapping in the cache, in the background
+        if a cache writer is running.'''
+        if self._state.cache_writer is not None:
+            self._state.cache_writer.put(entries)
+        elif self._cache is not None:
+            try:
+                self._cache.put_many(entries)
+            except cache.CacheError, e:
+                # Possibly due to the Redis maxmemory quota
+                if not self._warned_cache_update:
+                    self._warned_cache_update = True
+                    _log.warning('Failed to update cache: %s', e)
 
     def evaluate(self, obj):
         '''Evaluate the object and return True to accept or False to drop.'''
-        # Connect to Redis cache if not already connected
+        return self.evaluate_batch([obj])[0]
+
+    def evaluate_batch(self, objs):
+        '''Evaluate a list of objects together and return a list with True
+        for each object to accept or False for each object to drop.'''
+        # Connect to the cache backend if not already connected
         self._ensure_cache()
         timer = Timer()
-        accept = False
+        accepts = [False] * len(objs)
+        runners = self._runners
+        if self._stack is not None:
+            runners = [runners[0]] + [self._filter_runners[f]
+                                      for f in self._stack.execution_order()]
         try:
-            accept = self._evaluate(obj)
+            accepts = self._evaluate(objs, runners)
         finally:
-            self._state.stats.update('objs_processed',
-                                     execution_us=timer.elapsed,
-                                     objs_passed=int(accept),
-                                     objs_dropped=int(not accept))
-        return accept
+            # Charge each object of a batch an equal share of the time
+            elapsed = timer.elapsed / len(objs)
+            for obj, accept in zip(objs, accepts):
+                # Filters are done with any shared copies of attribute values
+                obj.release()
+                self._state.stats.update('objs_processed',
+                                         execution_us=elapsed,
+                                         objs_passed=int(accept),
+                                         objs_dropped=int(not accept))
+        return accepts
+
+    def _next_batch(self):
+        '''Take the next batch of objects from the scope.  Stop short of
+        the batch size if the scope runs dry, or if the flush timeout has
+        elapsed since the first object of the batch was at hand.  With a
+        result cache, take up to cache_lookahead further objects that are
+        ready without waiting whenever the objects already taken cannot
+        fill a batch, and prefetch the cache entries for all of the new
+        objects together.'''
+        config = self._state.config
+        if self._scope is None:
+            self._scope = _ScopeReader(self._state.scope,
+                                       config.batch_size +
+                                       config.cache_lookahead)
+        if len(self._lookahead) < config.batch_size:
+            timeout = config.batch_timeout / 1000.0
+            deadline = None
+            if self._lookahead:
+                deadline = time.time() + timeout
+            objs = []
+            while len(self._lookahead) + len(objs) < config.batch_size:
+                # Wait as long as it takes for the first object
+                wait = None
+                if deadline is not None:
+                    wait = max(0, deadline - time.time())
+                obj = self._scope.get(wait)
+                if obj is None:
+                    break
+                objs.append(obj)
+                if deadline is None:
+                    deadline = time.time() + timeout
+            if self._cache is not None and objs:
+                for _i in xrange(config.cache_lookahead):
+                    obj = self._scope.get(0)
+                    if obj is None:
+                        break
+                    objs.append(obj)
+            self._prefetch(objs)
+            self._lookahead.extend(objs)
+        count = min(config.batch_size, len(self._lookahead))
+        return [self._lookahead.popleft() for _i in xrange(count)]
 
     # We want to catch all exceptions
     # pylint: disable=broad-except
@@ -988,10 +2845,13 @@ class FilterStackRunner(threading.Thread):
         timer = Timer()
         first_seen = False
         try:
-            # ScopeListLoader properly handles interleaved access by
-            # multiple threads
-            for obj in self._state.scope:
-                accept = self.evaluate(obj)
+            while True:
+                objs = self._next_batch()
+                if not objs:
+                    break
+                accepts = self.evaluate_batch(objs)
+                if self._stack is not None:
+                    self._stack.note_evaluated(self._state, len(objs))
                 if not first_seen:
                     self._state.stats.update(
                         time_to_first_result=timer.elapsed,
@@ -999,9 +2859,208 @@ class FilterStackRunner(threading.Thread):
                         time_to_first_result_avg=timer.elapsed
                     )
                     first_seen = True
-                if accept:
-                    self._state.blast.send(obj)
+                for obj, accept in zip(objs, accepts):
+                    if accept:
+                        self._state.blast.send(obj)
+
+        except ConnectionFailure:
+            # Client closed blast connection.  Rather than just calling
+            # sys.exit(), signal the main thread to shut us down.
+            os.kill(os.getpid(), signal.SIGUSR1)
+        except Exception:
+            _log.exception('Worker thread exception')
+            os.kill(os.getpid(), signal.SIGUSR1)
+            # pylint: enable=broad-except
+        finally:
+            if self._threads is not None:
+                self._threads.close()
+
+
+class _PipelineItem(object):
+    '''An object in flight through a _FilterPipeline, together with its
+    cache state.  The runner-keyed mappings use the runners of the worker
+    that admitted the object to the pipeline.'''
+
+    def __init__(self, obj, runners, cache_keys):
+        self.obj = obj
+        self.runners = runners
+        self.timer = Timer()
+        self.cache_keys = cache_keys
+        self.cache_results = dict()
+        self.new_results = dict()
+
+
+class _PipelineStage(object):
+    '''A stage of a _FilterPipeline: the bounded queue of objects waiting
+    for one runner, and the count of upstream threads still feeding it.'''
+
+    def __init__(self, stats, threads, queue_size, producers):
+        # FilterStatistics, or None for the object fetcher
+        self.stats = stats
+        self.threads = threads
+        self.queue = Queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._producers = producers
+
+    def get(self):
+        '''Return the next item for this stage, or None at end of input.'''
+        item = self.queue.get()
+        if self.stats is not None:
+            depth = self.queue.qsize()
+            self.stats.update(queue_depth_avg=depth, queue_depth_max=depth)
+        return item
+
+    def producer_done(self):
+        '''Called by each upstream thread as it exits.  The last one marks
+        the end of input for each thread of this stage.'''
+        with self._lock:
+            self._producers -= 1
+            last = self._producers == 0
+        if last:
+            for _i in xrange(self.threads):
+                self.queue.put(None)
+
+
+class _FilterPipeline(object):
+    '''Pipeline-parallel execution of a filter stack.  The object fetcher
+    and each filter are stages with their own worker threads, connected by
+    bounded queues.  An object leaves the pipeline as soon as it is
+    dropped.'''
+
+    def __init__(self, stack, state, count):
+        self._state = state
+        self._lock = threading.Lock()
+        self._timer = Timer()
+        self._first_seen = False
+        config = state.config
+        # The fetcher stage reads from the scope rather than a queue
+        self.stages = [_PipelineStage(None, count, 0, 0)]
+        for filter in stack:
+            threads = max(1, config.filter_processes.get(filter.name, count))
+            self.stages.append(_PipelineStage(filter.stats, threads,
+                                              config.pipeline_queue,
+                                              self.stages[-1].threads))
+
+    def stalled(self, index, elapsed):
+        '''Record that stage index waited elapsed us for room downstream.'''
+        stats = self.stages[index].stats
+        if stats is not None:
+            stats.update(stall_us=elapsed)
+        self._state.stats.update(pipeline_stall_us=elapsed)
+
+    def note_result(self):
+        '''Record that an object has left the pipeline.'''
+        with self._lock:
+            if self._first_seen:
+                return
+            self._first_seen = True
+        elapsed = self._timer.elapsed
+        self._state.stats.update(
+            time_to_first_result=elapsed,
+            time_to_first_result_max=elapsed,
+            time_to_first_result_avg=elapsed
+        )
+
+
+class _PipelineWorker(FilterStackRunner):
+    '''A worker thread running one stage of a _FilterPipeline.'''
+
+    def __init__(self, state, filter_runners, name, cleanup, pipeline,
+                 index):
+        FilterStackRunner.__init__(self, state, filter_runners, name,
+                                   cleanup)
+        self._pipeline = pipeline
+        self._index = index
 
+    def _items(self):
+        '''Yield the items for our stage until the end of input.'''
+        if self._index == 0:
+            # ScopeListLoader properly handles interleaved access by
+            # multiple threads
+            for obj in self._state.scope:
+                yield _PipelineItem(obj, self._runners,
+                                    self._result_keys(obj))
+        else:
+            stage = self._pipeline.stages[self._index]
+            while True:
+                item = stage.get()
+                if item is None:
+                    return
+                yield item
+
+    def _process(self, item):
+        '''Run our runner on the item or load its prior result into the
+        object.  Return True if the object passes.'''
+        obj = item.obj
+        runner = self._runners[self._index]
+        # The runner that keys the item's cache state
+        key = item.runners[self._index]
+        if self._index == 0:
+            item.cache_results = self._cache_lookup(obj, item.cache_keys)
+            if self._result_cache_can_drop(obj, item.cache_results):
+                return False
+        cached = item.cache_results.get(key)
+        if (cached is not None and
+                self._attribute_cache_try_load(runner, obj, cached)):
+            result = cached
+        else:
+            try:
+                result = runner.evaluate(obj)
+            except _DropObject:
+                return False
+            item.new_results[key] = result
+        if not runner.threshold(result):
+            # Drop decision.
+            return False
+        elif runner.send_score:
+            # Store the filter score in the object.  This attribute is not
+            # cached because that would be redundant.
+            obj[ATTR_FILTER_SCORE % runner] = str(result.score) + '\0'
+        if self._index == 0 and self._content_keys:
+            # The object's content is now known
+            return bool(self._content_lookup(
+                [obj], [0], [item.cache_keys], [item.cache_results]))
+        return True
+
+    def _finish(self, item, accept):
+        '''Take the item out of the pipeline.'''
+        obj = item.obj
+        # Our resolution plan knows our own runners, which are in the same
+        # declared order as those keying the item
+        ours = dict(zip(item.runners, self._runners))
+        cache_keys = dict((ours[r], key)
+                          for r, key in item.cache_keys.iteritems())
+        new_results = dict((ours[r], result)
+                           for r, result in item.new_results.iteritems())
+        try:
+            self._cache_update([obj], [cache_keys], [new_results])
+        finally:
+            # Filters are done with any shared copies of attribute values
+            obj.release()
+            self._state.stats.update('objs_processed',
+                                     execution_us=item.timer.elapsed,
+                                     objs_passed=int(accept),
+                                     objs_dropped=int(not accept))
+        self._pipeline.note_result()
+        if accept:
+            self._state.blast.send(obj)
+
+    # We want to catch all exceptions
+    # pylint: disable=broad-except
+    def run(self):
+        '''Thread function.'''
+        stages = self._pipeline.stages
+        last = self._index == len(stages) - 1
+        try:
+            self._ensure_cache()
+            for item in self._items():
+                passed = self._process(item)
+                if passed and not last:
+                    timer = Timer()
+                    stages[self._index + 1].queue.put(item)
+                    self._pipeline.stalled(self._index, timer.elapsed)
+                else:
+                    self._finish(item, passed)
         except ConnectionFailure:
             # Client closed blast connection.  Rather than just calling
             # sys.exit(), signal the main thread to shut us down.
@@ -1010,6 +3069,9 @@ class FilterStackRunner(threading.Thread):
             _log.exception('Worker thread exception')
             os.kill(os.getpid(), signal.SIGUSR1)
             # pylint: enable=broad-except
+        finally:
+            if not last:
+                stages[self._index + 1].producer_done()
 
 
 class Reference(object):
@@ -1033,9 +3095,14 @@ class FilterStack(object):
         self._filters = dict([(f.name, f) for f in filters])
         # Ordered list of filters to execute
         self._order = list()
-
-        # If you are going to add some smartness of "filter ordering",
-        # work here.
+        # Current execution order, adapted at runtime from filter
+        # statistics.  Replaced, never modified in place.
+        self._live_order = None
+        self._lock = threading.Lock()
+        self._since_reorder = 0
+        # Filter -> _FilterPool, created on first bind()
+        self._pools = None
+        self._prewarmed = False
 
         # Resolve declared dependencies
         # Filters we have already resolved
@@ -1061,6 +3128,106 @@ class FilterStack(object):
 
         for filter in filters:
             resolve(filter)
+        self._set_order(self._order)
+
+    def _set_order(self, order):
+        self._live_order = order
+        for i, filter in enumerate(order):
+            filter.stats.set_position(i + 1)
+
+    @staticmethod
+    def _prior(filters):
+        '''Return the average execution time and fraction of objects
+        dropped over the filters with enough samples to rank, or None if
+        there are none.'''
+        processed = dropped = computed = execution_us = 0
+        for filter in filters:
+            stats = filter.stats
+            if stats.objs_processed >= REORDER_MIN_SAMPLES:
+                processed += stats.objs_processed
+                dropped += stats.objs_dropped
+                computed += stats.objs_computed
+                execution_us += stats.execution_us
+        if not processed:
+            return None
+        try:
+            cost = float(execution_us) / computed
+        except ZeroDivisionError:
+            cost = 0
+        return cost, float(dropped) / processed
+
+    @staticmethod
+    def _rank(filter, prior):
+        '''Return the sort key of a filter for adaptive ordering: its
+        average execution time divided by the fraction of objects it drops.
+        Running filters in increasing order of rank minimizes the expected
+        time to drop an object when filters drop independently.  A filter
+        with fewer than REORDER_MIN_SAMPLES objects is ranked as if the
+        missing samples had the prior, a (cost, drop ratio) pair, so that
+        a filter rarely reached stays put rather than jumping ahead on
+        little evidence.'''
+        stats = filter.stats
+        processed = stats.objs_processed
+        computed = stats.objs_computed
+        execution_us = stats.execution_us
+        dropped = stats.objs_dropped
+        if processed < REORDER_MIN_SAMPLES:
+            if prior is None:
+                return 0
+            missing = REORDER_MIN_SAMPLES - processed
+            prior_cost, prior_drop_ratio = prior
+            processed += missing
+            computed += missing
+            execution_us += prior_cost * missing
+            dropped += prior_drop_ratio * missing
+        drop_ratio = float(dropped) / processed
+        if drop_ratio == 0:
+            return float('inf')
+        try:
+            cost = float(execution_us) / computed
+        except ZeroDivisionError:
+            # Every result came from the cache
+            cost = 0
+        return cost / drop_ratio
+
+    def _reorder(self, search_stats):
+        '''Recompute the execution order from the filter statistics.  At
+        each step, run the lowest-ranked filter whose dependencies have
+        already run; ties keep the current order.'''
+        prior = self._prior(self._live_order)
+        ranks = dict((f, self._rank(f, prior)) for f in self._live_order)
+        remaining = list(self._live_order)
+        done = set()
+        order = []
+        while remaining:
+            ready = [f for f in remaining
+                     if all(self._filters[d] in done for d in f.dependencies)]
+            filter = min(ready, key=lambda f: ranks[f])
+            remaining.remove(filter)
+            done.add(filter)
+            order.append(filter)
+        if order != self._live_order:
+            _log.info('Filter order: %s', ', '.join(f.name for f in order))
+            self._set_order(order)
+            search_stats.update('filter_order_changes')
+
+    def execution_order(self):
+        '''Return the list of filters in the order they should currently
+        be executed.'''
+        with self._lock:
+            return self._live_order
+
+    def note_evaluated(self, state, count):
+        '''Note that count more objects have been evaluated, and adapt the
+        execution order every reorder_interval objects.'''
+        interval = state.config.reorder_interval
+        if not interval:
+            return
+        with self._lock:
+            self._since_reorder += count
+            if self._since_reorder >= interval:
+                self._since_reorder = 0
+                self._reorder(state.stats)
 
     def __len__(self):
         return len(self._order)
@@ -1068,15 +3235,119 @@ class FilterStack(object):
     def __iter__(self):
         return iter(self._order)
 
-    def bind(self, state, name='Filter', cleanup=None):
+    def _pool_limit(self, state, filter):
+        '''Return the maximum number of processes for the filter.  Unless
+        configured, this is a single process until the filter's cost has
+        been measured, and then the filter's share of the worker threads in
+        proportion to the time spent in it so far, since that is how many
+        threads will on average be waiting for it.'''
+        try:
+            return max(1, state.config.filter_processes[filter.name])
+        except KeyError:
+            pass
+        if filter.stats.objs_computed < REORDER_MIN_SAMPLES:
+            return 1
+        total = sum(f.stats.execution_us for f in self._order)
+        if not total:
+            return 1
+        share = float(filter.stats.execution_us) / total
+        return max(1, int(math.ceil(state.config.threads * share)))
+
+    def _get_pools(self, state):
+        with self._lock:
+            if self._pools is None:
+                self._pools = dict(
+                    (f, _FilterPool(f, partial(self._pool_limit, state, f),
+                                    state.filter_cache))
+                    for f in self._order)
+            return self._pools
+
+    def close(self):
+        '''Close idle filter connections at the end of the search.'''
+        with self._lock:
+            pools = self._pools or {}
+        for pool in pools.values():
+            pool.close()
+
+    def prewarm(self, state):
+        '''Begin starting and initializing filter processes in background
+        threads, so that the worker threads find them ready: one per filter,
+        or as many as configured for it.  Pools grow on demand from there.
+        Filters must already be resolved.'''
+        if not state.config.prewarm:
+            return
+        with self._lock:
+            if self._prewarmed:
+                return
+            self._prewarmed = True
+        pools = self._get_pools(state)
+        for filter in self._order:
+            runner = filter.bind(state, pools[filter])
+            count = max(1, state.config.filter_processes.get(filter.name, 1))
+            if (state.config.filter_fork and
+                    os.path.exists(_fork_hint(state, filter))):
+                # The filter offered to fork copies of itself last time.
+                # Start the rest once the first has initialized, so
+                # they can be forked from it.
+                pools[filter].expect_template()
+                target = partial(self._prewarm_forkable, runner,
+                                 pools[filter], count)
+                count = 1
+            else:
+                target = runner.prewarm
+            for _i in xrange(count):
+                thread = threading.Thread(target=target,
+                                          name='Prewarm-%s' % filter.name)
+                thread.setDaemon(True)
+                thread.start()
+
+    @staticmethod
+    def _prewarm_forkable(runner, pool, count):
+        try:
+            runner.prewarm()
+        finally:
+            pool.expect_template(False)
+        for _i in xrange(count - 1):
+            thread = threading.Thread(target=runner.prewarm,
+                                      name=threading.current_thread().name)
+            thread.setDaemon(True)
+            thread.start()
+
+    def _bind_runners(self, state, fetcher=None):
+        '''Return the object fetcher, a new one unless specified, followed
+        by a runner for each filter, in declared order.'''
+        if fetcher is None:
+            fetcher = _ObjectFetcher(state)
+        pools = self._get_pools(state)
+        return [fetcher] + [f.bind(state, pools[f]) for f in self._order]
+
+    def bind(self, state, name='Filter', cleanup=None, scope=None):
         '''Return a FilterStackRunner that can be used to process objects
         with this filter stack.'''
-        fetcher = _ObjectFetcher(state)
-        runners = [fetcher] + [f.bind(state) for f in self._order]
-        return FilterStackRunner(state, runners, name, cleanup)
+        return FilterStackRunner(state, self._bind_runners(state), name,
+                                 cleanup, self, scope)
 
     def start_threads(self, state, count):
-        '''Start count threads to process objects with this filter stack.'''
+        '''Start count threads to process objects with this filter stack.
+        In pipeline mode, count is the number of object fetcher threads,
+        and each filter stage gets its own threads.'''
         cleanup = Reference(state.blast.close)
-        for i in xrange(count):
-            self.bind(state, 'Filter-%d' % i, cleanup).start()
+        if state.config.execution_mode == 'pipeline':
+            pipeline = _FilterPipeline(self, state, count)
+            # Only the first stage loads objects.  Later stages never run
+            # their object fetcher, so they share one from the first stage,
+            # which keys the fetcher's results.
+            fetcher = None
+            for index, stage in enumerate(pipeline.stages):
+                for i in xrange(stage.threads):
+                    runners = self._bind_runners(state, fetcher)
+                    _PipelineWorker(state, runners,
+                                    'Stage-%d-%d' % (index, i), cleanup,
+                                    pipeline, index).start()
+                fetcher = runners[0]
+        else:
+            config = state.config
+            scope = _ScopeReader(state.scope,
+                                 config.batch_size + config.cache_lookahead)
+            for i in xrange(count):
+                self.bind(state, 'Filter-%d' % i, cleanup, scope).start()
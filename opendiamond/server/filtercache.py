@@ -0,0 +1,491 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+'''Reuse of initialized filter processes across searches.
+
+Starting a filter and running its initializer can take far longer than
+evaluating an object, and consecutive searches often run the same filters
+with the same arguments.  The supervisor therefore keeps idle filter
+processes, keyed by the filter's cache digest (code, name, arguments and
+blob argument), which search processes lease instead of starting filters
+of their own.
+
+The supervisor starts the cached processes, so search processes inherit
+their pipes when they are forked.  Each new process is driven through its
+initialization by a short-lived helper process forked from the
+supervisor, which answers initialization commands the way a search would.
+(The supervisor itself runs no threads, since a search forked while one
+held a lock would inherit the lock held forever.)  Search and supervisor
+coordinate through files in a private directory:
+
+    <digest>-<pid>.lock     flock()ed by whoever holds the process
+    <digest>-<pid>.state    JSON connection state; absent until the
+                            process has finished initializing
+    <digest>-<pid>.log      JSON list of messages the filter logged
+                            during initialization, for the supervisor
+    requests/<digest>       a filter that a search had to start itself
+    work/<random>/          the TMPDIR and working directory of one
+                            process
+
+Files a search leaves in the working directory are removed when its lease
+ends, so that each lease starts with the directory as initialization
+left it.
+
+A lease marks the process dirty.  A search that ends a lease between
+objects marks it clean again, along with the state of the connection.
+The supervisor kills processes that are dirty when not leased (because
+the filter failed, or the search exited while using it), processes idle
+for longer than the configured TTL, and the least recently used idle
+processes while the cache exceeds its memory limit.
+
+Search processes only see processes started before they were forked.
+When a search has to start a filter itself, it asks the supervisor to
+start one for later searches.
+'''
+
+import fcntl
+import logging
+import os
+import shutil
+import signal
+import subprocess
+from tempfile import mkdtemp
+import time
+
+import simplejson as json
+
+from opendiamond.blobcache import ExecutableBlobCache
+from opendiamond.framing import (
+    PROTOCOL_ENV, PROTOCOL_VERSION, SHARED_MEMORY_ENV)
+from opendiamond.server.child import CGROUP_TASKS_ENV
+from opendiamond.server.filter import _FilterConnection, FilterExecutionError
+
+_log = logging.getLogger(__name__)
+
+
+def _write_json(path, value):
+    '''Atomically replace the file at path with the JSON encoding of
+    value.  Avoids the tempfile module, whose locks are not safe to hold
+    across fork().'''
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump(value, fh)
+    os.rename(tmp, path)
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, True)
+    else:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _read_json(path):
+    '''Return the decoded contents of the file at path, or None if it is
+    missing or unreadable.'''
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+class _Lease(object):
+    '''A cached filter process leased to the current search process.'''
+
+    def __init__(self, entry, lockfd, state):
+        self.pid = entry.pid
+        # Our ends of the filter's pipes, inherited from the supervisor
+        self.fin = entry.fin
+        self.fout = entry.fout
+        # Connection state recorded when the process was last idle
+        self.state = state
+        self._entry = entry
+        self._lockfd = lockfd
+        # Contents of the working directory when the lease began
+        self._workfiles = set(_listdir(entry.workdir))
+
+    def end(self, state=None):
+        '''Give the process back.  If state is None, the process is not
+        reusable and the supervisor will kill it.'''
+        if self._lockfd is None:
+            return
+        for name in set(_listdir(self._entry.workdir)) - self._workfiles:
+            _remove_path(os.path.join(self._entry.workdir, name))
+        try:
+            if state is not None:
+                _write_json(self._entry.state_path, dict(state, clean=True))
+        except (IOError, OSError):
+            pass
+        os.close(self._lockfd)
+        self._lockfd = None
+
+
+class _CachedProcess(object):
+    '''A filter process started by the supervisor.'''
+
+    def __init__(self, basedir, digest, proc, workdir):
+        self.digest = digest
+        self.pid = proc.pid
+        self.fin = proc.stdout.fileno()
+        self.fout = proc.stdin.fileno()
+        self.workdir = workdir
+        base = os.path.join(basedir, '%s-%d' % (digest, proc.pid))
+        self.lock_path = base + '.lock'
+        self.state_path = base + '.state'
+        self.log_path = base + '.log'
+        open(self.lock_path, 'w').close()
+        self._proc = proc
+
+    def lock(self):
+        '''Try to lock the process.  Return the fd holding the lock, or
+        None if someone else holds it or the process has been removed.'''
+        try:
+            fd = os.open(self.lock_path, os.O_RDWR)
+        except OSError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def state(self):
+        '''Return the connection state, or None if the process has not
+        finished initializing.'''
+        return _read_json(self.state_path)
+
+    def last_used(self):
+        try:
+            return os.stat(self.state_path).st_mtime
+        except OSError:
+            return 0
+
+    def exited(self):
+        return self._proc.poll() is not None
+
+    def rss(self):
+        '''Return the resident set size of the process in bytes.'''
+        try:
+            with open('/proc/%d/statm' % self.pid) as fh:
+                pages = int(fh.read().split()[1])
+            return pages * os.sysconf('SC_PAGE_SIZE')
+        except (IOError, OSError, ValueError, IndexError):
+            return 0
+
+    def lease(self):
+        '''Lease the process to the current search process.  Return a
+        _Lease, or None if the process is busy or not reusable.'''
+        fd = self.lock()
+        if fd is None:
+            return None
+        try:
+            state = self.state()
+            if state is None or not state.get('clean'):
+                os.close(fd)
+                return None
+            _write_json(self.state_path, dict(state, clean=False))
+        except (IOError, OSError):
+            os.close(fd)
+            return None
+        # Account for the process in our cgroup while we use it
+        tasks = os.environ.get(CGROUP_TASKS_ENV)
+        if tasks is not None:
+            try:
+                with open(tasks, 'w') as fh:
+                    fh.write('%d\n' % self.pid)
+            except IOError:
+                pass
+        return _Lease(self, fd, state)
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        for fh in self._proc.stdin, self._proc.stdout:
+            try:
+                fh.close()
+            except IOError:
+                pass
+        try:
+            self._proc.wait()
+        except OSError:
+            pass
+        for path in self.lock_path, self.state_path, self.log_path:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        shutil.rmtree(self.workdir, True)
+
+
+class FilterProcessCache(object):
+    '''Idle filter processes kept by the supervisor for reuse by later
+    searches.'''
+
+    def __init__(self, config):
+        self._config = config
+        self._limit = config.filter_cache_mb << 20
+        self._ttl = config.filter_cache_ttl
+        self._dir = mkdtemp(prefix='diamond-filters-')
+        self._requests = os.path.join(self._dir, 'requests')
+        self._workdir = os.path.join(self._dir, 'work')
+        os.mkdir(self._requests)
+        os.mkdir(self._workdir)
+        self._blob_cache = ExecutableBlobCache(config.cachedir, self._dir)
+        # digest => [_CachedProcess]
+        self._entries = {}
+        # PID of initialization helper => _CachedProcess
+        self._helpers = {}
+
+    def _all(self):
+        return [e for entries in self._entries.values() for e in entries]
+
+    def lease(self, digest):
+        '''Called in a search process.  Return a _Lease on an idle,
+        initialized process for the filter with the specified cache
+        digest, or None.'''
+        for entry in self._entries.get(digest, ()):
+            lease = entry.lease()
+            if lease is not None:
+                return lease
+        return None
+
+    def request(self, filter, count):
+        '''Called in a search process that had to start a process for
+        filter, which is a resolved Filter.  Ask the supervisor to keep up
+        to count processes for the filter.'''
+        path = os.path.join(self._requests, filter.cache_digest)
+        try:
+            _write_json(path, {
+                'name': filter.name,
+                'code': filter.signature,
+                'args': filter.arguments,
+                'blob': filter.blob_signature,
+                'count': count,
+            })
+        except (IOError, OSError):
+            pass
+
+    def reusable_pids(self):
+        '''Return the PIDs of processes that were left in a reusable
+        state.'''
+        pids = []
+        for entry in self._all():
+            state = entry.state()
+            if state is not None and state.get('clean'):
+                pids.append(entry.pid)
+        return pids
+
+    def service(self):
+        '''Start requested processes and kill unusable or expired ones.
+        Called periodically by the supervisor.'''
+        self._reap_helpers()
+        for digest in os.listdir(self._requests):
+            path = os.path.join(self._requests, digest)
+            request = _read_json(path)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            if request is not None:
+                self._start(digest, request)
+        self._expire()
+
+    def _start(self, digest, request):
+        entries = self._entries.setdefault(digest, [])
+        for _i in xrange(len(entries), request['count']):
+            try:
+                code_path = self._blob_cache.executable_path(request['code'])
+                blob = self._blob_cache[request['blob']]
+            except KeyError:
+                return
+            workdir = mkdtemp(dir=self._workdir)
+            env = dict(os.environ)
+            env['TMPDIR'] = workdir
+            env[PROTOCOL_ENV] = str(self._config.filter_protocol)
+            if self._config.shm_threshold:
+                env[SHARED_MEMORY_ENV] = '1'
+            try:
+                # Our own reads are unbuffered, so that nothing the
+                # filter sends after initialization is lost to a search
+                proc = subprocess.Popen(
+                    [code_path, '--filter'],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    close_fds=True, cwd=workdir, env=env)
+            except OSError, e:
+                _log.warning('Could not start cached filter %s: %s',
+                             request['name'], e)
+                shutil.rmtree(workdir, True)
+                return
+            entry = _CachedProcess(self._dir, digest, proc, workdir)
+            entries.append(entry)
+            try:
+                helper = os.fork()
+            except OSError, e:
+                _log.warning('Could not initialize cached filter %s: %s',
+                             request['name'], e)
+                self._remove(entry)
+                return
+            if helper == 0:
+                # The helper must never return
+                try:
+                    self._initialize(entry, proc, request['name'],
+                                     request['args'], blob)
+                finally:
+                    os._exit(0)
+            self._helpers[helper] = entry
+            _log.info('Started cached filter %s, pid %d', request['name'],
+                      proc.pid)
+
+    def _reap_helpers(self):
+        '''Collect exited initialization helpers and log the messages
+        they left.'''
+        for helper, entry in self._helpers.items():
+            try:
+                pid, _status = os.waitpid(helper, os.WNOHANG)
+            except OSError:
+                pid = helper
+            if pid == 0:
+                continue
+            del self._helpers[helper]
+            for message in _read_json(entry.log_path) or []:
+                _log.info('Cached filter %s: %s', entry.pid, message)
+            try:
+                os.unlink(entry.log_path)
+            except OSError:
+                pass
+            if (entry.state() is None and
+                    entry in self._entries.get(entry.digest, ())):
+                # The helper died without recording the outcome
+                _log.info('Killing uninitialized cached filter, pid %d',
+                          entry.pid)
+                self._remove(entry)
+
+    def _initialize(self, entry, proc, name, args, blob):
+        '''Drive a new filter process through initialization, recording
+        the resulting connection state.  Runs in a helper process.'''
+        # Messages logged by the filter, left for the supervisor to log
+        messages = []
+        try:
+            conn = _FilterConnection(proc.stdout, proc.stdin, name, args,
+                                     blob)
+            while True:
+                cmd = conn.get_tag()
+                if cmd == 'init-success':
+                    break
+                elif cmd == 'set-protocol':
+                    version = int(conn.get_item())
+                    if (version == PROTOCOL_VERSION and
+                            version <= self._config.filter_protocol):
+                        conn.send(True)
+                        conn.upgrade()
+                    else:
+                        conn.send(False)
+                elif cmd == 'declare-attributes':
+                    conn.push_mapped = conn.get_item() == 'map'
+                    conn.push_attrs = conn.get_array()
+                elif cmd == 'declare-batch':
+                    conn.batch = True
+                elif cmd == 'log':
+                    conn.get_item()
+                    messages.append(conn.get_item())
+                elif cmd == 'stdout':
+                    conn.get_item()
+                else:
+                    raise IOError('unexpected command "%s"' % cmd)
+            state = {
+                'clean': True,
+                'protocol': conn.protocol_version,
+                'push_attrs': conn.push_attrs,
+                'push_mapped': conn.push_mapped,
+                'batch': conn.batch,
+            }
+        except (IOError, ValueError, FilterExecutionError), e:
+            messages.append('initialization failed: %s' % e)
+            state = {'clean': False}
+        try:
+            if messages:
+                _write_json(entry.log_path, messages)
+            _write_json(entry.state_path, state)
+        except (IOError, OSError):
+            pass
+
+    def _remove(self, entry):
+        entry.kill()
+        entries = self._entries[entry.digest]
+        entries.remove(entry)
+        if not entries:
+            del self._entries[entry.digest]
+
+    def _expire(self):
+        now = time.time()
+        # Locked idle processes, as (last used, entry, lock fd)
+        idle = []
+        try:
+            for entry in self._all():
+                state = entry.state()
+                if state is None:
+                    # Still initializing
+                    if entry.exited():
+                        self._remove(entry)
+                    continue
+                fd = entry.lock()
+                if fd is None:
+                    # Leased
+                    continue
+                # Reread now that nobody else can change it
+                state = entry.state()
+                if (state is None or not state.get('clean') or
+                        entry.exited()):
+                    _log.info('Killing unusable cached filter, pid %d',
+                              entry.pid)
+                    self._remove(entry)
+                    os.close(fd)
+                elif now - entry.last_used() > self._ttl:
+                    _log.info('Killing expired cached filter, pid %d',
+                              entry.pid)
+                    self._remove(entry)
+                    os.close(fd)
+                else:
+                    idle.append((entry.last_used(), entry, fd))
+            # Evict least recently used processes until under the limit
+            total = sum(entry.rss() for entry in self._all())
+            idle.sort(key=lambda item: item[0])
+            for _used, entry, _fd in idle:
+                if total <= self._limit:
+                    break
+                _log.info('Evicting cached filter, pid %d', entry.pid)
+                total -= entry.rss()
+                self._remove(entry)
+        finally:
+            for _used, _entry, fd in idle:
+                os.close(fd)
+
+    def shutdown(self):
+        '''Kill all cached processes and remove our files.'''
+        for entry in self._all():
+            entry.kill()
+        self._entries = {}
+        shutil.rmtree(self._dir, True)
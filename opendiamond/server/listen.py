@@ -126,12 +126,15 @@ class _PendingConnPollSet(object):
         self._pollset.unregister(fd)
         del self._fd_to_pconn[fd]
 
-    def poll(self):
+    def poll(self, timeout=None):
         '''Poll for events and return a list of (pconn, eventmask) pairs.
-        pconn will be None for events on the listening socket.'''
+        pconn will be None for events on the listening socket.  If timeout
+        (in seconds) is specified, the list may be empty.'''
+        if timeout is not None:
+            timeout = int(timeout * 1000)
         while True:
             try:
-                items = self._pollset.poll()
+                items = self._pollset.poll(timeout)
             except select.error, e:
                 # If poll() was interrupted by a signal, retry.  If the
                 # signal was supposed to be fatal, the signal handler would
@@ -242,10 +245,15 @@ class ConnListener(object):
             self._poll.unregister(pconn)
         return None
 
-    def accept(self):
-        '''Returns a new (control, data) connection pair.'''
+    def accept(self, timeout=None):
+        '''Returns a new (control, data) connection pair.  If timeout (in
+        seconds) is specified, returns None if there is no new pair before
+        it expires.'''
         while True:
-            for pconn, _flags in self._poll.poll():
+            events = self._poll.poll(timeout)
+            if not events:
+                return None
+            for pconn, _flags in events:
                 if hasattr(pconn, 'accept'):
                     # Listening socket
                     self._accept(pconn)
@@ -13,6 +13,10 @@
 '''Representations of a Diamond object.'''
 
 from cStringIO import StringIO
+import mmap
+import os
+from tempfile import mkstemp
+import threading
 from urlparse import urljoin
 import simplejson as json
 
@@ -38,6 +42,38 @@ class ObjectLoadError(Exception):
     '''Object failed to load.'''
 
 
+class _SharedAttributes(object):
+    '''A file, ideally on tmpfs, holding copies of large attribute values
+    so that filter processes can map them read-only rather than receiving
+    a copy over their pipes.  Each value is stored at an offset aligned to
+    the mmap granularity so that it can be mapped on its own.'''
+
+    def __init__(self, dirname):
+        fd, self.path = mkstemp(prefix='diamond-attrs-', dir=dirname)
+        self._file = os.fdopen(fd, 'wb')
+        self._size = 0
+        self._regions = dict()  # signature -> (offset, length)
+
+    def add(self, value, signature):
+        '''Return (offset, length) of the value, storing it if necessary.'''
+        if signature not in self._regions:
+            offset = self._size + (-self._size % mmap.ALLOCATIONGRANULARITY)
+            self._file.seek(offset)
+            self._file.write(value)
+            self._file.flush()
+            self._size = offset + len(value)
+            self._regions[signature] = (offset, len(value))
+        return self._regions[signature]
+
+    def close(self):
+        '''Delete the file.  Filters may retain existing mappings.'''
+        self._file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
 class EmptyObject(object):
     '''An immutable Diamond object with no data and no attributes.'''
 
@@ -114,6 +150,13 @@ class Object(EmptyObject):
     def __init__(self, server_id, url):
         EmptyObject.__init__(self)
         self._id = url
+        # Shared memory handoff of large attribute values, if enabled
+        self._shm_dir = None
+        self._shm_threshold = 0
+        self._shm = None
+        # Number of release() calls to ignore; see hold()
+        self._shm_holds = 0
+        self._shm_lock = threading.Lock()
 
         # Set default attributes
         self[ATTR_DEVICE_NAME] = server_id + '\0'
@@ -130,6 +173,40 @@ class Object(EmptyObject):
         self._attrs[key] = value
         self._signatures[key] = murmur(value)
 
+    def enable_sharing(self, dirname, threshold):
+        '''Allow attribute values of at least threshold bytes to be handed
+        to filters via a shared memory file created in dirname.'''
+        self._shm_dir = dirname
+        self._shm_threshold = threshold
+
+    def get_shared(self, key):
+        '''Return a (path, offset, length) handle to a shared copy of the
+        attribute value, or None if the value should be sent inline.'''
+        if (not self._shm_threshold or
+                len(self._attrs[key]) < self._shm_threshold):
+            return None
+        if self._shm is None:
+            self._shm = _SharedAttributes(self._shm_dir)
+        offset, length = self._shm.add(self._attrs[key],
+                                       self._signatures[key])
+        return (self._shm.path, offset, length)
+
+    def hold(self):
+        '''Keep shared memory for this object until release() has been
+        called once more, e.g. by a thread still evaluating the object.'''
+        with self._shm_lock:
+            self._shm_holds += 1
+
+    def release(self):
+        '''Release shared memory held for this object, unless it is
+        still held.'''
+        with self._shm_lock:
+            if self._shm_holds:
+                self._shm_holds -= 1
+            elif self._shm is not None:
+                self._shm.close()
+                self._shm = None
+
 
 class _HttpLoader(object):
     '''A context for loading Object data via HTTP.  Caches and reuses HTTP
@@ -184,6 +261,8 @@ class ObjectLoader(object):
     def __init__(self, config, blob_cache):
         self._http = _HttpLoader(config)
         self._blob_cache = blob_cache
+        self._shm_dir = config.shm_dir or os.getenv('TMPDIR')
+        self._shm_threshold = config.shm_threshold
 
     def source_available(self, obj):
         '''Examine the Object and return whether we think we will be able
@@ -208,6 +287,11 @@ class ObjectLoader(object):
         # Set display name if not already in initial attributes
         if ATTR_DISPLAY_NAME not in obj:
             obj[ATTR_DISPLAY_NAME] = uri + '\0'
+        # Place large initial attributes in shared memory for the filters
+        if self._shm_threshold:
+            obj.enable_sharing(self._shm_dir, self._shm_threshold)
+            for key in obj:
+                obj.get_shared(key)
 
     def _load_blobcache(self, obj, signature):
         # Load the object data
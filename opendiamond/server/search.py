@@ -22,8 +22,12 @@ from opendiamond.protocol import (
     DiamondRPCSchemeNotSupported)
 from opendiamond.rpc import RPCHandlers, RPCError, RPCProcedureUnavailable
 from opendiamond.scope import ScopeCookie, ScopeError, ScopeCookieExpired
+from opendiamond.server.cache import (
+    AdmissionPolicy, AttributeNames, CacheError, CacheWriter, MemoryCache,
+    ScoreIndex, SCORE_MEMBER_SIZE, caching_enabled, connect)
 from opendiamond.server.filter import (
-    FilterStack, Filter, FilterDependencyError, FilterUnsupportedSource)
+    FilterStack, Filter, FilterDependencyError, FilterUnsupportedMode,
+    FilterUnsupportedSource)
 from opendiamond.server.object_ import EmptyObject, Object, ObjectLoader
 from opendiamond.server.scopelist import ScopeListLoader
 from opendiamond.server.sessionvars import SessionVariables
@@ -35,11 +39,37 @@ _log = logging.getLogger(__name__)
 
 class SearchState(object):
     '''Search state that is also needed by filter code.'''
-    def __init__(self, config):
+    def __init__(self, config, filter_cache=None):
         self.config = config
         self.blob_cache = ExecutableBlobCache(config.cachedir)
+        # The supervisor's FilterProcessCache, if enabled
+        self.filter_cache = filter_cache
         self.session_vars = SessionVariables()
         self.stats = SearchStatistics()
+        # In-memory caches of result entries and attribute values,
+        # attribute name tables for compact result entries, attribute cache
+        # admission policy, objects out of range in the score indexes, and
+        # background writer for cache updates, if enabled
+        self.result_memory = None
+        self.attribute_memory = None
+        self.attribute_names = None
+        self.admission = None
+        self.score_index = None
+        self.cache_writer = None
+        if caching_enabled(config):
+            self.attribute_names = AttributeNames()
+            self.admission = AdmissionPolicy(config.cache_admission_sketch)
+            if config.cache_score_index:
+                self.score_index = ScoreIndex(
+                    (config.cache_score_index_mb << 20) // SCORE_MEMBER_SIZE)
+            if config.memory_cache_result_mb:
+                self.result_memory = MemoryCache(
+                    config.memory_cache_result_mb << 20)
+            if config.memory_cache_attribute_mb:
+                self.attribute_memory = MemoryCache(
+                    config.memory_cache_attribute_mb << 20)
+            if config.cache_write_mb:
+                self.cache_writer = CacheWriter(config, self.stats)
         self.scope = None
         self.blast = None
         # TODO change to something session-dependent
@@ -52,16 +82,27 @@ class Search(RPCHandlers):
 
     log_rpcs = True
 
-    def __init__(self, config, blast_conn):
+    def __init__(self, config, blast_conn, filter_cache=None):
         RPCHandlers.__init__(self)
         self._server_id = config.serverids[0]  # Canonical server ID
         self._blast_conn = blast_conn
-        self._state = SearchState(config)
+        self._state = SearchState(config, filter_cache)
         self._filters = FilterStack()
         self._running = False
 
     def shutdown(self):
         '''Clean up the search before the process exits.'''
+        # Return reusable filter processes to the supervisor.  This takes
+        # a final sample of their resource usage, so do it first.
+        self._filters.close()
+        if self._state.cache_writer is not None:
+            self._state.cache_writer.close()
+        if self._running and self._state.admission is not None:
+            try:
+                self._state.admission.save(connect(self._state.config))
+            except CacheError, e:
+                _log.warning('Cannot save cache admission state: %s', e)
+
         # Log search statistics
         if self._running:
             self._state.stats.log()
@@ -100,6 +141,17 @@ class Search(RPCHandlers):
         except FilterDependencyError, e:
             raise DiamondRPCFCacheMiss(str(e))
 
+    def _prewarm(self):
+        '''Begin starting filter processes in the background if all filter
+        code and blob arguments are available.'''
+        try:
+            for filter in self._filters:
+                filter.resolve(self._state)
+        except (FilterDependencyError, FilterUnsupportedMode):
+            # start() will report the problem
+            return
+        self._filters.prewarm(self._state)
+
     @RPCHandlers.handler(25, protocol.XDR_setup, protocol.XDR_blob_list)
     @running(False)
     def setup(self, params):
@@ -169,8 +221,11 @@ class Search(RPCHandlers):
             raise DiamondRPCFailure()
 
         # Commit
+        self._filters.close()
         self._filters = filterstack
         self._state.scope = scope
+        if not missing:
+            self._prewarm()
         return protocol.XDR_blob_list(missing)
 
     @RPCHandlers.handler(26, protocol.XDR_blob_data)
@@ -181,6 +236,7 @@ class Search(RPCHandlers):
                   sum([len(b) for b in params.blobs]))
         for blob in params.blobs:
             self._state.blob_cache.add(blob)
+        self._prewarm()
 
     @RPCHandlers.handler(28, protocol.XDR_start)
     @running(False)
@@ -197,6 +253,14 @@ class Search(RPCHandlers):
             # Encode everything
             push_attrs = None
         self._state.blast = BlastChannel(self._blast_conn, push_attrs)
+        if self._state.admission is not None:
+            # Continue from the estimates of earlier searches
+            try:
+                self._state.admission.load(
+                    connect(self._state.config),
+                    [f.cache_digest for f in self._filters])
+            except CacheError, e:
+                _log.warning('Cannot load cache admission state: %s', e)
         self._running = True
         _log.info('Starting search %s', params.search_id)
         self._filters.start_threads(self._state, self._state.config.threads)
@@ -93,6 +93,18 @@ class _Avg(_AggregateInterface):
             return -1
 
 
+class _Last(_AggregateInterface):
+    def __init__(self):
+        super(_Last, self).__init__()
+        self._value = 0
+
+    def advance(self, value):
+        self._value = value
+
+    def finalize(self):
+        return self._value
+
+
 class _Statistics(object):
     '''Base class for server statistics.'''
 
@@ -140,6 +152,42 @@ class SearchStatistics(_Statistics):
         ('objs_dropped', 'Objects dropped', _Sum),
         ('objs_passed', 'Objects passed', _Sum),
         ('objs_unloadable', 'Objects failing to load', _Sum),
+        ('result_cache_lookups', 'Result cache lookups', _Sum),
+        ('result_cache_hits', 'Result cache entries found', _Sum),
+        ('attribute_cache_lookups', 'Attribute cache loads attempted', _Sum),
+        ('attribute_cache_hits', 'Attribute cache loads completed', _Sum),
+        ('result_cache_index_drops',
+         'Objects dropped by the score index', _Sum),
+        ('result_cache_server_drops',
+         'Objects dropped by the cache server from cached results', _Sum),
+        ('result_memory_lookups', 'In-memory result cache lookups', _Sum),
+        ('result_memory_hits', 'In-memory result cache hits', _Sum),
+        ('attribute_memory_lookups', 'In-memory attribute cache lookups',
+         _Sum),
+        ('attribute_memory_hits', 'In-memory attribute cache hits', _Sum),
+        ('attribute_bytes_cached', 'Attribute bytes written to the cache',
+         _Sum),
+        ('attribute_bytes_stored', 'Attribute bytes stored after compression',
+         _Sum),
+        ('cache_fetch_latency_us', 'Attribute cache fetch latency (us)',
+         _Last),
+        ('cache_fetch_us_per_mb', 'Attribute cache fetch time per MB (us)',
+         _Last),
+        ('cache_round_trips', 'Cache lookup round trips', _Sum),
+        ('cache_round_trips_saved', 'Cache round trips saved by prefetching',
+         _Sum),
+        ('cache_record_migrations',
+         'Result cache entries copied into object records', _Sum),
+        ('cache_writes_queued', 'Cache entries queued for writing', _Sum),
+        ('cache_writes_coalesced', 'Cache entries coalesced in the queue',
+         _Sum),
+        ('cache_writes_dropped', 'Cache entries dropped on queue overflow',
+         _Sum),
+        ('cache_writes_failed', 'Cache entries failing to write', _Sum),
+        ('cache_write_batches', 'Cache write batches', _Sum),
+        ('cache_write_queue_max', 'Cache write queue Max (bytes)', _Max),
+        ('filter_order_changes', 'Filter execution order changes', _Sum),
+        ('pipeline_stall_us', 'Total pipeline stall time (us)', _Sum),
         ('execution_us', 'Total object examination time (us)', _Sum),
         ('time_to_first_result', 'Time to first result Min (us)', _Min),
         ('time_to_first_result_max', 'Time to first result Max (us)', _Max),
@@ -157,6 +205,11 @@ class SearchStatistics(_Statistics):
             stats = []
             stats.append(XDR_stat('objs_total', objs_total))
             stats.append(XDR_stat('avg_obj_time_us', avg_obj_us))
+            for tier in 'result', 'attribute':
+                lookups = getattr(self, tier + '_memory_lookups')
+                hits = getattr(self, tier + '_memory_hits')
+                stats.append(XDR_stat(tier + '_memory_hit_pct',
+                                      100 * hits / lookups if lookups else 0))
             for name, _desc, _cls in self.attrs:
                 if name != 'execution_us':
                     stats.append(XDR_stat(name, getattr(self, name)))
@@ -177,15 +230,74 @@ class FilterStatistics(_Statistics):
              ('objs_computed', 'Objects examined by filter', _Sum),
              ('objs_terminate', 'Objects causing filter to terminate', _Sum),
              ('execution_us', 'Filter execution time (us)', _Sum),
+             ('attrs_cache_admitted', 'Objects with outputs cached', _Sum),
+             ('attrs_cache_rejected', 'Objects with outputs not cached',
+              _Sum),
+             ('cpu_user_us', 'Filter user CPU time (us)', _Sum),
+             ('cpu_system_us', 'Filter system CPU time (us)', _Sum),
+             ('peak_rss_kb', 'Filter process peak RSS Max (KB)', _Max),
              ('startup_us_avg', 'Startup time Avg (us)', _Avg),
              ('startup_us_min', 'Startup time Min (us)', _Min),
              ('startup_us_max', 'Startup time Max (us)', _Max),
+             ('prewarm_us_avg', 'Prewarmed startup time Avg (us)', _Avg),
+             ('prewarm_us_min', 'Prewarmed startup time Min (us)', _Min),
+             ('prewarm_us_max', 'Prewarmed startup time Max (us)', _Max),
+             ('procs_started', 'Filter processes started', _Sum),
+             ('procs_prewarmed', 'Filter processes prewarmed', _Sum),
+             ('procs_reused', 'Filter processes reused', _Sum),
+             ('procs_forked', 'Filter processes forked', _Sum),
+             ('procs_max', 'Concurrent filter processes Max', _Max),
+             ('order_position', 'Current execution position', _Last),
+             ('queue_depth_avg', 'Pipeline queue depth Avg', _Avg),
+             ('queue_depth_max', 'Pipeline queue depth Max', _Max),
+             ('stall_us', 'Pipeline stall time (us)', _Sum),
              )
 
     def __init__(self, name):
         _Statistics.__init__(self)
         self.name = name
         self.label = 'Filter statistics for %s' % name
+        # Execution position -> objects processed there, excluding those
+        # since the filter took its current position; the objects it had
+        # processed then
+        self._positions = dict()
+        self._position_start = 0
+
+    def set_position(self, position):
+        '''Record that the filter now executes at position, counting from
+        1, so that the objects processed at each position it has held are
+        reported.'''
+        with self._lock:
+            processed = self._stats['objs_processed'].finalize()
+            current = self._stats['order_position'].finalize()
+            if current == position:
+                return
+            if current:
+                self._positions[current] = (
+                    self._positions.get(current, 0) +
+                    processed - self._position_start)
+            self._position_start = processed
+            self._stats['order_position'].advance(position)
+
+    def log(self):
+        '''Dump all statistics to the log.'''
+        _Statistics.log(self)
+        with self._lock:
+            counts = self._position_counts()
+        for position, count in sorted(counts.iteritems()):
+            _log.info('  Objects processed at position %d: %d', position,
+                      count)
+
+    def _position_counts(self):
+        '''Return the position -> objects processed mapping.  Call with
+        the lock held.'''
+        counts = dict(self._positions)
+        current = self._stats['order_position'].finalize()
+        if current:
+            counts[current] = (counts.get(current, 0) +
+                               self._stats['objs_processed'].finalize() -
+                               self._position_start)
+        return counts
 
     def xdr(self):
         '''Return an XDR statistics structure for these statistics.'''
@@ -200,6 +312,10 @@ class FilterStatistics(_Statistics):
             for name, _desc, _cls in self.attrs:
                 if name != 'execution_us':
                     stats.append(XDR_stat(name, getattr(self, name)))
+            for position, count in sorted(
+                    self._position_counts().iteritems()):
+                stats.append(XDR_stat('objs_at_position_%d' % position,
+                                      count))
 
             return XDR_filter_stats(
                 name=self.name,
@@ -0,0 +1,120 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+import threading
+
+from opendiamond.helpers import murmur
+from opendiamond.server.cache import AttributeNames
+from opendiamond.server.filter import (FilterStackRunner, _FilterResult,
+                                       _ObjectProcessor)
+from opendiamond.server.statistics import SearchStatistics, Timer
+
+
+class _Config(object):
+    batch_size = 4
+    batch_timeout = 50
+    cache_lookahead = 16
+    cache_content_keys = 0
+    cache_server_resolution = 0
+    cache_score_index = 0
+    cache_object_records = 0
+    cache_result_format = 1
+
+
+class _State(object):
+    def __init__(self, scope):
+        self.config = _Config()
+        self.stats = SearchStatistics()
+        self.scope = scope
+        self.result_memory = self.attribute_memory = None
+        self.admission = None
+        self.attribute_names = AttributeNames()
+
+
+def _stalled_scope(resume):
+    yield 'first'
+    resume.wait()
+    for obj in 'second', 'third':
+        yield obj
+
+
+def test_batch_timeout_with_stalled_scope():
+    resume = threading.Event()
+    runner = FilterStackRunner(_State(_stalled_scope(resume)), [], 'Filter',
+                               None)
+    timer = Timer()
+    # The partial batch is flushed although the scope yields nothing more
+    assert runner._next_batch() == ['first']
+    assert timer.elapsed_seconds < 5
+    resume.set()
+    assert runner._next_batch() == ['second', 'third']
+    assert runner._next_batch() == []
+
+
+class _Runner(_ObjectProcessor):
+    def __init__(self, name, drop=False):
+        _ObjectProcessor.__init__(self)
+        self.name = name
+        self.drop = drop
+
+    def __str__(self):
+        return self.name
+
+    def _get_cache_digest(self):
+        return murmur(self.name)
+
+    def threshold(self, result):
+        return not self.drop
+
+
+class _Cache(object):
+    def __init__(self, entries):
+        self.entries = entries
+        self.calls = 0
+
+    def get_many(self, keys):
+        self.calls += 1
+        return [self.entries.get(key) for key in keys]
+
+    def shard(self, key):
+        return 0
+
+
+def _prefetch(drop):
+    fetcher, first = _Runner('fetcher'), _Runner('first', drop)
+    objs = ['obj%d' % i for i in range(4)]
+    entries = dict()
+    for obj in objs:
+        entries[fetcher.get_cache_key(obj)] = _FilterResult(
+            output_attrs={'': 'data-' + obj}).encode()
+        entries[first.get_cache_key(obj)] = _FilterResult(
+            {'': 'data-' + obj}, {'out': 'out-' + obj}).encode()
+        for sig in 'data-' + obj, 'out-' + obj:
+            entries['attribute:' + sig] = 'value'
+    runner = FilterStackRunner(_State(iter(objs)), [fetcher, first],
+                               'Filter', None)
+    runner._cache = _Cache(entries)
+    runner._prefetch(objs)
+    assert sorted(runner._prefetched) == objs
+    return runner._state.stats, runner._cache.calls
+
+
+def test_prefetch_round_trips():
+    # Looked up one at a time, each object takes a round trip for its
+    # results, and one per loaded result for its attribute values
+    stats, calls = _prefetch(drop=False)
+    assert calls == stats.cache_round_trips == 2
+    assert stats.cache_round_trips_saved == 4 + 4 * 2 - 2
+    # Dropped objects load no attribute values
+    stats, calls = _prefetch(drop=True)
+    assert calls == stats.cache_round_trips == 2
+    assert stats.cache_round_trips_saved == 4 - 2
@@ -0,0 +1,68 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+from opendiamond.helpers import murmur
+from opendiamond.server.cache import AdmissionPolicy
+
+
+def test_admission_learns_fetch_cost():
+    policy = AdmissionPolicy()
+    # Before any fetches, assume 2 MB/s
+    assert policy.admit('slow', 1.0, 1 << 20, [])
+    assert not policy.admit('fast', 0.1, 1 << 20, [])
+    # A fast network: 1 ms latency plus 100 MB/s
+    for i in range(100):
+        nbytes = (i % 10 + 1) << 20
+        policy.record_fetch(nbytes, 0.001 + nbytes / float(100 << 20))
+    latency, per_byte = policy.fetch_estimate
+    assert abs(latency - 0.001) < 1e-4
+    assert abs(per_byte * (100 << 20) - 1) < 0.01
+    assert policy.admit('fast', 0.1, 1 << 20, [])
+    assert not policy.admit('trivial', 0.0005, 0, [])
+
+
+def test_admission_reuse_sketch():
+    policy = AdmissionPolicy(sketch=True)
+    sigs = [murmur('a'), murmur('b')]
+    assert not policy.admit('slow', 1.0, 100, sigs)
+    policy.record_lookups(sigs[:1])
+    assert not policy.admit('slow', 1.0, 100, sigs)
+    policy.record_lookups(sigs[1:])
+    assert policy.admit('slow', 1.0, 100, sigs)
+
+
+class _Backend(object):
+    def __init__(self):
+        self.data = dict()
+
+    def get_many(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def put_many(self, entries):
+        self.data.update(entries)
+
+
+def test_admission_state_persists():
+    backend = _Backend()
+    sigs = [murmur('a')]
+    policy = AdmissionPolicy(sketch=True)
+    policy.record_lookups(sigs)
+    for i in range(20):
+        policy.record_fetch(1 << 20, 0.01)
+    policy.admit('slow', 1.0, 100, sigs)
+    policy.save(backend)
+    # A later search starts from the saved estimates and sketch
+    later = AdmissionPolicy(sketch=True)
+    later.load(backend, ['slow', 'other'])
+    assert later.fetch_estimate == policy.fetch_estimate
+    assert later.admit('slow', 0.0, 100, sigs)
+    assert not later.admit('other', 0.0, 100, sigs)
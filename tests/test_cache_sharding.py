@@ -0,0 +1,262 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+from opendiamond.server import cache
+
+
+class _Config(object):
+    cache_result_ttl = 0
+    cache_attribute_ttl = 0
+
+    def __init__(self, count):
+        self.cache_server = [('cache%d' % i, 6379) for i in range(count)]
+
+
+class _Pipeline(object):
+    def __init__(self, redis):
+        self._redis = redis
+        self._replies = []
+
+    def mset(self, mapping):
+        self._redis.data.update(mapping)
+        self._replies.append(True)
+
+    def mget(self, keys):
+        self._replies.append([self._redis.data.get(key) for key in keys])
+
+    def hmset(self, key, mapping):
+        self._redis.hashes.setdefault(key, {}).update(mapping)
+        self._replies.append(True)
+
+    def hmget(self, key, fields):
+        values = self._redis.hashes.get(key, {})
+        self._replies.append([values.get(field) for field in fields])
+
+    def expire(self, key, ttl):
+        self._redis.ttls[key] = ttl
+        self._replies.append(True)
+
+    def execute_command(self, command, key, *args):
+        assert command == 'ZADD'
+        zset = self._redis.zsets.setdefault(key, {})
+        for score, member in zip(args[::2], args[1::2]):
+            zset[member] = float(score)
+        self._replies.append(len(args) // 2)
+
+    def execute(self):
+        self._redis.calls += 1
+        replies, self._replies = self._replies, []
+        return replies
+
+
+class _Redis(object):
+    def __init__(self):
+        self.data = {}
+        self.hashes = {}
+        self.lists = {}
+        self.ttls = {}
+        self.scripts = []
+        self.zsets = {}
+        self.calls = 0
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+    def mget(self, keys):
+        self.calls += 1
+        return [self.data.get(key) for key in keys]
+
+    def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value)
+        return len(self.lists[key])
+
+    def rpushx(self, key, value):
+        if key not in self.lists:
+            return 0
+        return self.rpush(key, value)
+
+    def lrange(self, key, start, end):
+        return list(self.lists.get(key, []))
+
+    def zrangebyscore(self, key, low, high, start, num, withscores):
+        def bound(limit, default):
+            if limit in ('-inf', '+inf'):
+                return default
+            return float(limit.lstrip('('))
+        low, high = bound(low, float('-inf')), bound(high, float('inf'))
+        members = sorted((score, member) for member, score in
+                         self.zsets.get(key, {}).iteritems()
+                         if low < score < high)
+        return [(member, score) for score, member in
+                members[start:start + num]]
+
+    def zrem(self, key, *members):
+        for member in members:
+            del self.zsets[key][member]
+
+    def register_script(self, script):
+        def run(keys, args):
+            self.scripts.append((keys, args))
+            # Drop every other record, via filters 0 and 2
+            return [[0, '1', 2, '-0.5'] if i % 2 else []
+                    for i in range(len(keys) - int(args[0]))]
+        return run
+
+
+def _backend(count, skip=(), ttl=0):
+    config = _Config(count)
+    config.cache_result_ttl = ttl
+    redises = dict((i, _Redis()) for i in range(count) if i not in skip)
+    backends = dict((i, cache.RedisBackend(config, server, redis=redises[i]))
+                    for i, server in enumerate(config.cache_server)
+                    if i in redises)
+    return cache.ShardedBackend(config, backends), redises
+
+
+def test_sharded_backend():
+    backend, redises = _backend(3)
+    entries = dict(('result:%d' % i, str(i)) for i in range(300))
+    backend.put_many(entries)
+    # One pipeline per server
+    assert [r.calls for r in redises.values()] == [1, 1, 1]
+    assert all(len(r.data) > 50 for r in redises.values())
+    keys = sorted(entries) + ['result:missing']
+    assert backend.get_many(keys) == [entries[k] for k in sorted(entries)] + [
+        None]
+    assert [r.calls for r in redises.values()] == [2, 2, 2]
+    # Lists live on the requested shard
+    assert backend.append('names:x', 'a', 2) == 0
+    assert backend.get_list('names:x', 2) == ['a']
+    assert backend.get_list('names:x', 1) == []
+    assert backend.append('names:y', 'a', 2, create=False) is None
+    assert backend.append('names:x', 'b', 2, create=False) == 1
+
+
+def test_lost_name_table():
+    backend, redises = _backend(1)
+    names = cache.AttributeNames()
+    generation, ids = names.get_ids(backend, 0, 'd', ['a', 'b'])
+    assert names.get_names(backend, 0, 'd', generation, ids) == ['a', 'b']
+    # The server loses the table, and another search starts a new one
+    # with other names under the same ids
+    redises[0].lists.clear()
+    other = cache.AttributeNames()
+    new_generation, new_ids = other.get_ids(backend, 0, 'd', ['c', 'd'])
+    assert new_ids == ids and new_generation != generation
+    # Entries interned in the lost table are not read against the new one
+    for reader in other, cache.AttributeNames():
+        assert reader.get_names(backend, 0, 'd', generation, ids) == [
+            None, None]
+    assert names.get_names(backend, 0, 'd', new_generation, ids) == [
+        'c', 'd']
+    assert names.get_names(backend, 0, 'd', generation, ids) == [None, None]
+    # Names are added to the new table rather than a revived old one
+    redises[0].lists.clear()
+    assert names.get_ids(backend, 0, 'd', ['e'])[1] == [1]
+    assert redises[0].lists['names:d'][1:] == ['e']
+
+
+def test_consistent_hashing():
+    keys = ['attribute:%d' % i for i in range(10000)]
+    before, _ = _backend(4)
+    after, _ = _backend(5)
+    moved = [k for k in keys if before.shard(k) != after.shard(k)]
+    # Only keys falling to the new server move
+    assert all(after.shard(k) == 4 for k in moved)
+    assert 0.15 < len(moved) / float(len(keys)) < 0.25
+    # Without server 1, only its keys move
+    degraded, _ = _backend(4, skip=[1])
+    moved = [k for k in keys if before.shard(k) != degraded.shard(k)]
+    assert all(before.shard(k) == 1 for k in moved)
+
+
+def test_object_records():
+    backend, redises = _backend(3, ttl=60)
+    entries = dict((cache.record_key('object:%d' % i, 'filter%d' % j),
+                    '%d.%d' % (i, j)) for i in range(30) for j in range(4))
+    entries['attribute:x'] = 'x'
+    backend.put_many(entries)
+    assert [r.calls for r in redises.values()] == [1, 1, 1]
+    # Each record is one hash, on one server, that expires as a whole
+    for i in range(30):
+        holders = [r for r in redises.values() if 'object:%d' % i in r.hashes]
+        assert len(holders) == 1
+        assert len(holders[0].hashes['object:%d' % i]) == 4
+        assert holders[0].ttls['object:%d' % i] == 60
+    assert 'attribute:x' not in [k for r in redises.values() for k in r.ttls]
+    keys = sorted(entries) + [cache.record_key('object:0', 'missing'),
+                              cache.record_key('object:missing', 'filter0')]
+    assert backend.get_many(keys) == [entries[k] for k in sorted(entries)] + [
+        None, None]
+    # Plain keys and record fields share a round trip
+    assert [r.calls for r in redises.values()] == [2, 2, 2]
+
+
+def test_resolve_drops():
+    backend, redises = _backend(2)
+    records = ['object:%d' % i for i in range(20)]
+    verdicts = backend.resolve_drops(records, ['f0', 'f1', 'f2'], [
+        (None, None), (float('-inf'), 1), (0.5, float('inf'))])
+    # One script call per server, over its records
+    calls = [r.scripts for r in redises.values()]
+    assert [len(c) for c in calls] == [1, 1]
+    assert sorted(k for c in calls for k in c[0][0][:-3]) == sorted(records)
+    for keys, args in (c[0] for c in calls):
+        assert keys[-3:] == ['names:f0', 'names:f1', 'names:f2']
+        assert args == [3, 'f0', '', '', 'f1', '', '1.0', 'f2', '0.5', '']
+    assert sum(v is None for v in verdicts) == 10
+    assert [v for v in verdicts if v is not None][0] == [(0, 1.0),
+                                                         (2, -0.5)]
+
+
+def test_score_index(monkeypatch):
+    backend, redises = _backend(3, ttl=60)
+    now = [1e9]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    monkeypatch.setattr(cache, 'SCORE_SCAN_PAGE', 3)
+    backend.put_many(dict((cache.score_key('scores:a', 'obj%d' % i),
+                           repr(float(i))) for i in range(10)))
+    # The index is one sorted set, which expires as a whole, so each
+    # member carries its own expiry time
+    holders = [r for r in redises.values() if 'scores:a' in r.zsets]
+    assert len(holders) == 1
+    zset = holders[0].zsets['scores:a']
+    assert sorted(zset) == sorted('obj%d:%d' % (i, 1e9 + 60)
+                                  for i in range(10))
+    assert holders[0].ttls['scores:a'] == 60
+    # Ranges are read in pages, up to the limit
+    assert backend.scan_scores('scores:a', None, 2, 100) == [
+        ('obj0', 0.0), ('obj1', 1.0)]
+    assert backend.scan_scores('scores:a', 2, None, 100) == [
+        ('obj%d' % i, float(i)) for i in range(3, 10)]
+    assert len(backend.scan_scores('scores:a', 2, None, 5)) == 5
+    # Members outlive their results no longer than the sorted set is
+    # refreshed; expired ones are skipped and removed
+    now[0] += 30
+    backend.put_many({cache.score_key('scores:a', 'obj1'): '1.0'})
+    now[0] += 40
+    assert backend.scan_scores('scores:a', None, None, 100) == [
+        ('obj1', 1.0)]
+    assert zset.keys() == ['obj1:%d' % (1e9 + 90)]
+
+
+def test_score_index_limit():
+    backend, _redises = _backend(3)
+    backend.put_many(dict((cache.score_key('scores:a', 'obj%d' % i),
+                           repr(float(i))) for i in range(10)))
+    backend.put_many({cache.score_key('scores:b', 'obj0'): '-1.0'})
+    queries = [('scores:a', 2, 8), ('scores:b', 0, None)]
+    assert cache.ScoreIndex(100).drops(backend, queries) == {
+        'obj0': (0, 0.0), 'obj1': (0, 1.0), 'obj9': (0, 9.0)}
+    # The search holds no more members than its budget
+    assert cache.ScoreIndex(2).drops(backend, queries) == {
+        'obj0': (0, 0.0), 'obj1': (0, 1.0)}
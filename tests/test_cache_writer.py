@@ -0,0 +1,92 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+import threading
+
+from opendiamond.helpers import murmur
+from opendiamond.server import cache
+from opendiamond.server.statistics import SearchStatistics
+
+
+class _Config(object):
+    cache_write_mb = 1
+    cache_result_ttl = 0
+    cache_attribute_ttl = 0
+
+
+class _Redis(object):
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.unblocked = threading.Event()
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def mset(self, mapping):
+        self.data.update(mapping)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+        self.ttls[key] = ex
+
+    def execute(self):
+        self.unblocked.wait()
+
+
+def test_cache_writer(monkeypatch):
+    redis = _Redis()
+    monkeypatch.setattr(cache, 'connect', lambda config:
+                        cache.RedisBackend(config, None, redis=redis))
+    stats = SearchStatistics()
+    writer = cache.CacheWriter(_Config(), stats)
+    value = 'x' * 400000
+    writer.put({'a': value, 'b': value})
+    # Over budget while the first batch is still being written
+    writer.put({'c': value, 'd': 'small'})
+    writer.put({'d': 'small'})
+    redis.unblocked.set()
+    writer.close()
+    assert sorted(redis.data) == ['a', 'b', 'd']
+    assert stats.cache_writes_queued == 3
+    assert stats.cache_writes_dropped == 1
+    assert stats.cache_writes_failed == 0
+    # Entries arriving after shutdown are dropped
+    writer.put({'e': 'late'})
+    assert stats.cache_writes_dropped == 2
+
+
+def test_write_ttl():
+    redis = _Redis()
+    redis.unblocked.set()
+    config = _Config()
+    config.cache_attribute_ttl = 60
+    cache.RedisBackend(config, None, redis=redis).put_many(
+        {'result:a': '1', 'attribute:b': '2', 'names:c': '3'})
+    assert redis.data == {'result:a': '1', 'attribute:b': '2',
+                          'names:c': '3'}
+    assert redis.ttls == {'attribute:b': 60}
+
+
+def test_attribute_compression():
+    value = '\0\0\0\xff' * 10000
+    key = 'attribute:' + murmur(value)
+    data = cache.encode_attribute('_rgb_image.rgbimage', value)
+    assert data.startswith(cache.ATTRIBUTE_COMPRESSED)
+    assert len(data) < len(value) / 10
+    assert cache.decode_attribute(key, data) == value
+    # Small or already compressed values are stored as-is
+    assert cache.encode_attribute('x', 'small') == 'small'
+    assert cache.encode_attribute('thumbnail.jpeg', value) == value
+    # Uncompressed values that happen to begin with the header
+    data = cache.ATTRIBUTE_COMPRESSED + 'x' * 100
+    assert cache.decode_attribute('attribute:' + murmur(data), data) == data
@@ -0,0 +1,88 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+from opendiamond.server import cache
+
+
+class _Config(object):
+    cache_server = None
+    cache_disk_mb = 1
+    cache_result_ttl = 0
+    cache_attribute_ttl = 0
+
+    def __init__(self, path):
+        self.cache_disk_dir = str(path)
+
+
+def test_disk_backend(tmpdir, monkeypatch):
+    config = _Config(tmpdir.join('cache'))
+    backend = cache.connect(config)
+    assert isinstance(backend, cache.DiskBackend)
+    backend.put_many({'result:a': '\0\1', 'attribute:b': 'x' * 1000})
+    # Another search sees the entries
+    other = cache.connect(config)
+    assert other.get_many(['result:a', 'missing', 'attribute:b']) == [
+        '\0\1', None, 'x' * 1000]
+    assert [backend.append('names:c', name) for name in 'pq'] == [0, 1]
+    assert other.append('names:c', 'r') == 2
+    assert backend.get_list('names:c') == ['p', 'q', 'r']
+    assert backend.get_list('names:d') == []
+    assert backend.append('names:d', 's', create=False) is None
+    assert backend.get_list('names:d') == []
+    # Expired entries are not returned
+    config.cache_result_ttl = 10
+    backend.put_many({'result:e': '1'})
+    monkeypatch.setattr(cache.time, 'time', lambda: 2e9)
+    assert backend.get_many(['result:e', 'result:a']) == [None, '\0\1']
+
+
+def test_disk_backend_eviction(tmpdir, monkeypatch):
+    config = _Config(tmpdir)
+    backend = cache.connect(config)
+    value = 'x' * (100 << 10)
+    now = [1e9]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    for i in range(8):
+        backend.put_many({'attribute:%d' % i: value})
+        now[0] += 1
+    # Touch the oldest entry so that it survives
+    now[0] += cache.DISK_ATIME_INTERVAL + 1
+    assert backend.get_many(['attribute:0']) == [value]
+    for i in range(8, 12):
+        backend.put_many({'attribute:%d' % i: value})
+    found = backend.get_many(['attribute:%d' % i for i in range(12)])
+    assert found[0] == value
+    assert found[1] is None
+    assert found[-1] == value
+    assert sum(len(v) for v in found if v is not None) <= 1 << 20
+
+
+def test_disk_score_index(tmpdir, monkeypatch):
+    config = _Config(tmpdir)
+    backend = cache.connect(config)
+    backend.put_many(dict(
+        [(cache.score_key('scores:a', 'obj%d' % i), repr(i / 2.0))
+         for i in range(10)] +
+        # An index whose name extends the first's
+        [(cache.score_key('scores:ab', 'obj0'), '-1.0')]))
+    assert sorted(backend.scan_scores('scores:a', None, 1, 100)) == [
+        ('obj0', 0.0), ('obj1', 0.5)]
+    assert sorted(backend.scan_scores('scores:a', 4, None, 100)) == [
+        ('obj9', 4.5)]
+    assert len(backend.scan_scores('scores:a', None, None, 4)) == 4
+    # Members expire with the results
+    config.cache_result_ttl = 10
+    backend.put_many({cache.score_key('scores:c', 'obj0'): '-1.0'})
+    assert backend.scan_scores('scores:c', None, 0, 100) == [
+        ('obj0', -1.0)]
+    monkeypatch.setattr(cache.time, 'time', lambda: 2e9)
+    assert backend.scan_scores('scores:c', None, 0, 100) == []
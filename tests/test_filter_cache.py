@@ -0,0 +1,141 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from opendiamond.server.child import ChildManager
+from opendiamond.server.filtercache import FilterProcessCache
+
+# Reports init-success, then idles until its stdin is closed
+_FILTER = '''#!%s
+import sys
+sys.stdout.write('log\\n1\\n1\\n5\\nhello\\ninit-success\\n')
+sys.stdout.flush()
+sys.stdin.read()
+''' % sys.executable
+
+_STATE = {
+    'protocol': 1,
+    'push_attrs': [],
+    'push_mapped': False,
+    'batch': False,
+}
+
+
+class _Config(object):
+    filter_cache_mb = 64
+    filter_cache_ttl = 3600
+    filter_protocol = 1
+    shm_threshold = 0
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+
+class _Filter(object):
+    name = 'filter'
+    signature = 'code'
+    arguments = []
+    blob_signature = 'blob'
+    cache_digest = 'digest'
+
+
+@pytest.fixture
+def cache(tmpdir):
+    tmpdir.join('code').write(_FILTER)
+    tmpdir.join('blob').write('')
+    cache = FilterProcessCache(_Config(str(tmpdir)))
+    yield cache
+    cache.shutdown()
+
+
+def _start(cache, count):
+    '''Have the cache start count processes and wait for them to
+    initialize.'''
+    cache.request(_Filter(), count)
+    cache.service()
+    deadline = time.time() + 10
+    while len(cache.reusable_pids()) < count:
+        assert time.time() < deadline
+        time.sleep(0.05)
+    cache.service()
+    return cache._entries[_Filter.cache_digest]
+
+
+def test_lease(cache):
+    entries = _start(cache, 2)
+    assert len(entries) == 2
+    # Each process has a working directory of its own
+    assert entries[0].workdir != entries[1].workdir
+    first = cache.lease(_Filter.cache_digest)
+    second = cache.lease(_Filter.cache_digest)
+    assert first.pid != second.pid
+    assert first.state['protocol'] == 1
+    assert cache.lease(_Filter.cache_digest) is None
+    assert cache.lease('other') is None
+    workdirs = dict((e.pid, e.workdir) for e in entries)
+    # Files left by a search are gone when the next lease begins
+    open(os.path.join(workdirs[first.pid], 'scratch'), 'w').close()
+    first.end(_STATE)
+    assert os.listdir(workdirs[first.pid]) == []
+    assert cache.lease(_Filter.cache_digest).pid == first.pid
+    # A process given back dirty is killed
+    second.end()
+    cache.service()
+    assert [e.pid for e in entries] == [first.pid]
+    assert not os.path.exists(workdirs[second.pid])
+
+
+def test_ttl_expiry(cache):
+    entries = _start(cache, 1)
+    pid = entries[0].pid
+    cache._ttl = 0
+    time.sleep(0.05)
+    cache.service()
+    assert _Filter.cache_digest not in cache._entries
+    assert pid not in cache.reusable_pids()
+
+
+def test_memory_cap(cache):
+    entries = list(_start(cache, 2))
+    # Keep the more recently used process
+    os.utime(entries[0].state_path, (0, 0))
+    cache._limit = entries[1].rss() * 3 // 2
+    cache.service()
+    assert cache._entries[_Filter.cache_digest] == entries[1:]
+    # Leased processes are not evicted
+    lease = cache.lease(_Filter.cache_digest)
+    cache._limit = 0
+    cache.service()
+    assert cache._entries[_Filter.cache_digest] == entries[1:]
+    lease.end(_STATE)
+    cache.service()
+    assert _Filter.cache_digest not in cache._entries
+
+
+def test_sigchld_skips_other_children():
+    handler = signal.getsignal(signal.SIGCHLD)
+    try:
+        ChildManager(fork=False)
+        proc = subprocess.Popen(['sh', '-c', 'exit 3'])
+        time.sleep(0.2)
+        os.kill(os.getpid(), signal.SIGCHLD)
+        # The exit status is left for the process's owner
+        assert proc.wait() == 3
+    finally:
+        signal.signal(signal.SIGCHLD, handler)
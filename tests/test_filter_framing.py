@@ -0,0 +1,83 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+from cStringIO import StringIO
+
+import pytest
+
+from opendiamond.framing import (
+    FrameCodec, FRAME_HEADER, PROTOCOL_ENV, advertised_version)
+
+
+def _roundtrip(write):
+    out = StringIO()
+    write(FrameCodec(None, out))
+    return FrameCodec(StringIO(out.getvalue()), None)
+
+
+def test_framing_roundtrip():
+    def write(codec):
+        codec.put_tag('set-attribute')
+        codec.put_item('key')
+        codec.put_item('\n\0' * 1000)
+        codec.put_none()
+        codec.put_item(1.5)
+    codec = _roundtrip(write)
+    assert codec.get_tag() == 'set-attribute'
+    assert codec.get_item() == 'key'
+    assert codec.get_item() == '\n\0' * 1000
+    assert codec.get_item() is None
+    assert codec.get_item() == '1.5'
+    with pytest.raises(IOError):
+        codec.get_item()
+
+
+def test_framing_errors():
+    codec = _roundtrip(lambda c: c.put_item('x'))
+    with pytest.raises(IOError):
+        codec.get_tag()
+
+    codec = _roundtrip(lambda c: c.put_tag('result'))
+    with pytest.raises(IOError):
+        codec.get_item()
+
+    codec = FrameCodec(StringIO(FRAME_HEADER.pack(0, 10) + 'short'), None)
+    with pytest.raises(IOError) as e:
+        codec.get_item()
+    e.match('Short read')
+
+
+def test_framing_batches_flushes():
+    class CountingFile(object):
+        flushes = 0
+
+        def write(self, _data):
+            pass
+
+        def flush(self):
+            self.flushes += 1
+
+    out = CountingFile()
+    codec = FrameCodec(StringIO(FRAME_HEADER.pack(1, 0)), out)
+    codec.put_tag('get-attribute')
+    codec.put_item('')
+    assert out.flushes == 0
+    assert codec.get_item() is None
+    assert out.flushes == 1
+    codec.flush()
+    assert out.flushes == 1
+
+
+def test_advertised_version():
+    assert advertised_version({}) == 1
+    assert advertised_version({PROTOCOL_ENV: '2'}) == 2
+    assert advertised_version({PROTOCOL_ENV: 'bogus'}) == 1
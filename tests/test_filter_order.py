@@ -0,0 +1,147 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+from opendiamond.server import filter as filter_module
+from opendiamond.server.filter import Filter, FilterStack
+from opendiamond.server.statistics import SearchStatistics
+
+
+class _Config(object):
+    reorder_interval = 10
+    threads = 8
+    filter_processes = {}
+    execution_mode = 'pipeline'
+    pipeline_queue = 4
+    parallel_filters = 1
+    cache_content_keys = 0
+    cache_server_resolution = 0
+    cache_object_records = 0
+    cache_score_index = 0
+
+
+class _State(object):
+    def __init__(self):
+        self.config = _Config()
+        self.stats = SearchStatistics()
+        self.filter_cache = None
+        self.blob_cache = None
+        self.blast = self
+
+    def close(self):
+        pass
+
+
+def _filter(name, dependencies=()):
+    return Filter(name, 'sha256:code', 'sha256:blob', 0, 1, [],
+                  list(dependencies))
+
+
+def _run(filter, objs, cost_us, dropped):
+    filter.stats.update(objs_processed=objs, objs_computed=objs,
+                        execution_us=objs * cost_us, objs_dropped=dropped)
+
+
+def _names(stack):
+    return [f.name for f in stack.execution_order()]
+
+
+def test_adaptive_order():
+    slow = _filter('slow')
+    cheap = _filter('cheap')
+    selective = _filter('selective', ['slow'])
+    stack = FilterStack([slow, cheap, selective])
+    state = _State()
+    assert _names(stack) == ['slow', 'cheap', 'selective']
+
+    _run(slow, 100, 1000, 10)
+    _run(cheap, 100, 10, 10)
+    _run(selective, 100, 10, 90)
+    # Not yet time to reorder
+    stack.note_evaluated(state, 5)
+    assert _names(stack) == ['slow', 'cheap', 'selective']
+    # The selective filter must still follow its dependency
+    stack.note_evaluated(state, 5)
+    assert _names(stack) == ['cheap', 'slow', 'selective']
+    assert [f.stats.order_position for f in stack] == [2, 1, 3]
+    assert state.stats.filter_order_changes == 1
+
+    # Unchanged statistics leave the order alone
+    stack.note_evaluated(state, 10)
+    assert state.stats.filter_order_changes == 1
+
+
+def test_adaptive_order_ranks_unsampled_filters_by_prior():
+    selective = _filter('selective')
+    slow = _filter('slow')
+    late = _filter('late')
+    stack = FilterStack([slow, selective, late])
+    state = _State()
+    _run(slow, 100, 1000, 10)
+    _run(selective, 100, 10, 50)
+    # Rarely reached, so ranked mostly as an average filter rather than
+    # moved to the front
+    _run(late, 2, 10, 0)
+    stack.note_evaluated(state, 10)
+    assert _names(stack) == ['selective', 'late', 'slow']
+
+
+def test_order_history():
+    first = _filter('first')
+    second = _filter('second')
+    stack = FilterStack([first, second])
+    state = _State()
+    _run(first, 100, 1000, 0)
+    _run(second, 100, 10, 50)
+    stack.note_evaluated(state, 10)
+    assert _names(stack) == ['second', 'first']
+    _run(first, 20, 1000, 0)
+    _run(second, 30, 10, 15)
+    counts = [dict((s.name, s.value) for s in f.stats.xdr().stats
+                   if s.name.startswith('objs_at_position_'))
+              for f in (first, second)]
+    assert counts == [{'objs_at_position_1': 100, 'objs_at_position_2': 20},
+                      {'objs_at_position_2': 100, 'objs_at_position_1': 30}]
+
+
+def test_pool_limit():
+    cheap = _filter('cheap')
+    slow = _filter('slow')
+    fixed = _filter('fixed')
+    stack = FilterStack([cheap, slow, fixed])
+    state = _State()
+    state.config.filter_processes = {'fixed': 3}
+    # A single process until costs are measured, unless configured
+    assert [stack._pool_limit(state, f) for f in stack] == [1, 1, 3]
+    _run(cheap, 100, 10, 0)
+    _run(slow, 100, 990, 0)
+    assert [stack._pool_limit(state, f) for f in stack] == [1, 8, 3]
+
+
+def test_pipeline_fetchers(monkeypatch):
+    workers = []
+    loaders = []
+    monkeypatch.setattr(filter_module._PipelineWorker, 'start',
+                        lambda self: workers.append(self))
+    monkeypatch.setattr(filter_module, 'ObjectLoader',
+                        lambda config, blob_cache: loaders.append(1))
+    first = _filter('first')
+    second = _filter('second', ['first'])
+    for f in first, second:
+        f.code_path = 'filter'
+    state = _State()
+    state.config.filter_processes = {'second': 2}
+    FilterStack([first, second]).start_threads(state, 3)
+    assert [w.name for w in workers] == [
+        'Stage-0-0', 'Stage-0-1', 'Stage-0-2', 'Stage-1-0', 'Stage-1-1',
+        'Stage-1-2', 'Stage-2-0', 'Stage-2-1']
+    # Only the threads of the first stage load objects
+    assert len(loaders) == 3
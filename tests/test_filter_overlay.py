@@ -0,0 +1,132 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+import os
+import time
+
+from opendiamond.server.filter import (Filter, FilterStack,
+                                       FilterStackRunner, _Cancellation,
+                                       _FilterResult, _ObjectOverlay,
+                                       _ObjectProcessor)
+from opendiamond.server.object_ import Object
+from opendiamond.server.statistics import SearchStatistics
+
+
+def test_overlay_isolated():
+    obj = Object('server', 'obj')
+    obj['in'] = 'value'
+    overlay = _ObjectOverlay(obj, _Cancellation())
+    overlay['out'] = 'new'
+    overlay.omit('in')
+    assert overlay['in'] == 'value'
+    assert overlay['out'] == 'new'
+    assert overlay.get_signature('out') is not None
+    assert 'out' not in obj
+    assert overlay.get_shared('out') is None
+
+
+def test_overlay_merge_order():
+    # Whichever filter finishes first, the later one in declared order wins
+    for finish_order in ((1, 2), (2, 1)):
+        obj = Object('server', 'obj')
+        cancellation = _Cancellation()
+        overlays = {}
+        for position in 1, 2:
+            overlays[position] = _ObjectOverlay(obj, cancellation)
+            overlays[position]['attr'] = str(position)
+        writers = {}
+        for position in finish_order:
+            overlays[position].merge(position, writers)
+        assert obj['attr'] == '2'
+        assert obj.get_signature('attr') == \
+            overlays[2].get_signature('attr')
+
+
+class _Config(object):
+    cache_content_keys = 0
+    cache_server_resolution = 0
+    cache_score_index = 0
+    parallel_filters = 2
+
+
+class _State(object):
+    def __init__(self):
+        self.config = _Config()
+        self.stats = SearchStatistics()
+
+
+class _Runner(_ObjectProcessor):
+    send_score = False
+
+    def __init__(self, name, delay, drop):
+        _ObjectProcessor.__init__(self)
+        self.name = name
+        self.delay = delay
+        self.drop = drop
+        self.finished = False
+
+    def __str__(self):
+        return self.name
+
+    def evaluate(self, obj):
+        time.sleep(self.delay)
+        self.finished = True
+        return _FilterResult()
+
+    def threshold(self, result):
+        return not self.drop
+
+
+def test_concurrent_drop_abandons_running_filters(tmpdir):
+    filters = [Filter(name, 'sha256:code', 'sha256:blob', 0, 1, [], [])
+               for name in ('slow', 'dropper')]
+    slow = _Runner('slow', 0.5, False)
+    dropper = _Runner('dropper', 0, True)
+    fetcher = _Runner('fetcher', 0, False)
+    runner = FilterStackRunner(_State(), [fetcher, slow, dropper], 'Filter',
+                               None, FilterStack(filters))
+    obj = Object('server', 'obj')
+    obj.enable_sharing(str(tmpdir), 1)
+    obj['data'] = 'value'
+    path = obj.get_shared('data')[0]
+    assert runner._run_concurrently([obj], [slow, dropper], [0], [{}],
+                                    [{}]) == []
+    assert not slow.finished
+    # The worker releases the object, but the slow filter may still read
+    # its shared memory until it finishes
+    obj.release()
+    assert os.path.exists(path)
+    deadline = time.time() + 5
+    while os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.05)
+    assert slow.finished
+    assert not os.path.exists(path)
+
+
+class _Connection(object):
+    aborted = False
+
+    def abort(self):
+        self.aborted = True
+
+
+def test_cancellation_aborts_connections():
+    cancellation = _Cancellation()
+    busy, done = _Connection(), _Connection()
+    assert cancellation.attach(busy)
+    assert cancellation.attach(done)
+    cancellation.detach(done)
+    cancellation.cancel()
+    assert busy.aborted
+    assert not done.aborted
+    # Connections acquired afterward are not to be used
+    assert not cancellation.attach(_Connection())
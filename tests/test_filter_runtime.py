@@ -0,0 +1,223 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+'''Drive the filter runtime in a child process, over a socketpair standing
+in for the filter's stdin and stdout, through the server's side of the
+filter protocol.'''
+
+import mmap
+import os
+import socket
+import sys
+import time
+
+import pytest
+
+from opendiamond.filter import Filter
+from opendiamond.framing import PROTOCOL_ENV, SHARED_MEMORY_ENV
+from opendiamond.server.filter import _FilterConnection
+from opendiamond.server.object_ import Object
+
+
+def _spawn(filter_class, environ):
+    '''Run filter_class in a child process with the specified environment
+    variables.  Return its PID and the server's connection to it, after
+    the argument handshake.'''
+    ours, theirs = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        # The child must never return
+        try:
+            ours.close()
+            # Undo the test runner's output capture
+            sys.stdin, sys.stdout = sys.__stdin__, sys.__stdout__
+            os.dup2(theirs.fileno(), 0)
+            os.dup2(theirs.fileno(), 1)
+            theirs.close()
+            os.environ.update(environ)
+            filter_class.run(argv=['filter', '--filter'])
+        finally:
+            os._exit(0)
+    theirs.close()
+    conn = _FilterConnection(ours.makefile('rb'), ours.makefile('wb'),
+                             filter_class.__name__, [], '')
+    ours.close()
+    return pid, conn
+
+
+def _finish(pid, conn):
+    '''Close the connection and check that the filter exits.'''
+    conn._fout.close()
+    conn._fin.close()
+    _pid, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def _upgrade(conn):
+    '''Accept the filter's request for binary framing.'''
+    assert conn.get_tag() == 'set-protocol'
+    assert conn.get_item() == '2'
+    conn.send(True)
+    conn.upgrade()
+
+
+class _ConcatFilter(Filter):
+    '''Copies the concatenation of attributes a, b and c to output.'''
+    shared_attributes = True
+
+    def __call__(self, obj):
+        values = [obj.get_binary(key) for key in 'abc']
+        obj.set_binary('output', ''.join(str(v) for v in values))
+        return len(values[0])
+
+
+def test_shared_memory_handoff(tmpdir):
+    pid, conn = _spawn(_ConcatFilter, {SHARED_MEMORY_ENV: '1'})
+    assert conn.get_tag() == 'init-success'
+    obj = Object('server', 'obj')
+    obj.enable_sharing(str(tmpdir), 1000)
+    obj['a'] = 'x' * 3000
+    obj['b'] = 'y' * 2000
+    obj['c'] = 'short'
+    offsets = []
+    for key in 'ab':
+        assert conn.get_tag() == 'map-attribute'
+        assert conn.get_item() == key
+        path, offset, length = obj.get_shared(key)
+        assert length == len(obj[key])
+        offsets.append(offset)
+        conn.send([path, offset, length])
+    # Each value is at an offset that can be mapped on its own
+    assert offsets[0] == 0
+    assert offsets[1] % mmap.ALLOCATIONGRANULARITY == 0
+    assert offsets[1] >= 3000
+    assert conn.get_tag() == 'map-attribute'
+    assert conn.get_item() == 'c'
+    # Releasing the object deletes the file, but the filter keeps its
+    # existing mappings
+    obj.release()
+    assert not os.path.exists(path)
+    # Small values are sent inline
+    assert obj.get_shared('c') is None
+    conn.send([obj['c']])
+    assert conn.get_tag() == 'set-attribute'
+    assert conn.get_item() == 'output'
+    assert conn.get_item() == 'x' * 3000 + 'y' * 2000 + 'short'
+    assert conn.get_tag() == 'result'
+    assert conn.get_item() == '3000'
+    _finish(pid, conn)
+
+
+class _PushedFilter(Filter):
+    '''Scores each object by the length of attribute a, which it declares
+    as an input.'''
+    shared_attributes = True
+    input_attributes = ('a',)
+
+    def __call__(self, obj):
+        return len(obj.get_binary('a'))
+
+
+@pytest.mark.parametrize('shared', (False, True))
+def test_input_attribute_push(tmpdir, shared):
+    environ = {PROTOCOL_ENV: '2'}
+    if shared:
+        environ[SHARED_MEMORY_ENV] = '1'
+    pid, conn = _spawn(_PushedFilter, environ)
+    _upgrade(conn)
+    assert conn.get_tag() == 'declare-attributes'
+    assert conn.get_item() == ('map' if shared else 'get')
+    assert conn.get_array() == ['a']
+    assert conn.get_tag() == 'init-success'
+    for size in 3000, 5:
+        obj = Object('server', 'obj%d' % size)
+        obj.enable_sharing(str(tmpdir), 1000)
+        obj['a'] = 'x' * size
+        # Pushed at the start of the object, as a map-attribute reply if
+        # the filter maps shared memory
+        if shared:
+            conn.send(obj.get_shared('a') or [obj['a']])
+        else:
+            conn.send(obj['a'])
+        # The filter asks for nothing before its result
+        assert conn.get_tag() == 'result'
+        assert conn.get_item() == str(size)
+        obj.release()
+    _finish(pid, conn)
+
+
+class _ForkableFilter(Filter):
+    '''Scores each object by the PID of the process evaluating it.'''
+    forkable = True
+
+    def __call__(self, obj):
+        obj.get_binary('id')
+        return os.getpid()
+
+
+def _accept(listener):
+    '''Accept a connection from the filter's template process or a copy.'''
+    sock, _addr = listener.accept()
+    conn = _FilterConnection(sock.makefile('rb'), sock.makefile('wb'),
+                             'template', None, None, handshake=False)
+    sock.close()
+    conn.upgrade()
+    return conn
+
+
+def _evaluate(conn):
+    '''Evaluate an object and return the score.'''
+    assert conn.get_tag() == 'get-attribute'
+    assert conn.get_item() == 'id'
+    conn.send('obj')
+    assert conn.get_tag() == 'result'
+    return int(conn.get_item())
+
+
+def test_fork_handshake(tmpdir):
+    path = str(tmpdir.join('fork'))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(5)
+    listener.settimeout(10)
+    pid, conn = _spawn(_ForkableFilter, {PROTOCOL_ENV: '2'})
+    _upgrade(conn)
+    assert conn.get_tag() == 'declare-fork'
+    conn.send(path)
+    conn.flush()
+    # The filter goes on to evaluate objects itself, while a template
+    # process forked from it connects to the socket
+    assert conn.get_tag() == 'init-success'
+    template = _accept(listener)
+    assert _evaluate(conn) == pid
+    template.send('fork')
+    assert template.get_tag() == 'forked'
+    copy_pid = int(template.get_item())
+    # The copy connects to the socket, already initialized
+    copy = _accept(listener)
+    assert _evaluate(copy) == copy_pid
+    assert copy_pid not in (pid, os.getpid())
+    # Copies exit when their connection closes
+    copy._fin.close()
+    copy._fout.close()
+    deadline = time.time() + 10
+    while True:
+        try:
+            os.kill(copy_pid, 0)
+        except OSError:
+            break
+        assert time.time() < deadline
+        time.sleep(0.05)
+    template._fin.close()
+    template._fout.close()
+    listener.close()
+    _finish(pid, conn)
@@ -0,0 +1,43 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+import os
+import sys
+
+import pytest
+
+from opendiamond.server.filter import _FilterConnection, _read_usage
+from opendiamond.server.statistics import FilterStatistics
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='requires /proc')
+def test_account_usage():
+    user, system, peak = _read_usage(os.getpid())
+    assert user >= 0 and system >= 0 and peak > 0
+    assert _read_usage(-1) is None
+
+    conn = _FilterConnection(None, None, 'test', [], '', handshake=False)
+    stats = FilterStatistics('test')
+    conn.account_usage(stats)
+    assert stats.peak_rss_kb == -1
+    conn.pid = os.getpid()
+    conn.account_usage(stats)
+    assert stats.cpu_user_us >= user
+    assert stats.peak_rss_kb >= peak
+    # Samples are rate-limited unless forced
+    sum(xrange(5000000))
+    total = stats.cpu_user_us + stats.cpu_system_us
+    conn.account_usage(stats)
+    assert stats.cpu_user_us + stats.cpu_system_us == total
+    conn.account_usage(stats, True)
+    assert stats.cpu_user_us + stats.cpu_system_us > total
@@ -0,0 +1,31 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+from opendiamond.server.cache import MEMORY_ENTRY_OVERHEAD, MemoryCache
+
+
+def test_memory_cache_lru():
+    entry = 1000
+    value = 'x' * (entry - 1 - MEMORY_ENTRY_OVERHEAD)
+    cache = MemoryCache(3 * entry)
+    for key in 'abc':
+        cache.update({key: value})
+    # Touch a so that b is the least recently used
+    assert cache.get_many(['a', 'z']) == [value, None]
+    cache.update({'d': value})
+    assert cache.get_many(['a', 'b', 'c', 'd']) == [value, None, value, value]
+    # Replacing an entry doesn't count it twice
+    cache.update({'d': value})
+    assert cache.get_many(['a', 'c']) == [value, value]
+    # Oversized values are not stored
+    cache.update({'e': value * 4})
+    assert cache.get_many(['e', 'a']) == [None, value]
@@ -0,0 +1,286 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+import struct
+
+import pytest
+import simplejson as json
+
+from opendiamond.helpers import murmur
+from opendiamond.server import cache
+from opendiamond.server.filter import (_FilterResult, _ObjectFetcher,
+                                       _ObjectProcessor, _PipelineItem,
+                                       _PipelineWorker, _ResolutionPlan)
+from opendiamond.server.object_ import ATTR_DATA, Object
+from opendiamond.server.statistics import SearchStatistics
+
+
+class _Runner(_ObjectProcessor):
+    def __init__(self, name, drop=False):
+        _ObjectProcessor.__init__(self)
+        self.name = name
+        self.drop = drop
+
+    def __str__(self):
+        return self.name
+
+    def _get_cache_digest(self):
+        return murmur(self.name)
+
+    def threshold(self, result):
+        return not self.drop
+
+
+def _chain():
+    '''A fetcher and two filters, the second reading the output of the
+    first and dropping the object.'''
+    fetcher, first, second = (_Runner('fetcher'), _Runner('first'),
+                              _Runner('second', drop=True))
+    results = {
+        fetcher: _FilterResult(output_attrs={'data': 'a'}),
+        first: _FilterResult({'data': 'a'}, {'_first.out': 'b'}),
+        second: _FilterResult({'_first.out': 'b'}, {}),
+    }
+    return [fetcher, first, second], results
+
+
+def test_result_keys():
+    runners, _ = _chain()
+    plan = _ResolutionPlan(runners)
+    assert plan.result_keys('obj') == dict((r, r.get_cache_key('obj'))
+                                           for r in runners)
+    records = plan.result_keys('obj', records=True)
+    assert records[runners[1]] == ('object:' + murmur('obj') + '#' +
+                                   runners[1].cache_digest)
+
+
+def test_resolve_drop():
+    runners, results = _chain()
+    plan = _ResolutionPlan(runners)
+    assert plan.resolve_drop('obj', results) == set(runners)
+    # Not provable without the result producing the dropping filter's input
+    del results[runners[1]]
+    assert plan.resolve_drop('obj', results) is None
+    # Nor if that result's output differs from the input that was used
+    runners, results = _chain()
+    results[runners[1]].output_attrs['_first.out'] = 'c'
+    plan = _ResolutionPlan(runners)
+    assert plan.resolve_drop('obj', results) is None
+
+
+class _LuaRedis(object):
+    '''Runs server scripts with Lua, over a Redis with hashes and lists.'''
+
+    def __init__(self, lupa):
+        self._lupa = lupa
+        self.hashes = dict()
+        self.lists = dict()
+
+    def register_script(self, script):
+        def run(keys, args):
+            lua = self._lupa.LuaRuntime(unpack_returned_tuples=True)
+            # Redis runs Lua 5.1
+            lua.execute('unpack = unpack or table.unpack')
+            null = lua.eval('{}')
+
+            def to_lua(value):
+                if value is None:
+                    return null
+                if isinstance(value, dict):
+                    return lua.table_from(dict(
+                        (str(k), to_lua(v)) for k, v in value.iteritems()))
+                if isinstance(value, unicode):
+                    return str(value)
+                return value
+
+            def call(command, key, *args):
+                if command == 'LRANGE':
+                    return lua.table_from(self.lists.get(key, []))
+                assert command == 'HMGET'
+                values = self.hashes.get(key, {})
+                return lua.table_from([values.get(f, False) for f in args])
+
+            def unpack(fmt, data, pos):
+                return struct.unpack_from(fmt, data, pos - 1)[0], pos + 8
+
+            env = lua.globals()
+            env.redis = lua.table_from({'call': call})
+            env.cjson = lua.table_from({
+                'null': null,
+                'decode': lambda data: to_lua(json.loads(data)),
+            })
+            env.struct = lua.table_from({'unpack': unpack})
+            env.KEYS = lua.table_from(keys)
+            env.ARGV = lua.table_from([str(a) for a in args])
+            return [list(reply.values())
+                    for reply in lua.execute(script).values()]
+        return run
+
+
+class _Fetcher(_ObjectFetcher):
+    def __init__(self):
+        _ObjectProcessor.__init__(self)
+
+    def _get_cache_digest(self):
+        return 'dataretriever'
+
+
+class _Filter(_Runner):
+    score_bounds = (1, float('inf'))
+
+    def __init__(self, name, dependencies=()):
+        _Runner.__init__(self, name)
+        self.dependencies = dependencies
+
+
+def test_score_entries():
+    fetcher = _Fetcher()
+    first = _Filter('first')
+    second = _Filter('second', ['first'])
+    undeclared = _Filter('undeclared')
+    plan = _ResolutionPlan([fetcher, first, second, undeclared])
+    results = {
+        fetcher: _FilterResult(output_attrs={'data': 'a'}),
+        first: _FilterResult({'data': 'a'}, {'_first.out': 'b'}, score=2),
+        second: _FilterResult({'_first.out': 'b'}, {}, score=0),
+        # Reads an output of a filter it doesn't declare
+        undeclared: _FilterResult({'_first.out': 'b'}, {}, score=0),
+    }
+    # Scores a sorted set cannot hold are left out
+    for score in float('nan'), float('-inf'):
+        nonfinite = _FilterResult({'data': 'a'}, {}, score=score)
+        assert plan.score_entries('obj', {first: nonfinite}) == {}
+    entries = plan.score_entries('obj', results)
+    indexes = dict(plan.score_queries)
+    assert sorted(indexes) == sorted([first, second, undeclared])
+    assert entries == {
+        cache.score_key(indexes[first][0], murmur('obj')): '2.0',
+        cache.score_key(indexes[second][0], murmur('obj')): '0.0',
+    }
+    assert indexes[second][1:] == (1, None)
+
+
+def test_content_keys():
+    fetcher = _Fetcher()
+    first = _Filter('first')
+    plan = _ResolutionPlan([fetcher, first], content_keys=True)
+    obj = Object('server', 'http://a/1')
+    # Until the content is known, only the fetcher's result has a key
+    assert plan.content(obj) is None
+    assert plan.result_keys(obj) == {fetcher: fetcher.get_cache_key(obj)}
+    fetched = _FilterResult(output_attrs={ATTR_DATA: murmur('data')})
+    assert plan.content(obj, {fetcher: fetched}) == murmur('data')
+    # Objects with the same data share filter results
+    mirror = Object('server', 'http://b/1')
+    for o in obj, mirror:
+        o[ATTR_DATA] = 'data'
+    keys = plan.result_keys(obj, content=plan.content(obj))
+    mirrored = plan.result_keys(mirror, content=plan.content(mirror))
+    assert keys[first] == mirrored[first] == first.get_cache_key(
+        murmur('data'))
+    assert keys[fetcher] != mirrored[fetcher]
+    records = plan.result_keys(obj, records=True, content=murmur('data'))
+    assert records[first].startswith('object:' + murmur(murmur('data')))
+
+
+class _Config(object):
+    cache_score_index = 1
+    cache_content_keys = 0
+    cache_object_records = 0
+    cache_server_resolution = 0
+    cache_result_format = 1
+    cache_compress = 0
+
+
+class _Writer(object):
+    def __init__(self):
+        self.entries = dict()
+
+    def put(self, entries):
+        self.entries.update(entries)
+
+
+class _State(object):
+    def __init__(self):
+        self.config = _Config()
+        self.stats = SearchStatistics()
+        self.result_memory = self.attribute_memory = None
+        self.cache_writer = _Writer()
+        self.blast = self
+        self.sent = []
+
+    def send(self, obj):
+        self.sent.append(obj)
+
+
+class _Pipeline(object):
+    def note_result(self):
+        pass
+
+
+def test_pipeline_score_entries():
+    # The object is admitted by a worker of the first stage and leaves
+    # the pipeline from a worker of the last, each with its own runners
+    state = _State()
+    admit = _PipelineWorker(state, [_Fetcher(), _Filter('first')],
+                            'Stage-0-0', None, _Pipeline(), 0)
+    finish = _PipelineWorker(state, [_Fetcher(), _Filter('first')],
+                             'Stage-1-0', None, _Pipeline(), 1)
+    obj = Object('server', 'http://a/1')
+    obj[ATTR_DATA] = 'data'
+    fetcher, first = admit._runners
+    item = _PipelineItem(obj, admit._runners, admit._result_keys(obj))
+    item.new_results = {
+        fetcher: _FilterResult(
+            output_attrs={ATTR_DATA: obj.get_signature(ATTR_DATA)}),
+        first: _FilterResult({ATTR_DATA: obj.get_signature(ATTR_DATA)}, {},
+                             score=2),
+    }
+    finish._finish(item, True)
+    assert state.sent == [obj]
+    index = dict(finish._plan.score_queries)[finish._runners[1]][0]
+    entries = state.cache_writer.entries
+    assert entries[cache.score_key(index, murmur(str(obj)))] == '2.0'
+    assert first.get_cache_key(obj) in entries
+
+
+def test_server_resolution_matches_plan():
+    lupa = pytest.importorskip('lupa')
+    fetcher = _Fetcher()
+    clash = _Filter('clash')
+    first = _Filter('first')
+    second = _Filter('second', ['first'])
+    third = _Filter('third')
+    for runner in second, third:
+        runner.drop = True
+    runners = [fetcher, clash, first, second, third]
+    results = {
+        fetcher: _FilterResult(output_attrs={'': 'a'}, score=1),
+        # Outputs the attribute second reads, with another value
+        clash: _FilterResult({'': 'a'}, {'_out': 'c'}, score=2),
+        first: _FilterResult({'': 'a'}, {'_out': 'b'}, score=2),
+        second: _FilterResult({'_out': 'b'}, {}, score=0),
+        third: _FilterResult({'': 'a'}, {}, score=0),
+    }
+    plan = _ResolutionPlan(runners)
+    redis = _LuaRedis(lupa)
+    backend = cache.RedisBackend(None, None, redis=redis)
+    record = plan.record('obj')
+    redis.hashes[record] = dict((r.cache_digest, result.encode())
+                                for r, result in results.iteritems())
+    verdicts = backend.resolve_drops([record], *plan.drop_query)
+    # Both credit the dropping filter declared first, through the producer
+    # of its input with the right value
+    expected = plan.resolve_drop('obj', results)
+    assert expected == set([fetcher, first, second])
+    assert sorted((runners[i], score) for i, score in verdicts[0]) == \
+        sorted((r, results[r].score) for r in expected)
@@ -0,0 +1,79 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2017 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+from opendiamond.helpers import murmur
+from opendiamond.server.filter import _FilterResult, RESULT_FORMAT_COMPACT
+
+
+class _Names(object):
+    def __init__(self, generation=7):
+        self.generation = generation
+        self.names = []
+
+    def intern(self, names):
+        for name in names:
+            if name not in self.names:
+                self.names.append(name)
+        return self.generation, [self.names.index(name) for name in names]
+
+    def lookup(self, generation, ids):
+        if generation != self.generation:
+            return [None] * len(ids)
+        return [self.names[i] if i < len(self.names) else None for i in ids]
+
+
+def _result(score):
+    return _FilterResult({'': murmur('data'), 'missing': None},
+                         {'rgb': murmur('pixels'), 'score': murmur('1')},
+                         ['rgb'], score)
+
+
+def _assert_same(a, b):
+    assert a.input_attrs == b.input_attrs
+    assert a.output_attrs == b.output_attrs
+    assert a.omit_attrs == b.omit_attrs
+    assert a.score == b.score
+    assert isinstance(b.score, float)
+
+
+def test_compact_roundtrip():
+    names = _Names()
+    for score in (0.0, 1.0, -3.0, 12345678901.0, 0.25, -1e300):
+        result = _result(score)
+        data = result.encode(names.intern)
+        assert data.startswith(RESULT_FORMAT_COMPACT)
+        assert len(data) < len(result.encode()) / 2
+        _assert_same(result, _FilterResult.decode(data, names.lookup))
+
+
+def test_compact_unknown_names():
+    names = _Names()
+    data = _result(1.0).encode(names.intern)
+    del names.names[-1]
+    assert _FilterResult.decode(data, names.lookup) is None
+    assert _FilterResult.decode(data) is None
+    assert _FilterResult.decode(data[:-3], names.lookup) is None
+    # Nor against a later generation of the table
+    data = _result(1.0).encode(names.intern)
+    names.generation += 1
+    assert _FilterResult.decode(data, names.lookup) is None
+
+
+def test_json_entries_still_read():
+    result = _result(2.0)
+    _assert_same(result, _FilterResult.decode(result.encode(),
+                                              _Names().lookup))
+    # Signatures that aren't murmur() hashes fall back to JSON
+    result.output_attrs['odd'] = 'not-a-hash'
+    data = result.encode(_Names().intern)
+    assert data.startswith('{')
+    _assert_same(result, _FilterResult.decode(data))